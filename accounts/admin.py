@@ -1,5 +1,11 @@
 from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db.models import Q
+
+from mysite.large_admin import LargeTableAdmin
+
 from .models import Profile, OTP, Friendship
+from .services import normalize_phone
 
 
 @admin.register(Profile)
@@ -16,8 +22,23 @@ class OTPAdmin(admin.ModelAdmin):
 
 
 @admin.register(Friendship)
-class FriendshipAdmin(admin.ModelAdmin):
+class FriendshipAdmin(LargeTableAdmin):
     list_display = ("from_user", "to_user", "status", "created_at", "updated_at")
-    list_filter = ("status", "created_at")
-    search_fields = ("from_user__profile__name", "to_user__profile__name")
+    list_filter = ("status",)
+    list_select_related = ("from_user", "to_user")
+    search_fields = ("=from_user__username", "=to_user__username")
+    search_help_text = "اسم المستخدم أو رقم الهاتف أو رقم المستخدم بالضبط"
     raw_id_fields = ("from_user", "to_user")
+
+    def get_search_results(self, request, queryset, search_term):
+        # نبحث عن المستخدمين أولاً بفهارس فريدة (اسم المستخدم، الهاتف) ثم عن صداقاتهم
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        match = Q(username=term)
+        if term.isdigit():
+            match |= Q(pk=int(term))
+        if any(c.isdigit() for c in term):
+            match |= Q(profile__phone=normalize_phone(term))
+        user_ids = list(User.objects.filter(match).values_list("pk", flat=True))
+        return queryset.filter(Q(from_user__in=user_ids) | Q(to_user__in=user_ids)), False
@@ -6,6 +6,9 @@ from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
 
+from core.ratelimit import ratelimit, user_or_ip
+from mysite.db_router import replica_reads
+
 from .models import Friendship
 from .serializers import (
     UserSerializer, 
@@ -28,6 +31,8 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         ).select_related('profile')
     
     @action(detail=False, methods=['get'])
+    @ratelimit('user_search', '30/m', key=user_or_ip)
+    @replica_reads
     def search(self, request):
         """البحث عن مستخدمين بالاسم أو الهاتف"""
         query = request.GET.get('q', '').strip()
@@ -238,7 +243,7 @@ class FriendshipViewSet(viewsets.ModelViewSet):
         friendships = Friendship.objects.filter(
             to_user=request.user,
             status=Friendship.STATUS_PENDING
-        ).select_related('from_user__profile')
+        ).select_related('from_user__profile', 'to_user__profile')
         
         serializer = self.get_serializer(friendships, many=True)
         return Response(serializer.data)
@@ -249,7 +254,7 @@ class FriendshipViewSet(viewsets.ModelViewSet):
         friendships = Friendship.objects.filter(
             from_user=request.user,
             status=Friendship.STATUS_PENDING
-        ).select_related('to_user__profile')
+        ).select_related('from_user__profile', 'to_user__profile')
         
         serializer = self.get_serializer(friendships, many=True)
         return Response(serializer.data)
@@ -260,7 +265,7 @@ class FriendshipViewSet(viewsets.ModelViewSet):
         friendships = Friendship.objects.filter(
             from_user=request.user,
             status=Friendship.STATUS_BLOCKED
-        ).select_related('to_user__profile')
+        ).select_related('from_user__profile', 'to_user__profile')
         
         serializer = self.get_serializer(friendships, many=True)
         return Response(serializer.data)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from accounts.otp_store import get_otp_store
+
+
+class Command(BaseCommand):
+    help = 'Delete expired or used OTP codes in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--max-batches', type=int, default=None)
+
+    def handle(self, *args, **options):
+        purged = get_otp_store().sweep(
+            batch_size=options['batch_size'],
+            max_batches=options['max_batches'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Purged {purged} OTP codes'))
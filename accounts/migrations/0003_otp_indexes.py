@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_friendship'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(fields=['phone', 'purpose', 'is_used', '-created_at'], name='accounts_otp_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(fields=['expires_at'], name='accounts_otp_expires_idx'),
+        ),
+    ]
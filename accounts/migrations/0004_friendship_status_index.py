@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+from mysite.migration_operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0003_otp_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='friendship',
+            index=models.Index(fields=['status', 'id'], name='accounts_friendship_status_idx'),
+        ),
+    ]
@@ -25,6 +25,12 @@ class OTP(models.Model):
     is_used = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['phone', 'purpose', 'is_used', '-created_at'], name='accounts_otp_lookup_idx'),
+            models.Index(fields=['expires_at'], name='accounts_otp_expires_idx'),
+        ]
+
     def is_expired(self) -> bool:
         return timezone.now() >= self.expires_at
 
@@ -68,6 +74,9 @@ class Friendship(models.Model):
     class Meta:
         unique_together = (('from_user', 'to_user'),)
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='accounts_friendship_status_idx'),
+        ]
         verbose_name = 'صداقة'
         verbose_name_plural = 'الصداقات'
     
@@ -90,6 +99,19 @@ class Friendship(models.Model):
             models.Q(from_user=user2, to_user=user1, status=cls.STATUS_BLOCKED)
         ).exists()
     
+    @classmethod
+    def relations_with(cls, user, others):
+        """علاقات ``user`` مع مجموعة مستخدمين باستعلام واحد: {معرف المستخدم: [العلاقات، الأحدث أولاً]}"""
+        ids = [getattr(other, 'pk', other) for other in others]
+        relations = {pk: [] for pk in ids}
+        for friendship in cls.objects.filter(
+            models.Q(from_user=user, to_user_id__in=ids) |
+            models.Q(from_user_id__in=ids, to_user=user)
+        ):
+            other_id = friendship.to_user_id if friendship.from_user_id == user.pk else friendship.from_user_id
+            relations[other_id].append(friendship)
+        return relations
+    
     @classmethod
     def get_friendship_status(cls, user1, user2):
         """الحصول على حالة العلاقة بين مستخدمين"""
@@ -0,0 +1,186 @@
+"""Pluggable storage for one-time passcodes.
+
+``DatabaseOTPStore`` keeps codes in the ``OTP`` table and purges expired or
+used rows in batches.  ``CacheOTPStore`` keeps a single entry per
+(phone, purpose) in the Django cache and lets the cache TTL expire it, so
+nothing accumulates at all.  The active backend is chosen with
+``settings.OTP_STORE``.
+"""
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OTP
+
+
+class BaseOTPStore:
+    """Interface shared by every OTP backend."""
+
+    def get_active(self, phone: str, purpose: str) -> Optional[OTP]:
+        """Return the latest unused code for phone/purpose, or None."""
+        raise NotImplementedError
+
+    def issue(self, phone: str, purpose: str, code: str, ttl: timedelta) -> OTP:
+        raise NotImplementedError
+
+    def set_code(self, otp: OTP, code: str) -> None:
+        raise NotImplementedError
+
+    def record_attempt(self, otp: OTP, limit: int) -> bool:
+        """Count one guess at ``otp``; False (and nothing counted) once ``limit`` guesses were made.
+
+        The check and the increment are one atomic step, so guesses made in
+        parallel cannot all pass on the same count.
+        """
+        raise NotImplementedError
+
+    def consume(self, otp: OTP) -> None:
+        raise NotImplementedError
+
+    def sweep(self, batch_size: int = 1000, max_batches: Optional[int] = None) -> int:
+        """Remove dead codes; returns the number of purged entries."""
+        return 0
+
+
+class DatabaseOTPStore(BaseOTPStore):
+    """OTP rows in the database, looked up through ``accounts_otp_lookup_idx``."""
+
+    SWEEP_LOCK_KEY = 'otp:sweep-lock'
+
+    def get_active(self, phone, purpose):
+        return (
+            OTP.objects.filter(phone=phone, purpose=purpose, is_used=False)
+            .order_by('-created_at')
+            .first()
+        )
+
+    def issue(self, phone, purpose, code, ttl):
+        otp = OTP.objects.create(
+            phone=phone,
+            code=code,
+            purpose=purpose,
+            expires_at=timezone.now() + ttl,
+        )
+        self.maybe_sweep()
+        return otp
+
+    def set_code(self, otp, code):
+        otp.code = code
+        otp.save(update_fields=['code'])
+
+    def record_attempt(self, otp, limit):
+        if not OTP.objects.filter(pk=otp.pk, attempts__lt=limit).update(attempts=F('attempts') + 1):
+            return False
+        otp.attempts += 1
+        return True
+
+    def consume(self, otp):
+        otp.is_used = True
+        otp.save(update_fields=['is_used'])
+
+    def maybe_sweep(self) -> None:
+        """Run one sweep batch at most once per ``OTP_SWEEP_INTERVAL`` seconds."""
+        interval = getattr(settings, 'OTP_SWEEP_INTERVAL', 3600)
+        if interval and cache.add(self.SWEEP_LOCK_KEY, 1, timeout=interval):
+            self.sweep(max_batches=1)
+
+    def sweep(self, batch_size=1000, max_batches=None):
+        dead = OTP.objects.filter(Q(expires_at__lte=timezone.now()) | Q(is_used=True))
+        purged = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            ids = list(dead.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            purged += OTP.objects.filter(pk__in=ids).delete()[0]
+            batches += 1
+            if len(ids) < batch_size:
+                break
+        return purged
+
+
+class CacheOTPStore(BaseOTPStore):
+    """One cache entry per (phone, purpose); expiry is left to the cache TTL.
+
+    Returned ``OTP`` instances are unsaved and only carry the cached fields.
+    """
+
+    KEY_PREFIX = 'otp'
+
+    def _key(self, phone: str, purpose: str) -> str:
+        return f"{self.KEY_PREFIX}:{purpose}:{phone}"
+
+    def _attempts_key(self, phone: str, purpose: str) -> str:
+        # A counter of its own, so it can be moved with cache.incr
+        return f"{self.KEY_PREFIX}:attempts:{purpose}:{phone}"
+
+    def _timeout(self, otp: OTP) -> int:
+        return max(1, int((otp.expires_at - timezone.now()).total_seconds()))
+
+    def _save(self, otp: OTP) -> None:
+        cache.set(
+            self._key(otp.phone, otp.purpose),
+            {
+                'code': otp.code,
+                'created_at': otp.created_at,
+                'expires_at': otp.expires_at,
+            },
+            timeout=self._timeout(otp),
+        )
+
+    def get_active(self, phone, purpose):
+        data = cache.get(self._key(phone, purpose))
+        if not data:
+            return None
+        otp = OTP(
+            phone=phone,
+            purpose=purpose,
+            code=data['code'],
+            attempts=cache.get(self._attempts_key(phone, purpose), 0),
+            expires_at=data['expires_at'],
+        )
+        otp.created_at = data['created_at']
+        return otp
+
+    def issue(self, phone, purpose, code, ttl):
+        now = timezone.now()
+        otp = OTP(phone=phone, purpose=purpose, code=code, expires_at=now + ttl)
+        otp.created_at = now
+        self._save(otp)
+        cache.set(self._attempts_key(phone, purpose), 0, timeout=self._timeout(otp))
+        return otp
+
+    def set_code(self, otp, code):
+        otp.code = code
+        self._save(otp)
+
+    def record_attempt(self, otp, limit):
+        key = self._attempts_key(otp.phone, otp.purpose)
+        cache.add(key, 0, timeout=self._timeout(otp))
+        try:
+            otp.attempts = cache.incr(key)
+        except ValueError:
+            # The counter was evicted between add and incr: count nothing and refuse
+            return False
+        return otp.attempts <= limit
+
+    def consume(self, otp):
+        otp.is_used = True
+        cache.delete_many([self._key(otp.phone, otp.purpose), self._attempts_key(otp.phone, otp.purpose)])
+
+
+_store = None
+
+
+def get_otp_store() -> BaseOTPStore:
+    """Return the configured store (``settings.OTP_STORE``), built once."""
+    global _store
+    if _store is None:
+        path = getattr(settings, 'OTP_STORE', 'accounts.otp_store.DatabaseOTPStore')
+        _store = import_string(path)()
+    return _store
@@ -11,6 +11,17 @@ class ProfileSerializer(serializers.ModelSerializer):
         fields = ['name', 'phone', 'created_at']
 
 
+class UserListSerializer(serializers.ListSerializer):
+    """يجلب علاقات الصداقة لكل القائمة باستعلام واحد بدل استعلامين لكل مستخدم"""
+    
+    def to_representation(self, data):
+        users = list(data.all() if hasattr(data, 'all') else data)
+        request = self.context.get('request')
+        if request and request.user.is_authenticated:
+            self.child.relations = Friendship.relations_with(request.user, users)
+        return super().to_representation(users)
+
+
 class UserSerializer(serializers.ModelSerializer):
     """Serializer للمستخدمين مع معلومات الملف الشخصي"""
     profile = ProfileSerializer(read_only=True)
@@ -20,25 +31,34 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'profile', 'is_friend', 'friendship_status']
+        list_serializer_class = UserListSerializer
+    
+    def _relations(self, obj):
+        """علاقات المستخدم الحالي مع ``obj`` (الأحدث أولاً)، أو None إن لم ينطبق"""
+        request = self.context.get('request')
+        if not (request and request.user.is_authenticated and request.user.pk != obj.pk):
+            return None
+        relations = getattr(self, 'relations', None)
+        if relations is None or obj.pk not in relations:
+            relations = self.relations = Friendship.relations_with(request.user, [obj])
+        return relations[obj.pk]
     
     def get_is_friend(self, obj):
         """تحقق إذا كان المستخدم صديق"""
-        request = self.context.get('request')
-        if request and request.user.is_authenticated and request.user != obj:
-            return Friendship.are_friends(request.user, obj)
-        return False
+        found = self._relations(obj)
+        return bool(found) and any(f.status == Friendship.STATUS_ACCEPTED for f in found)
     
     def get_friendship_status(self, obj):
         """الحصول على حالة الصداقة"""
         request = self.context.get('request')
-        if request and request.user.is_authenticated and request.user != obj:
-            friendship = Friendship.get_friendship_status(request.user, obj)
-            if friendship:
-                return {
-                    'status': friendship.status,
-                    'from_me': friendship.from_user == request.user,
-                    'created_at': friendship.created_at.isoformat()
-                }
+        found = self._relations(obj)
+        if found:
+            friendship = found[0]
+            return {
+                'status': friendship.status,
+                'from_me': friendship.from_user_id == request.user.pk,
+                'created_at': friendship.created_at.isoformat()
+            }
         return None
 
 
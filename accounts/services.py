@@ -1,14 +1,17 @@
 import os
 import random
 import re
+import time
 from datetime import timedelta
 from typing import Tuple
 
-import requests
 from django.utils import timezone
 from django.conf import settings
 
+from mysite.metrics import otp_latency, otp_sends
+
 from .models import OTP
+from .otp_store import get_otp_store
 
 
 def normalize_phone(phone: str) -> str:
@@ -21,35 +24,72 @@ def normalize_phone(phone: str) -> str:
     return digits
 
 
+def display_name(user) -> str:
+    """The name a user's messages are shown under: the profile name, else the username."""
+    profile = getattr(user, 'profile', None)
+    return profile.name if profile is not None else user.username
+
+
+OTP_TTL = timedelta(minutes=5)
+
+VERIFY_OK = 'ok'
+VERIFY_MISSING = 'missing'
+VERIFY_EXPIRED = 'expired'
+VERIFY_INVALID = 'invalid'
+VERIFY_TOO_MANY = 'too_many'
+
+
+def _use_static_otp() -> bool:
+    return bool(getattr(settings, 'DEBUG', False) or os.getenv('USE_STATIC_OTP'))
+
+
 def create_otp(phone: str, purpose: str = OTP.PURPOSE_SIGNUP) -> Tuple[OTP, bool]:
+    store = get_otp_store()
     now = timezone.now()
     # Throttle: if an OTP exists in last 60s, reuse it
-    recent = OTP.objects.filter(phone=phone, purpose=purpose, is_used=False, expires_at__gt=now).order_by('-created_at').first()
-    if recent and (now - recent.created_at).total_seconds() < 60:
-        if getattr(settings, 'DEBUG', False) or os.getenv('USE_STATIC_OTP'):
-            if recent.code != '123456':
-                recent.code = '123456'
-                recent.save(update_fields=['code'])
+    recent = store.get_active(phone, purpose)
+    if recent and not recent.is_expired() and (now - recent.created_at).total_seconds() < 60:
+        if _use_static_otp() and recent.code != '123456':
+            store.set_code(recent, '123456')
         return recent, False
     code = f"{random.randint(0, 999999):06d}"
-    if getattr(settings, 'DEBUG', False) or os.getenv('USE_STATIC_OTP'):
+    if _use_static_otp():
         code = '123456'
-    otp = OTP.objects.create(
-        phone=phone,
-        code=code,
-        purpose=purpose,
-        expires_at=now + timedelta(minutes=5),
-    )
-    return otp, True
+    return store.issue(phone, purpose, code, OTP_TTL), True
+
+
+def verify_otp(phone: str, code: str, purpose: str = OTP.PURPOSE_SIGNUP) -> str:
+    """Check ``code`` against the active OTP and consume it on success.
+
+    Only codes issued for ``purpose`` count.  Every guess is counted before
+    it is compared, so at most ``OTP_MAX_ATTEMPTS`` guesses are ever
+    checked, even in parallel; the next one uses the code up.  Returns one
+    of the ``VERIFY_*`` constants.
+    """
+    store = get_otp_store()
+    otp = store.get_active(phone, purpose)
+    if not otp:
+        return VERIFY_MISSING
+    if otp.is_expired():
+        return VERIFY_EXPIRED
+    if not store.record_attempt(otp, settings.OTP_MAX_ATTEMPTS):
+        store.consume(otp)
+        return VERIFY_TOO_MANY
+    if otp.code != code:
+        return VERIFY_INVALID
+    store.consume(otp)
+    return VERIFY_OK
 
 
 def send_whatsapp_otp_via_twilio(phone: str, code: str) -> bool:
-    if getattr(settings, 'DEBUG', False) or os.getenv('USE_STATIC_OTP'):
+    if _use_static_otp():
+        otp_sends.labels('static').inc()
         return True
     account_sid = os.getenv('TWILIO_ACCOUNT_SID')
     auth_token = os.getenv('TWILIO_AUTH_TOKEN')
     wa_from = os.getenv('TWILIO_WHATSAPP_FROM')  # e.g. 'whatsapp:+14155238886'
     if not all([account_sid, auth_token, wa_from]):
+        otp_sends.labels('unconfigured').inc()
         return False
     url = f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
     data = {
@@ -57,8 +97,15 @@ def send_whatsapp_otp_via_twilio(phone: str, code: str) -> bool:
         'To': f'whatsapp:{phone}' if not phone.startswith('whatsapp:') else phone,
         'Body': f'رمز التحقق الخاص بك هو: {code}\nArab Chat'
     }
+    # مستورد عند الحاجة فقط: لا داعي لتحميله عند إقلاع العامل
+    import requests
+
+    started = time.perf_counter()
     try:
         resp = requests.post(url, data=data, auth=(account_sid, auth_token), timeout=10)
-        return 200 <= resp.status_code < 300
+        ok = 200 <= resp.status_code < 300
     except Exception:
-        return False
+        ok = False
+    otp_latency.observe(time.perf_counter() - started)
+    otp_sends.labels('ok' if ok else 'failed').inc()
+    return ok
@@ -0,0 +1,140 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from core.tests import PLAIN_STATIC, QueryBudgetMixin
+from . import services
+from .models import OTP, Friendship, Profile
+from .otp_store import CacheOTPStore, DatabaseOTPStore
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False)
+class FriendshipQueryBudgetTests(QueryBudgetMixin, TransactionTestCase):
+    """قوائم المستخدمين والأصدقاء بعدد استعلامات ثابت مهما زاد عدد المستخدمين والعلاقات"""
+
+    def setUp(self):
+        self.me = User.objects.create_user(username='me')
+        Profile.objects.create(user=self.me, phone='+10', name='me')
+        self.client.force_login(self.me)
+        self.size = 0
+
+    def grow_to(self, size: int) -> None:
+        statuses = [Friendship.STATUS_ACCEPTED, Friendship.STATUS_PENDING, Friendship.STATUS_BLOCKED]
+        for i in range(self.size, size):
+            other = User.objects.create_user(username=f'user{i}')
+            Profile.objects.create(user=other, phone=f'+2{i}', name=f'user {i}')
+            # Both directions and every status
+            sender, receiver = (self.me, other) if i % 2 else (other, self.me)
+            Friendship.objects.create(from_user=sender, to_user=receiver, status=statuses[i % 3])
+        self.size = size
+
+    def test_users_list(self):
+        self.assertFlatQueries(5, lambda: self.get_ok('/accounts/users/'))
+
+    def test_friends_list(self):
+        self.assertFlatQueries(7, lambda: self.get_ok('/accounts/friends/'))
+
+    def test_api_users(self):
+        self.assertFlatQueries(5, lambda: self.get_ok('/api/v1/users/'))
+
+    def test_api_user_search(self):
+        self.assertFlatQueries(4, lambda: self.get_ok('/api/v1/users/search/?q=user'))
+
+    def test_api_friends(self):
+        self.assertFlatQueries(5, lambda: self.get_ok('/api/v1/users/friends/'))
+
+    def test_api_friendships(self):
+        for action in ('', 'pending_received/', 'pending_sent/', 'blocked_users/'):
+            with self.subTest(action=action):
+                self.size = 0
+                Friendship.objects.all().delete()
+                User.objects.exclude(pk=self.me.pk).delete()
+                self.assertFlatQueries(4, lambda: self.get_ok(f'/api/v1/friendships/{action}'))
+
+    def test_users_list_matches_per_user_lookups(self):
+        """الاستعلام المجمّع يعطي نفس حالة الصداقة التي تعطيها الدوال لكل مستخدم"""
+        self.grow_to(6)
+        users = self.get_ok('/accounts/users/').context['users']
+        for user in users:
+            self.assertEqual(user.friendship, Friendship.get_friendship_status(self.me, user))
+            self.assertEqual(user.is_friend, Friendship.are_friends(self.me, user))
+            self.assertEqual(user.is_blocked, Friendship.is_blocked(self.me, user))
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False)
+class FriendshipAdminTests(TransactionTestCase):
+    """البحث في الصداقات بالمستخدم بالضبط دون LIKE على الجداول المرتبطة"""
+
+    def test_search_by_username_or_phone(self):
+        users = [User.objects.create_user(username=f'user{i}') for i in range(3)]
+        Profile.objects.create(user=users[2], phone='+9665', name='user 2')
+        first = Friendship.objects.create(from_user=users[0], to_user=users[1])
+        second = Friendship.objects.create(from_user=users[2], to_user=users[0])
+        self.client.force_login(User.objects.create_superuser(username='admin', password='x'))
+        for term, expected in [('user1', [first]), ('user0', [second, first]), ('00 9665', [second])]:
+            response = self.client.get('/admin/accounts/friendship/', {'q': term})
+            self.assertEqual(list(response.context['cl'].result_list), expected)
+
+
+class OTPStoreTests(TransactionTestCase):
+    """إصدار الرموز والتحقق منها وانتهاؤها وحذف القديمة في مخزن قاعدة البيانات"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_issue_and_verify(self):
+        otp, created = services.create_otp('+1')
+        self.assertTrue(created)
+        # A second request within a minute reuses the code
+        self.assertEqual(services.create_otp('+1'), (otp, False))
+        self.assertEqual(services.verify_otp('+1', otp.code), services.VERIFY_OK)
+        self.assertEqual(services.verify_otp('+1', otp.code), services.VERIFY_MISSING)
+
+    def test_codes_only_count_for_their_purpose(self):
+        otp, _ = services.create_otp('+1', OTP.PURPOSE_LOGIN)
+        self.assertEqual(services.verify_otp('+1', otp.code, OTP.PURPOSE_SIGNUP), services.VERIFY_MISSING)
+        self.assertEqual(services.verify_otp('+1', otp.code, OTP.PURPOSE_LOGIN), services.VERIFY_OK)
+
+    def test_expired_code(self):
+        otp, _ = services.create_otp('+1')
+        OTP.objects.filter(pk=otp.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(services.verify_otp('+1', otp.code), services.VERIFY_EXPIRED)
+
+    @override_settings(OTP_MAX_ATTEMPTS=3)
+    def test_wrong_codes_use_the_code_up(self):
+        for store in (DatabaseOTPStore(), CacheOTPStore()):
+            with self.subTest(store=type(store).__name__), mock.patch.object(services, 'get_otp_store', lambda: store):
+                otp, _ = services.create_otp('+1')
+                wrong = '000000' if otp.code != '000000' else '111111'
+                results = [services.verify_otp('+1', wrong) for _ in range(4)]
+                self.assertEqual(results, [services.VERIFY_INVALID] * 3 + [services.VERIFY_TOO_MANY])
+                self.assertEqual(services.verify_otp('+1', otp.code), services.VERIFY_MISSING)
+
+    @override_settings(OTP_MAX_ATTEMPTS=3)
+    def test_parallel_guesses_share_one_count(self):
+        """كل طلب قرأ الرمز قبل أن يُسجّل غيره محاولته، ومع ذلك لا يمر أكثر من الحد"""
+        for store in (DatabaseOTPStore(), CacheOTPStore()):
+            with self.subTest(store=type(store).__name__):
+                store.issue('+1', OTP.PURPOSE_SIGNUP, '123456', timedelta(minutes=5))
+                stale = [store.get_active('+1', OTP.PURPOSE_SIGNUP) for _ in range(5)]
+                self.assertEqual([store.record_attempt(otp, 3) for otp in stale], [True] * 3 + [False] * 2)
+                store.consume(stale[0])
+
+    @override_settings(OTP_SWEEP_INTERVAL=3600)
+    def test_maybe_sweep_purges_dead_codes_once_per_interval(self):
+        store = DatabaseOTPStore()
+        past = timezone.now() - timedelta(minutes=1)
+        OTP.objects.create(phone='+1', code='1', expires_at=past)
+        OTP.objects.create(phone='+2', code='2', expires_at=timezone.now() + timedelta(minutes=5), is_used=True)
+        live = store.issue('+3', OTP.PURPOSE_SIGNUP, '3', timedelta(minutes=5))
+        self.assertEqual(list(OTP.objects.values_list('pk', flat=True)), [live.pk])
+        # The next sweep waits for the interval
+        OTP.objects.create(phone='+4', code='4', expires_at=past)
+        store.maybe_sweep()
+        self.assertEqual(OTP.objects.count(), 2)
+        self.assertEqual(store.sweep(batch_size=1), 1)
@@ -10,13 +10,32 @@ from django.core.paginator import Paginator
 from django.db.models import Q
 from django.http import JsonResponse
 
+from core.ratelimit import ratelimit, client_ip
+from mysite.db_router import replica_reads
+
 from .forms import SignupForm, VerifyForm
 from .models import Profile, OTP, Friendship
-from .services import normalize_phone, create_otp, send_whatsapp_otp_via_twilio
+from .services import (
+    normalize_phone, create_otp, verify_otp, send_whatsapp_otp_via_twilio,
+    VERIFY_MISSING, VERIFY_EXPIRED, VERIFY_INVALID, VERIFY_TOO_MANY,
+)
+
+
+def _otp_phone_key(request):
+    phone = request.POST.get('phone')
+    return normalize_phone(phone) if phone else None
+
+
+def _verify_phone_key(request):
+    # The verify form falls back to the phone kept in the session
+    phone = request.POST.get('phone') or request.session.get('pending_phone')
+    return normalize_phone(phone) if phone else None
 
 
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
+@ratelimit('otp_ip', '20/h', key=client_ip, methods=['POST'])
+@ratelimit('otp_phone', '5/h', key=_otp_phone_key, methods=['POST'])
 def signup(request):
     if request.user.is_authenticated:
         return redirect('core:room_list')
@@ -39,6 +58,8 @@ def signup(request):
 
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
+@ratelimit('verify_ip', '60/h', key=client_ip, methods=['POST'])
+@ratelimit('verify_phone', '10/h', key=_verify_phone_key, methods=['POST'])
 def verify(request):
     if request.user.is_authenticated:
         return redirect('core:room_list')
@@ -51,20 +72,19 @@ def verify(request):
             phone = normalize_phone(phone_val or '')
             name = (name_val or 'مستخدم').strip() or 'مستخدم'
             code = form.cleaned_data['code'].strip()
-            otp = OTP.objects.filter(phone=phone, is_used=False).order_by('-created_at').first()
-            if not otp:
+            result = verify_otp(phone, code, OTP.PURPOSE_SIGNUP)
+            if result == VERIFY_MISSING:
                 messages.error(request, 'لم يتم العثور على رمز صالح. الرجاء إعادة الإرسال من صفحة التسجيل.')
                 return redirect('accounts:signup')
-            if otp.is_expired():
+            if result == VERIFY_EXPIRED:
                 messages.error(request, 'انتهت صلاحية الرمز. الرجاء المحاولة مجدداً.')
                 return redirect('accounts:signup')
-            if otp.code != code:
-                otp.attempts += 1
-                otp.save(update_fields=['attempts'])
+            if result == VERIFY_TOO_MANY:
+                messages.error(request, 'محاولات خاطئة كثيرة. الرجاء طلب رمز جديد.')
+                return redirect('accounts:signup')
+            if result == VERIFY_INVALID:
                 messages.error(request, 'رمز غير صحيح.')
                 return render(request, 'accounts/verify.html', {'form': form, 'phone': phone})
-            otp.is_used = True
-            otp.save(update_fields=['is_used'])
             user = User.objects.filter(profile__phone=phone).first()
             if not user:
                 username = f"user_{timezone.now().timestamp()}"
@@ -93,7 +113,10 @@ def dashboard(request):
 
 def logout_view(request):
     logout(request)
-    return redirect('accounts:signup')
+    response = redirect('accounts:signup')
+    # الصفحات التالية تعرض السجل من الخادم إلى أن يُنشئ المستخدم التالي ذاكرته المحلية
+    response.delete_cookie('chat_history')
+    return response
 
 
 @csrf_exempt
@@ -128,6 +151,7 @@ def contacts_sync(request):
 
 
 @login_required
+@replica_reads
 def users_list(request):
     """عرض قائمة جميع المستخدمين مع البحث"""
     # استبعاد المستخدم الحالي والمستخدمين بدون profile
@@ -149,16 +173,18 @@ def users_list(request):
     page = request.GET.get('page', 1)
     users_page = paginator.get_page(page)
     
-    # إضافة حالة الصداقة لكل مستخدم
+    # إضافة حالة الصداقة لكل مستخدم (استعلام واحد للصفحة كلها)
+    relations = Friendship.relations_with(request.user, users_page)
     for user in users_page:
-        user.friendship = Friendship.get_friendship_status(request.user, user)
-        user.is_friend = Friendship.are_friends(request.user, user)
-        user.is_blocked = Friendship.is_blocked(request.user, user)
+        found = relations[user.id]
+        user.friendship = found[0] if found else None
+        user.is_friend = any(f.status == Friendship.STATUS_ACCEPTED for f in found)
+        user.is_blocked = any(f.status == Friendship.STATUS_BLOCKED for f in found)
     
     return render(request, 'accounts/users_list.html', {
         'users': users_page,
         'query': query,
-        'total_count': users.count()
+        'total_count': paginator.count
     })
 
 
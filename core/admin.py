@@ -1,5 +1,10 @@
 from django.contrib import admin
-from .models import Room, Message
+
+from mysite.large_admin import LargeTableAdmin
+
+from .models import Room, Message, RoomActivity
+
+ACTIVE_ROOMS_IN_FILTER = 20
 
 
 @admin.register(Room)
@@ -9,8 +14,43 @@ class RoomAdmin(admin.ModelAdmin):
     prepopulated_fields = {"slug": ("name",)}
 
 
+class ActiveRoomFilter(admin.SimpleListFilter):
+    """The most active rooms (from ``RoomActivity.rank``) rather than every room; any id works in the URL."""
+
+    title = "room"
+    parameter_name = "room"
+
+    def lookups(self, request, model_admin):
+        top = RoomActivity.objects.select_related("room").order_by("-rank")[:ACTIVE_ROOMS_IN_FILTER]
+        return [(str(activity.room_id), activity.room.name) for activity in top]
+
+    def has_output(self):
+        # Still filter by a room that is not (or no longer) among the active ones
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        if not self.value().isdigit():
+            return queryset.none()
+        return queryset.filter(room_id=self.value())
+
+
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     list_display = ("id", "room", "author_name", "content", "created_at")
-    list_filter = ("room",)
-    search_fields = ("author_name", "content")
+    list_filter = (ActiveRoomFilter,)
+    list_select_related = ("room",)
+    autocomplete_fields = ("room",)
+    raw_id_fields = ("author",)
+    search_fields = ("=id", "=author_name")
+    search_help_text = "Message id or exact author name"
+
+    def get_search_results(self, request, queryset, search_term):
+        # Both hit an index (the primary key, core_message_author_id_idx)
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if term.isdigit():
+            return queryset.filter(pk=int(term)), False
+        return queryset.filter(author_name=term), False
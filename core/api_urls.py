@@ -8,6 +8,7 @@ router.register(r'direct-threads', api_views.DirectThreadViewSet, basename='dire
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('messages/batch/', api_views.send_messages_batch, name='send_messages_batch'),
     path('rooms/search/', api_views.search_rooms, name='search_rooms'),
     path('rooms/<str:room_slug>/poll/', api_views.api_messages_poll, name='messages_poll'),
 ]
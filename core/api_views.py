@@ -2,13 +2,49 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, aget_object_or_404
+from django.views.decorators.http import require_GET
+from django.conf import settings
 from django.db.models import Q
+from django.http import Http404
+from accounts.services import display_name
 from .models import Room, Message, DirectThread, DirectMessage
+from .archive import cursor_param, room_history, aroom_history, thread_history
+from .batch import submit_batch
+from .changes import MessageArchived, adelta_fields, change_row, delete_message, edit_message
+from .directory import record_messages
+from .fragments import bump_room_list, bump_dm_list, set_thread_last_message
+from mysite.db_router import replica_reads
+from mysite.metrics import chat_messages
+from .ratelimit import ratelimit, user_or_ip
+from .views import DELTA_LIMIT
+from .conditional import conditional_get, room_list_etag, room_messages_etag, thread_list_etag
 from .serializers import (
     RoomSerializer, MessageSerializer,
     DirectThreadSerializer, DirectMessageSerializer
 )
+from .fast_serializers import (
+    MESSAGE_COLUMNS, DIRECT_MESSAGE_COLUMNS, FastJsonResponse,
+    room_rows, thread_rows, serialize_messages, serialize_direct_messages,
+    serialize_rooms, serialize_threads,
+)
+
+
+def change_message(request, conversation, message_id: int) -> Response:
+    """PATCH (``content``) edits a message of ``conversation``, DELETE deletes it."""
+    try:
+        if request.method == 'DELETE':
+            change = delete_message(conversation, message_id, request.user)
+        else:
+            content = request.data.get('content', '')
+            if not content:
+                return Response({'error': 'Content is required'}, status=status.HTTP_400_BAD_REQUEST)
+            change = edit_message(conversation, message_id, request.user, content)
+    except (Message.DoesNotExist, DirectMessage.DoesNotExist):
+        raise Http404
+    except MessageArchived:
+        return Response({'error': 'Archived messages cannot be changed'}, status=status.HTTP_409_CONFLICT)
+    return Response(change_row(change))
 
 
 class RoomViewSet(viewsets.ModelViewSet):
@@ -17,19 +53,45 @@ class RoomViewSet(viewsets.ModelViewSet):
     serializer_class = RoomSerializer
     lookup_field = 'slug'
     
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        bump_room_list()
+    
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        bump_room_list()
+    
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        bump_room_list()
+    
+    @replica_reads
+    @conditional_get(room_list_etag)
+    def list(self, request, *args, **kwargs):
+        rows = room_rows(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serialize_rooms(page))
+        return Response(serialize_rooms(rows))
+    
+    @replica_reads
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+    
     @action(detail=True, methods=['get'])
+    @replica_reads
     def messages(self, request, slug=None):
-        """Get all messages for a specific room"""
+        """Get the last 200 messages of a room, or the 200 before ?before=<id>"""
         room = self.get_object()
-        messages = room.messages.all()[:200]  # Last 200 messages
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        rows = room_history(room, before=cursor_param(request.query_params, 'before'), limit=200,
+                            columns=MESSAGE_COLUMNS)
+        return Response(serialize_messages(rows))
     
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def send_message(self, request, slug=None):
         """Send a message to a room"""
         room = self.get_object()
-        author_name = request.user.profile.name if hasattr(request.user, 'profile') else request.user.username
+        author_name = display_name(request.user)
         content = request.data.get('content', '')
         
         if not content:
@@ -37,11 +99,20 @@ class RoomViewSet(viewsets.ModelViewSet):
         
         message = Message.objects.create(
             room=room,
+            author=request.user,
             author_name=author_name,
             content=content
         )
+        record_messages([message])
+        chat_messages.labels('room', 'http').inc()
         serializer = MessageSerializer(message)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
+    
+    @action(detail=True, methods=['patch', 'delete'], url_path=r'messages/(?P<message_id>\d+)',
+            permission_classes=[IsAuthenticated])
+    def message(self, request, slug=None, message_id=None):
+        """Edit (PATCH) or delete (DELETE) one of your messages in a room"""
+        return change_message(request, self.get_object(), int(message_id))
 
 
 class DirectThreadViewSet(viewsets.ModelViewSet):
@@ -56,13 +127,23 @@ class DirectThreadViewSet(viewsets.ModelViewSet):
             Q(user1=user) | Q(user2=user)
         ).distinct()
     
+    @replica_reads
+    @conditional_get(thread_list_etag)
+    def list(self, request, *args, **kwargs):
+        rows = thread_rows(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serialize_threads(page))
+        return Response(serialize_threads(rows))
+    
     @action(detail=True, methods=['get'])
+    @replica_reads
     def messages(self, request, pk=None):
-        """Get all messages for a specific thread"""
+        """Get the last 500 messages of a thread, or the 500 before ?before=<id>"""
         thread = self.get_object()
-        messages = thread.messages.all()[:500]
-        serializer = DirectMessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        rows = thread_history(thread, before=cursor_param(request.query_params, 'before'), limit=500,
+                              columns=DIRECT_MESSAGE_COLUMNS)
+        return Response(serialize_direct_messages(rows))
     
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
@@ -78,9 +159,16 @@ class DirectThreadViewSet(viewsets.ModelViewSet):
             author=request.user,
             content=content
         )
+        set_thread_last_message(message)
+        chat_messages.labels('dm', 'http').inc()
         serializer = DirectMessageSerializer(message)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     
+    @action(detail=True, methods=['patch', 'delete'], url_path=r'messages/(?P<message_id>\d+)')
+    def message(self, request, pk=None, message_id=None):
+        """Edit (PATCH) or delete (DELETE) one of your messages in a thread"""
+        return change_message(request, self.get_object(), int(message_id))
+    
     @action(detail=False, methods=['post'])
     def get_or_create(self, request):
         """Get or create a direct thread with another user"""
@@ -92,39 +180,62 @@ class DirectThreadViewSet(viewsets.ModelViewSet):
         from django.contrib.auth.models import User
         other_user = get_object_or_404(User, id=other_user_id)
         
-        # Ensure consistent ordering
-        u1, u2 = (request.user, other_user) if request.user.id <= other_user.id else (other_user, request.user)
-        
-        thread, created = DirectThread.objects.get_or_create(user1=u1, user2=u2)
+        thread, created = DirectThread.get_or_create_for_users(request.user.id, other_user.id)
+        if created:
+            bump_dm_list(thread.user1_id, thread.user2_id)
         serializer = self.get_serializer(thread)
         return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 
-@api_view(['GET'])
-def api_messages_poll(request, room_slug):
-    """Get new messages since a specific message ID (for polling)"""
-    room = get_object_or_404(Room, slug=room_slug)
-    after_id = int(request.GET.get('after', 0))
+@require_GET
+@replica_reads
+@conditional_get(room_messages_etag)
+async def api_messages_poll(request, room_slug):
+    """Get new messages since a specific message ID (for polling)
+    
+    At most DELTA_LIMIT messages per response; ``more`` tells the client to
+    poll again from the last id.  With ``?since_seq=N`` the edits and deletions after change seq N come
+    along (see ``core.changes``).  Plain async Django view (DRF views are sync-only) so the polling hot
+    path stays on the event loop.
+    """
+    room = await aget_object_or_404(Room, slug=room_slug)
+    after_id = cursor_param(request.GET, 'after') or 0
     
-    messages = room.messages.filter(id__gt=after_id)
-    serializer = MessageSerializer(messages, many=True)
+    rows = await aroom_history(room, after=after_id, limit=DELTA_LIMIT, columns=MESSAGE_COLUMNS)
     
-    return Response({
-        'messages': serializer.data,
-        'count': messages.count()
+    return FastJsonResponse({
+        'messages': serialize_messages(rows),
+        'count': len(rows),
+        'more': len(rows) == DELTA_LIMIT,
+        **await adelta_fields(request, room),
     })
 
 
 @api_view(['GET'])
+@replica_reads
 def search_rooms(request):
     """Search for rooms by name"""
     query = request.GET.get('q', '')
     
     if query:
-        rooms = Room.objects.filter(name__icontains=query)[:20]
+        rooms = Room.objects.filter(name__icontains=query)
     else:
-        rooms = Room.objects.all()[:20]
+        rooms = Room.objects.all()
     
-    serializer = RoomSerializer(rooms, many=True)
-    return Response(serializer.data)
+    return Response(serialize_rooms(room_rows(rooms)[:20]))
 
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@ratelimit('message_batch', '30/m', key=user_or_ip)
+def send_messages_batch(request):
+    """Send up to MESSAGE_BATCH_MAX messages to rooms and DM threads in one request"""
+    items = request.data.get('messages') if isinstance(request.data, dict) else request.data
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'Expected a non-empty list of messages'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > settings.MESSAGE_BATCH_MAX:
+        return Response(
+            {'error': f'At most {settings.MESSAGE_BATCH_MAX} messages per batch'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return Response({'results': submit_batch(request.user, items)})
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Hook the query metrics and profiler into every DB connection,
+        # including ones opened before the first request
+        import mysite.metrics  # noqa: F401
+        import mysite.query_profiler  # noqa: F401
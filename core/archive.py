@@ -0,0 +1,238 @@
+"""Tiered message storage: hot rows in the message tables, cold rows in
+compressed ``ArchiveSegment`` blocks.
+
+``archive_conversation`` moves the oldest hot messages of one room or DM
+thread into a segment; the ``archive_messages`` command drives it
+incrementally.  ``room_history``/``thread_history`` are the cursor-based
+readers used by the history endpoints: they read hot rows first and fall
+through to the archive once a page reaches past the oldest hot message.
+Archived rows come back as unsaved ``Message``/``DirectMessage`` instances,
+so serializers and templates treat both tiers the same way.  Passing
+``columns`` returns plain ``values_list`` tuples from both tiers instead, for
+the fast serializers in ``core.fast_serializers``.
+"""
+import json
+import zlib
+from datetime import datetime
+from operator import attrgetter
+from typing import List, Optional, Sequence
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import BadRequest
+from django.db import transaction
+
+from .db_executor import db_sync_to_async
+from .fragments import bump_room_list
+from .models import ArchiveSegment, DirectMessage, DirectThread, Message, Room
+
+
+def _conversation(kind: str):
+    """(message model, fk attname, author field, conversation model) for an archive kind."""
+    if kind == ArchiveSegment.KIND_ROOM:
+        return Message, 'room_id', 'author_name', Room
+    return DirectMessage, 'thread_id', 'author_id', DirectThread
+
+
+def encode_rows(rows) -> bytes:
+    payload = json.dumps(rows, separators=(',', ':'), ensure_ascii=False)
+    return zlib.compress(payload.encode('utf-8'), 6)
+
+
+def decode_segment(segment: ArchiveSegment) -> list:
+    """Rebuild the unsaved message instances stored in ``segment``."""
+    model, fk, author_field, _ = _conversation(segment.kind)
+    rows = json.loads(zlib.decompress(bytes(segment.payload)))
+    messages = []
+    for pk, author, content, created_at in rows:
+        message = model(**{'id': pk, fk: segment.conversation_id, author_field: author, 'content': content})
+        message.created_at = datetime.fromisoformat(created_at)
+        messages.append(message)
+    return messages
+
+
+def archive_conversation(kind: str, conversation_id: int, cutoff: datetime, segment_size: int) -> int:
+    """Move up to ``segment_size`` hot messages older than ``cutoff`` into one segment.
+
+    Returns the number of archived messages (0 when nothing is old enough).
+    """
+    model, fk, author_field, conversation_model = _conversation(kind)
+    with transaction.atomic():
+        rows = list(
+            model.objects.filter(**{fk: conversation_id, 'created_at__lt': cutoff})
+            .order_by('id')
+            .values_list('id', author_field, 'content', 'created_at')[:segment_size]
+        )
+        if not rows:
+            return 0
+        ArchiveSegment.objects.create(
+            kind=kind,
+            conversation_id=conversation_id,
+            first_id=rows[0][0],
+            last_id=rows[-1][0],
+            first_created_at=rows[0][3],
+            last_created_at=rows[-1][3],
+            count=len(rows),
+            payload=encode_rows([[pk, author, content, created.isoformat()] for pk, author, content, created in rows]),
+        )
+        model.objects.filter(id__in=[r[0] for r in rows]).delete()
+        conversation_model.objects.filter(pk=conversation_id).update(archived_through=rows[-1][0])
+    if kind == ArchiveSegment.KIND_ROOM:
+        # Room list counts only cover hot messages
+        bump_room_list()
+    return len(rows)
+
+
+def archive_older_than(cutoff: datetime, segment_size: Optional[int] = None, max_segments: Optional[int] = None):
+    """Archive every conversation's messages older than ``cutoff``.
+
+    Works one segment at a time and stops after ``max_segments`` so runs can
+    be kept short; the next run simply continues where this one stopped.
+    Returns ``(segments, messages)`` written.
+    """
+    segment_size = segment_size or settings.MESSAGE_ARCHIVE_SEGMENT_SIZE
+    segments = archived = 0
+    sources = [
+        (ArchiveSegment.KIND_ROOM, Room.objects.values_list('id', flat=True)),
+        (ArchiveSegment.KIND_DM, DirectThread.objects.values_list('id', flat=True)),
+    ]
+    for kind, ids in sources:
+        for conversation_id in ids.iterator():
+            while max_segments is None or segments < max_segments:
+                count = archive_conversation(kind, conversation_id, cutoff, segment_size)
+                if not count:
+                    break
+                segments += 1
+                archived += count
+            if max_segments is not None and segments >= max_segments:
+                return segments, archived
+    return segments, archived
+
+
+def archived_messages(kind: str, conversation_id: int, after: Optional[int] = None,
+                      before: Optional[int] = None, limit: Optional[int] = None) -> list:
+    """Archived messages with ``after < id < before`` in id order.
+
+    With ``before`` the newest ``limit`` matches are returned, otherwise the
+    oldest ``limit`` (or all of them).
+    """
+    segments = ArchiveSegment.objects.filter(kind=kind, conversation_id=conversation_id)
+    if after is not None:
+        segments = segments.filter(last_id__gt=after)
+    if before is not None:
+        segments = segments.filter(first_id__lt=before).order_by('-first_id')
+    else:
+        segments = segments.order_by('first_id')
+
+    collected: List = []
+    for segment in segments.iterator():
+        rows = [
+            m for m in decode_segment(segment)
+            if (after is None or m.id > after) and (before is None or m.id < before)
+        ]
+        if before is not None:
+            collected[:0] = rows
+        else:
+            collected.extend(rows)
+        if limit is not None and len(collected) >= limit:
+            break
+    if limit is None:
+        return collected
+    return collected[-limit:] if before is not None else collected[:limit]
+
+
+def cursor_param(params, name: str) -> Optional[int]:
+    """Message-id cursor ``name`` (``before``/``after``) from query ``params``; a malformed one is a 400."""
+    value = params.get(name)
+    if not value:
+        return None
+    if not (value.isascii() and value.isdigit()):
+        raise BadRequest(f'{name} must be a message id')
+    return int(value)
+
+
+def _history(kind: str, conversation, hot, after, before, limit, columns=None) -> list:
+    conversation_id = conversation.id
+    archived = archived_messages
+    row_id = attrgetter('id')
+    if columns:
+        # Hot rows as tuples, archived instances flattened to the same shape
+        hot = hot.values_list(*columns)
+        as_row = attrgetter(*columns)
+
+        def archived(*args, **kwargs):
+            return [as_row(m) for m in archived_messages(*args, **kwargs)]
+
+        def row_id(row):
+            return row[0]
+
+    if after is not None:
+        older = []
+        if after < conversation.archived_through:
+            older = archived(kind, conversation_id, after=after, limit=limit)
+        hot_limit = None if limit is None else limit - len(older)
+        if hot_limit == 0:
+            return older
+        rows = hot.filter(id__gt=after).order_by('id')
+        return older + list(rows if hot_limit is None else rows[:hot_limit])
+
+    rows = hot.order_by('-id')
+    if before is not None:
+        rows = rows.filter(id__lt=before)
+    recent = list(rows[:limit])[::-1]
+    if limit is None or len(recent) < limit:
+        high_water = conversation.archived_through
+        if high_water:
+            cursor = row_id(recent[0]) if recent else before
+            if cursor is None:
+                cursor = high_water + 1
+            need = None if limit is None else limit - len(recent)
+            recent = archived(kind, conversation_id, before=cursor, limit=need) + recent
+    return recent
+
+
+def room_history(room: Room, after: Optional[int] = None, before: Optional[int] = None, limit: Optional[int] = 200,
+                 columns: Optional[Sequence[str]] = None) -> list:
+    """Room messages after/before a cursor across hot and archived storage.
+
+    Without ``after`` the newest ``limit`` messages older than ``before`` (or
+    the newest overall) are returned; with ``after`` the page walks forward.
+    ``columns`` (starting with ``id``) switches the result to tuples.
+    """
+    return _history(ArchiveSegment.KIND_ROOM, room, room.messages.all(), after, before, limit, columns)
+
+
+def thread_history(thread: DirectThread, after: Optional[int] = None, before: Optional[int] = None, limit: Optional[int] = 500,
+                   columns: Optional[Sequence[str]] = None) -> list:
+    """Same as ``room_history`` for a direct thread."""
+    if columns:
+        return _history(ArchiveSegment.KIND_DM, thread, thread.messages.all(), after, before, limit, columns)
+    messages = _history(
+        ArchiveSegment.KIND_DM, thread, thread.messages.select_related('author'), after, before, limit,
+    )
+    # Archived rows only carry author_id; load their authors in one query
+    missing = {m.author_id for m in messages if not DirectMessage.author.is_cached(m)}
+    if missing:
+        users = User.objects.select_related('profile').in_bulk(missing)
+        for m in messages:
+            if not DirectMessage.author.is_cached(m):
+                m.author = users.get(m.author_id)
+    return messages
+
+
+async def aroom_history(room: Room, after: Optional[int] = None, before: Optional[int] = None, limit: Optional[int] = 200,
+                        columns: Optional[Sequence[str]] = None) -> list:
+    """Async ``room_history``.
+
+    Forward pages inside the hot range (the polling case) stay on the event
+    loop with native async ORM calls; archive fall-through runs on the
+    bounded DB executor.
+    """
+    if after is not None and after >= room.archived_through:
+        rows = room.messages.filter(id__gt=after).order_by('id')
+        if columns:
+            rows = rows.values_list(*columns)
+        if limit is not None:
+            rows = rows[:limit]
+        return [m async for m in rows]
+    return await db_sync_to_async(room_history)(room, after=after, before=before, limit=limit, columns=columns)
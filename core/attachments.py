@@ -0,0 +1,353 @@
+"""Image attachments: capped streaming uploads, variants off the request, ranged serving.
+
+Upload (``views.upload_attachment``): ``CappedUploadHandler`` writes the
+multipart file to a temporary file chunk by chunk, so it is never held in
+memory, and stops taking it once ``ATTACHMENT_MAX_BYTES`` is passed.  The
+file is then moved under ``MEDIA_ROOT`` and stored as a *processing*
+``Attachment``.
+
+Processing: after commit ``core.imaging.make_variants`` runs in a pool of
+``ATTACHMENT_WORKERS`` processes (in the request when 0), so decoding and
+resizing never hold the event loop or the serving process's GIL; it also
+re-encodes the original without its metadata (EXIF carries the camera and
+often the GPS position), so no served file has any.  ``finish``
+then saves the variants, creates the room message or DM that shows the
+image and broadcasts it to the conversation's group like any other
+message, with an ``attachment`` pointer (see ``pointer``) in the frame.
+
+Serving (``views.attachment_file``): ``ranged_response`` answers a single
+``Range`` with 206 and streams the file from an async iterator; a sync one
+would be read into memory whole under ASGI.
+"""
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+from django.db import close_old_connections, transaction
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import parse_etags
+
+from . import imaging
+from .db_executor import get_executor
+from .directory import record_messages
+from .fragments import set_thread_last_message
+from .models import Attachment, DirectMessage, Message, Room
+from mysite.metrics import chat_messages, group_send_latency
+
+logger = logging.getLogger('core.attachments')
+
+EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/webp': '.webp', 'image/gif': '.gif'}
+CHUNK_SIZE = 256 * 1024
+# Files never change once written, so clients may keep them
+MAX_AGE = 60 * 60 * 24 * 365
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class CappedUploadHandler(TemporaryFileUploadHandler):
+    """Stream uploads to a temporary file; skip a file once it passes ``max_bytes``."""
+
+    def __init__(self, request=None, max_bytes: Optional[int] = None):
+        super().__init__(request)
+        self.max_bytes = max_bytes or settings.ATTACHMENT_MAX_BYTES
+        self.received = 0
+        self.too_large = False
+
+    def new_file(self, *args, **kwargs):
+        self.received = 0
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            # The parser closes (and so deletes) the partial file and drains the rest
+            self.too_large = True
+            raise SkipFile
+        return super().receive_data_chunk(raw_data, start)
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Forking a process that already runs threads is unsafe; spawned
+                # workers only import core.imaging
+                _pool = ProcessPoolExecutor(
+                    max_workers=settings.ATTACHMENT_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+    return _pool
+
+
+def _variant_targets(attachment: Attachment) -> Dict[str, Tuple[int, str]]:
+    stem = os.path.splitext(attachment.file.path)[0]
+    return {name: (bound, f'{stem}.{name}') for name, bound in settings.ATTACHMENT_VARIANTS.items()}
+
+
+def schedule(attachment: Attachment) -> None:
+    """Make the variants of a stored upload; ``finish`` runs when they are done."""
+    args = (attachment.file.path, _variant_targets(attachment), settings.ATTACHMENT_MAX_PIXELS)
+    if settings.ATTACHMENT_WORKERS <= 0:
+        try:
+            result = imaging.make_variants(*args)
+        except Exception as exc:
+            finish(attachment.pk, None, exc)
+        else:
+            finish(attachment.pk, result)
+        return
+    future = get_pool().submit(imaging.make_variants, *args)
+    # The callback runs on the pool's result thread; the ORM work goes to a DB executor thread
+    future.add_done_callback(lambda done: get_executor().submit(_finish_future, attachment.pk, done))
+
+
+def _finish_future(pk: int, future: Future) -> None:
+    close_old_connections()
+    try:
+        error = future.exception()
+        finish(pk, None if error else future.result(), error)
+    except Exception:
+        logger.exception('Finishing attachment %s failed', pk)
+    finally:
+        close_old_connections()
+
+
+def _storage_name(path: str) -> str:
+    return os.path.relpath(path, default_storage.location).replace(os.sep, '/')
+
+
+def finish(pk: int, result: Optional[dict], error: Optional[BaseException] = None) -> Attachment:
+    """Store the outcome of ``make_variants``; on success post the message that shows the image."""
+    attachment = Attachment.objects.select_related('uploader').get(pk=pk)
+    if error is not None:
+        logger.warning('Attachment %s could not be processed: %s', pk, error)
+        attachment.status = Attachment.STATUS_FAILED
+        attachment.save(update_fields=['status'])
+        return attachment
+
+    attachment.content_type = result['content_type']
+    attachment.width, attachment.height = result['width'], result['height']
+    attachment.size = result['size']
+    attachment.variants = {
+        name: {'name': _storage_name(made['path']), 'width': made['width'], 'height': made['height'],
+               'content_type': made['content_type']}
+        for name, made in result['variants'].items()
+    }
+    with transaction.atomic():
+        if attachment.kind == Attachment.KIND_ROOM:
+            message = Message.objects.create(
+                room=Room.objects.get(pk=attachment.conversation_id), author=attachment.uploader,
+                author_name=attachment.author_name, content=attachment.caption,
+            )
+        else:
+            message = DirectMessage.objects.create(
+                thread_id=attachment.conversation_id, author=attachment.uploader, content=attachment.caption,
+            )
+        attachment.status = Attachment.STATUS_READY
+        attachment.message_id = message.id
+        attachment.save(update_fields=[
+            'content_type', 'width', 'height', 'size', 'variants', 'status', 'message_id',
+        ])
+
+    if attachment.kind == Attachment.KIND_ROOM:
+        record_messages([message])
+    else:
+        set_thread_last_message(message)
+    chat_messages.labels(attachment.kind, 'attachment').inc()
+    _broadcast(attachment, message)
+    return attachment
+
+
+def _broadcast(attachment: Attachment, message) -> None:
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    data = {
+        'id': message.id,
+        'author_name': attachment.author_name,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+        'attachment': pointer(attachment),
+    }
+    if attachment.kind == Attachment.KIND_ROOM:
+        group, event_type = f'chat_{message.room.slug}', 'chat_message'
+    else:
+        group, event_type = f'dm_{message.thread_id}', 'dm_message'
+        data['author'] = attachment.uploader.username
+    started = time.perf_counter()
+    async_to_sync(channel_layer.group_send)(group, {'type': event_type, 'data': data})
+    group_send_latency.labels('attachment').observe(time.perf_counter() - started)
+
+
+def discard(kind: str, message_id: int) -> None:
+    """Drop the image of a deleted message; its files go once the deletion commits."""
+    names = []
+    for attachment in Attachment.objects.filter(kind=kind, message_id=message_id):
+        names.append(attachment.file.name)
+        names.extend(variant['name'] for variant in attachment.variants.values())
+        attachment.delete()
+
+    def remove():
+        for name in names:
+            default_storage.delete(name)
+
+    if names:
+        transaction.on_commit(remove)
+
+
+def pointer(attachment: Attachment) -> dict:
+    """The ``attachment`` of message frames and history rows."""
+    return {
+        'id': attachment.pk,
+        'content_type': attachment.content_type,
+        'size': attachment.size,
+        'width': attachment.width,
+        'height': attachment.height,
+        'url': reverse('core:attachment_file', args=[attachment.pk, 'original']),
+        'variants': {
+            name: {
+                'url': reverse('core:attachment_file', args=[attachment.pk, name]),
+                'width': variant['width'],
+                'height': variant['height'],
+            }
+            for name, variant in attachment.variants.items()
+        },
+    }
+
+
+def _ready_for(kind: str, message_ids: list):
+    return Attachment.objects.filter(kind=kind, message_id__in=message_ids, status=Attachment.STATUS_READY)
+
+
+def pointers_for(kind: str, message_ids: Iterable[int]) -> Dict[int, dict]:
+    """``{message_id: pointer}`` for the messages among ``message_ids`` that show an image; one query."""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+    return {attachment.message_id: pointer(attachment) for attachment in _ready_for(kind, message_ids)}
+
+
+def add_pointers(kind: str, rows: list) -> list:
+    """Set ``attachment`` on the history dicts ``rows`` whose message has one."""
+    found = pointers_for(kind, [row['id'] for row in rows])
+    for row in rows:
+        if row['id'] in found:
+            row['attachment'] = found[row['id']]
+    return rows
+
+
+async def aadd_pointers(kind: str, rows: list) -> list:
+    if rows:
+        found = {a.message_id: pointer(a) async for a in _ready_for(kind, [row['id'] for row in rows])}
+        for row in rows:
+            if row['id'] in found:
+                row['attachment'] = found[row['id']]
+    return rows
+
+
+class WithAttachments:
+    """``messages`` with ``.attachment`` set on each, for templates.
+
+    Iterating evaluates the queryset; until then nothing is queried, so a
+    cached fragment that never renders costs nothing.
+    """
+
+    def __init__(self, messages, kind: str):
+        self.messages = messages
+        self.kind = kind
+
+    def __iter__(self):
+        messages = list(self.messages)
+        found = pointers_for(self.kind, [m.id for m in messages])
+        for message in messages:
+            message.attachment = found.get(message.id)
+        return iter(messages)
+
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive ``(start, end)`` of a single ``Range`` header.
+
+    ``None`` means serve the whole file (no, malformed or multi-part ranges,
+    which a server may ignore); an unsatisfiable range raises ``ValueError``.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError(header)
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+async def _read_file(path: str, start: int, length: int):
+    read = sync_to_async(lambda f, n: f.read(n), thread_sensitive=False)
+    handle = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+    try:
+        handle.seek(start)
+        while length > 0:
+            chunk = await read(handle, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        handle.close()
+
+
+def ranged_response(request, path: str, content_type: str, etag: str, private: bool) -> HttpResponse:
+    """Serve the file at ``path`` with ``Range``, ``If-Range`` and ``If-None-Match`` support."""
+    size = os.path.getsize(path)
+    cache_control = f'{"private" if private else "public"}, max-age={MAX_AGE}, immutable'
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = cache_control
+        return response
+
+    start, end, status = 0, size - 1, 200
+    header = request.headers.get('Range')
+    if header and request.headers.get('If-Range', etag) == etag:
+        try:
+            found = byte_range(header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if found is not None:
+            (start, end), status = found, 206
+
+    length = end - start + 1
+    if request.method == 'HEAD':
+        response = HttpResponse(status=status, content_type=content_type)
+    else:
+        response = StreamingHttpResponse(_read_file(path, start, length), status=status, content_type=content_type)
+    response['Content-Length'] = str(length)
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
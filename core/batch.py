@@ -0,0 +1,176 @@
+"""Batch message submission.
+
+``submit_batch`` takes a list of messages for any mix of rooms and DM
+threads, validates each item on its own, inserts all valid ones with one
+``bulk_create`` per table inside a single transaction, then broadcasts them
+to the same channel-layer groups the websocket consumers use.  Items may
+carry a client-chosen ``key``; keys are stored with the messages (in the
+same transaction), so a retried batch gets the original ids back instead
+of duplicates.
+"""
+import time
+from typing import Dict, List, Tuple
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from accounts.services import display_name
+
+from .directory import record_messages
+from .fragments import bump_dm_list, set_thread_last_message
+from .models import DirectMessage, DirectThread, IdempotencyKey, Message, Room
+from .serializers import BatchMessageSerializer
+from mysite.metrics import chat_messages, group_send_latency
+
+STATUS_CREATED = 'created'
+STATUS_DUPLICATE = 'duplicate'
+STATUS_ERROR = 'error'
+
+
+def _resolve_targets(user, items: List[dict]) -> Dict:
+    """Rooms by slug and the user's threads by id / peer id, in three queries."""
+    slugs = {i['room'] for i in items if 'room' in i}
+    thread_ids = {i['thread'] for i in items if 'thread' in i}
+    peer_ids = {i['user'] for i in items if 'user' in i} - {user.id}
+    rooms = {r.slug: r for r in Room.objects.filter(slug__in=slugs)} if slugs else {}
+    threads = {}
+    if thread_ids or peer_ids:
+        mine = DirectThread.objects.filter(Q(user1=user) | Q(user2=user))
+        for thread in mine.filter(Q(id__in=thread_ids) | Q(user1_id__in=peer_ids) | Q(user2_id__in=peer_ids)):
+            threads[('thread', thread.id)] = thread
+            threads[('user', thread.user2_id if thread.user1_id == user.id else thread.user1_id)] = thread
+    peers = set()
+    if peer_ids:
+        peers = set(User.objects.filter(id__in=peer_ids).values_list('id', flat=True))
+    return {'rooms': rooms, 'threads': threads, 'peers': peers}
+
+
+def _broadcast(room_messages, dm_messages, user, author_name: str) -> None:
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    group_send = async_to_sync(channel_layer.group_send)
+    observe = group_send_latency.labels('batch').observe
+
+    def send(group, message):
+        started = time.perf_counter()
+        group_send(group, message)
+        observe(time.perf_counter() - started)
+
+    for message, room in room_messages:
+        send(f'chat_{room.slug}', {'type': 'chat_message', 'data': {
+            'id': message.id,
+            'author_name': message.author_name,
+            'content': message.content,
+            'created_at': message.created_at.isoformat(),
+        }})
+    for message in dm_messages:
+        send(f'dm_{message.thread_id}', {'type': 'dm_message', 'data': {
+            'id': message.id,
+            'author': user.username,
+            'author_name': author_name,
+            'content': message.content,
+            'created_at': message.created_at.isoformat(),
+        }})
+
+
+def _submit(user, items: List[dict]) -> Tuple[List[dict], list, list, list]:
+    results: List[dict] = [{} for _ in items]
+    valid = []
+    for index, raw in enumerate(items):
+        serializer = BatchMessageSerializer(data=raw)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            results[index] = {'key': raw.get('key') if isinstance(raw, dict) else None,
+                              'status': STATUS_ERROR, 'errors': serializer.errors}
+
+    # Keys seen before (earlier requests or earlier in this batch)
+    keys = [item['key'] for _, item in valid if item.get('key')]
+    known = {
+        k.key: k for k in IdempotencyKey.objects.filter(user=user, key__in=keys)
+    } if keys else {}
+    seen = {}
+    targets = _resolve_targets(user, [item for _, item in valid])
+    author_name = display_name(user)
+
+    pending = []  # (index, item, message object, room or None)
+    created_threads = []
+    for index, item in valid:
+        key = item.get('key')
+        if key in known:
+            results[index] = {'key': key, 'status': STATUS_DUPLICATE, 'id': known[key].message_id}
+            continue
+        if key in seen:
+            seen[key].append(index)
+            continue
+        if 'room' in item:
+            room = targets['rooms'].get(item['room'])
+            if room is None:
+                results[index] = {'key': key, 'status': STATUS_ERROR, 'errors': {'room': ['Room not found.']}}
+                continue
+            message = Message(room=room, author=user, author_name=item.get('author_name') or author_name,
+                              content=item['content'])
+            pending.append((index, item, message, room))
+        else:
+            target = ('thread', item['thread']) if 'thread' in item else ('user', item['user'])
+            thread = targets['threads'].get(target)
+            if thread is None and target[0] == 'user' and target[1] in targets['peers']:
+                thread, created = DirectThread.get_or_create_for_users(user.id, target[1])
+                targets['threads'][target] = thread
+                if created:
+                    created_threads.append(thread)
+            if thread is None:
+                results[index] = {'key': key, 'status': STATUS_ERROR, 'errors': {target[0]: ['Conversation not found.']}}
+                continue
+            message = DirectMessage(thread=thread, author=user, content=item['content'])
+            pending.append((index, item, message, None))
+        if key:
+            seen[key] = []
+
+    room_messages = [(p[2], p[3]) for p in pending if p[3] is not None]
+    dm_messages = [p[2] for p in pending if p[3] is None]
+    Message.objects.bulk_create([m for m, _ in room_messages])
+    DirectMessage.objects.bulk_create(dm_messages)
+    IdempotencyKey.objects.bulk_create([
+        IdempotencyKey(
+            user=user, key=item['key'], message_id=message.id,
+            kind=IdempotencyKey.KIND_ROOM if room is not None else IdempotencyKey.KIND_DM,
+        )
+        for _, item, message, room in pending if item.get('key')
+    ])
+
+    for index, item, message, _ in pending:
+        key = item.get('key')
+        results[index] = {'key': key, 'status': STATUS_CREATED, 'id': message.id}
+        for repeat in seen.get(key, []) if key else []:
+            results[repeat] = {'key': key, 'status': STATUS_DUPLICATE, 'id': message.id}
+    return results, room_messages, dm_messages, created_threads
+
+
+def submit_batch(user, items: List[dict]) -> List[dict]:
+    """Create the valid messages of ``items``; returns one result per item, in order."""
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                results, room_messages, dm_messages, created_threads = _submit(user, items)
+            break
+        except IntegrityError:
+            # A concurrent retry stored one of our keys first; the second pass reports it as a duplicate
+            if attempt:
+                raise
+
+    chat_messages.labels('room', 'batch').inc(len(room_messages))
+    chat_messages.labels('dm', 'batch').inc(len(dm_messages))
+    if room_messages:
+        record_messages([m for m, _ in room_messages])
+    for message in dm_messages:
+        set_thread_last_message(message)
+    for thread in created_threads:
+        bump_dm_list(thread.user1_id, thread.user2_id)
+    _broadcast(room_messages, dm_messages, user, display_name(user))
+    return results
+
@@ -0,0 +1,375 @@
+"""Seeded benchmark of the hot pages, API endpoints and ORM paths.
+
+Used by ``manage.py bench``.  ``seed`` bulk-loads a synthetic data set
+(users with profiles, friendships, rooms with a skewed message
+distribution, DM threads); ``run`` times every case of ``build_cases`` twice:
+
+* ``cold``: the cache is cleared before each round, so fragment and version
+  state is rebuilt as on the first hit after a deploy;
+* ``warm``: one untimed round first, then the timed rounds.
+
+Results are plain JSON (median / p95 / min milliseconds plus the query
+count of one round per mode) so two runs can be diffed with ``compare``.
+
+``worker_scaling`` (``manage.py bench_workers``) measures HTTP throughput
+of ``manage.py serve`` at several worker counts instead.
+"""
+import http.client
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+
+from accounts.models import Friendship, Profile
+from mysite import query_profiler
+from .archive import room_history, thread_history
+from .directory import ranked_rooms, rebuild_activity
+from .fast_serializers import DIRECT_MESSAGE_COLUMNS, MESSAGE_COLUMNS
+from .models import DirectMessage, DirectThread, Message, Room
+
+DEFAULT_VOLUMES = {
+    'users': 2000,
+    'friends_per_user': 10,
+    'rooms': 200,
+    'messages': 1_000_000,
+    'threads': 5000,
+    'dm_messages': 200_000,
+}
+
+BATCH_SIZE = 5000
+SEED = 1234
+
+
+def _batched(objects, model, batch_size: int = BATCH_SIZE) -> None:
+    chunk = []
+    for obj in objects:
+        chunk.append(obj)
+        if len(chunk) >= batch_size:
+            model.objects.bulk_create(chunk, batch_size=batch_size)
+            chunk = []
+    if chunk:
+        model.objects.bulk_create(chunk, batch_size=batch_size)
+
+
+def seed(volumes: Dict[str, int], log: Callable[[str], None] = lambda msg: None) -> None:
+    """Bulk-load ``volumes`` rows; deterministic for a given ``volumes``."""
+    rng = random.Random(SEED)
+    n_users = volumes['users']
+    # Every bench user shares one hash: hashing per user would dominate seeding
+    password = make_password('bench')
+
+    log(f'users: {n_users}')
+    _batched((User(username=f'bench{i}', password=password) for i in range(n_users)), User)
+    user_ids = list(User.objects.filter(username__startswith='bench').order_by('id').values_list('id', flat=True))
+    _batched((
+        Profile(user_id=uid, phone=f'+9665{i:08d}', name=f'مستخدم {i}') for i, uid in enumerate(user_ids)
+    ), Profile)
+
+    log(f'friendships: {n_users * volumes["friends_per_user"]}')
+    statuses = [Friendship.STATUS_ACCEPTED] * 8 + [Friendship.STATUS_PENDING] * 2
+    _batched((
+        Friendship(from_user_id=uid, to_user_id=user_ids[(i + step) % n_users], status=rng.choice(statuses))
+        for i, uid in enumerate(user_ids)
+        for step in range(1, min(volumes['friends_per_user'], n_users - 1) + 1)
+    ), Friendship)
+
+    log(f'rooms: {volumes["rooms"]}')
+    _batched((Room(name=f'Bench room {i}', slug=f'bench-room-{i}') for i in range(volumes['rooms'])), Room)
+    room_ids = list(Room.objects.filter(slug__startswith='bench-room-').order_by('id').values_list('id', flat=True))
+
+    # A few busy rooms and a long tail, like a real directory
+    log(f'messages: {volumes["messages"]}')
+    _batched((
+        Message(
+            room_id=room_ids[int(len(room_ids) * rng.random() ** 3)],
+            author_name=f'مستخدم {rng.randrange(n_users)}',
+            content=f'رسالة تجريبية رقم {i} ' * rng.randint(1, 6),
+        )
+        for i in range(volumes['messages'])
+    ), Message)
+    rebuild_activity()
+
+    log(f'threads: {volumes["threads"]}')
+    pairs = set()
+    while len(pairs) < min(volumes['threads'], n_users * (n_users - 1) // 2):
+        a, b = rng.sample(user_ids, 2)
+        pairs.add(DirectThread.ordered_ids(a, b))
+    _batched((DirectThread(user1_id=a, user2_id=b) for a, b in sorted(pairs)), DirectThread)
+    threads = list(DirectThread.objects.values_list('id', 'user1_id', 'user2_id'))
+
+    log(f'dm messages: {volumes["dm_messages"]}')
+    _batched((
+        DirectMessage(thread_id=t[0], author_id=t[rng.randint(1, 2)], content=f'dm {i}')
+        for i, t in ((i, threads[int(len(threads) * rng.random() ** 2)]) for i in range(volumes['dm_messages']))
+    ), DirectMessage)
+
+
+class Case:
+    """One timed path: a GET through the full middleware stack, or a plain callable."""
+
+    def __init__(self, name: str, url: Optional[str] = None, func: Optional[Callable] = None,
+                 login: bool = False):
+        self.name = name
+        self.url = url
+        self.func = func
+        self.login = login
+
+    def __call__(self, client: Client):
+        if self.func is not None:
+            return self.func()
+        response = client.get(self.url)
+        if response.status_code != 200:
+            raise RuntimeError(f'{self.name}: GET {self.url} returned {response.status_code}')
+        if response.streaming:
+            b''.join(response.streaming_content)
+
+
+def build_cases() -> Tuple[List[Case], User]:
+    """The key pages and endpoints, pointed at the busiest room and DM thread.
+
+    Returns the cases and the user the logged-in ones run as.
+    """
+    room = Room.objects.order_by('-activity__rank').first()
+    # A poll that picks up the room's last 20 messages
+    recent = list(Message.objects.filter(room=room).order_by('-id').values_list('id', flat=True)[:21])
+    poll_after = recent[-1] if len(recent) > 20 else 0
+    busiest = DirectMessage.objects.values('thread_id').annotate(n=Count('id')).order_by('-n').first()
+    thread = DirectThread.objects.select_related('user1').get(pk=busiest['thread_id'])
+    other_id = thread.user2_id
+    return [
+        Case('room_list', '/rooms/'),
+        Case('room_detail', f'/r/{room.slug}/'),
+        Case('api_messages', f'/api/r/{room.slug}/messages/'),
+        Case('api_rooms_list', '/api/v1/rooms/'),
+        Case('api_messages_poll', f'/api/v1/rooms/{room.slug}/poll/?after={poll_after}'),
+        Case('users_list', '/accounts/users/', login=True),
+        Case('dm_list', '/dm/', login=True),
+        Case('dm_thread', f'/dm/{other_id}/', login=True),
+        Case('api_dm_messages', f'/api/dm/{other_id}/messages/', login=True),
+        Case('api_direct_threads_list', '/api/v1/direct-threads/', login=True),
+        Case('orm_ranked_rooms', func=lambda: list(ranked_rooms()[:50])),
+        Case('orm_room_history', func=lambda: room_history(room, limit=50, columns=MESSAGE_COLUMNS)),
+        Case('orm_thread_history', func=lambda: thread_history(thread, limit=50, columns=DIRECT_MESSAGE_COLUMNS)),
+    ], thread.user1
+
+
+def _summary(samples: List[float]) -> dict:
+    ordered = sorted(samples)
+    return {
+        'median_ms': round(statistics.median(ordered) * 1000, 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        'min_ms': round(ordered[0] * 1000, 3),
+    }
+
+
+def _time_case(case: Case, client: Client, rounds: int, cold: bool) -> dict:
+    if not cold:
+        case(client)
+    samples = []
+    for _ in range(rounds):
+        if cold:
+            cache.clear()
+        started = time.perf_counter()
+        case(client)
+        samples.append(time.perf_counter() - started)
+    if cold:
+        cache.clear()
+    # Counted through the profiler so queries run on executor threads are included
+    with query_profiler.profile_queries(f'bench {case.name}') as profile:
+        case(client)
+    result = _summary(samples)
+    result['queries'] = profile.count
+    return result
+
+
+def run(rounds: int, only: Optional[List[str]] = None, log: Callable[[str], None] = lambda msg: None) -> dict:
+    query_profiler.enable()
+    cases, user = build_cases()
+    anonymous, logged_in = Client(), Client()
+    logged_in.force_login(user)
+    results = {}
+    for case in cases:
+        if only and case.name not in only:
+            continue
+        client = logged_in if case.login else anonymous
+        results[case.name] = {
+            'cold': _time_case(case, client, rounds, cold=True),
+            'warm': _time_case(case, client, rounds, cold=False),
+        }
+        log(f'{case.name}: cold {results[case.name]["cold"]["median_ms"]} ms, '
+            f'warm {results[case.name]["warm"]["median_ms"]} ms')
+    return {
+        'meta': {
+            'created_at': datetime.now(dt_timezone.utc).isoformat(),
+            'rounds': rounds,
+            'database': connection.vendor,
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'rows': {
+                'users': User.objects.count(),
+                'rooms': Room.objects.count(),
+                'messages': Message.objects.count(),
+                'threads': DirectThread.objects.count(),
+                'dm_messages': DirectMessage.objects.count(),
+            },
+        },
+        'results': results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[dict]:
+    """Median change per case and mode; ``regressed`` when slower by more than ``threshold`` percent."""
+    rows = []
+    for name, modes in current['results'].items():
+        for mode, now in modes.items():
+            before = baseline.get('results', {}).get(name, {}).get(mode)
+            if not before:
+                continue
+            change = (now['median_ms'] - before['median_ms']) / before['median_ms'] * 100 if before['median_ms'] else 0.0
+            rows.append({
+                'case': name,
+                'mode': mode,
+                'baseline_ms': before['median_ms'],
+                'current_ms': now['median_ms'],
+                'change_pct': round(change, 1),
+                'queries': f'{before["queries"]} -> {now["queries"]}',
+                'regressed': change > threshold,
+            })
+    return rows
+
+
+def _hammer(args) -> Tuple[int, int, List[float]]:
+    """One client process: ``connections`` keep-alive connections GETting ``path`` for ``duration`` seconds."""
+    host, port, path, connections, duration = args
+    deadline = time.monotonic() + duration
+    lock = threading.Lock()
+    totals = {'ok': 0, 'errors': 0}
+    latencies: List[float] = []
+
+    def loop():
+        ok = errors = 0
+        samples = []
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=10)
+                continue
+            if response.status == 200:
+                ok += 1
+                if ok % 10 == 0:
+                    samples.append(time.perf_counter() - started)
+            else:
+                errors += 1
+        conn.close()
+        with lock:
+            totals['ok'] += ok
+            totals['errors'] += errors
+            latencies.extend(samples)
+
+    threads = [threading.Thread(target=loop) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return totals['ok'], totals['errors'], latencies
+
+
+def http_throughput(host: str, port: int, path: str, duration: float, connections: int, processes: int) -> dict:
+    """Requests per second over ``connections`` spread across ``processes`` client processes."""
+    per_process = [connections // processes + (1 if i < connections % processes else 0) for i in range(processes)]
+    jobs = [(host, port, path, n, duration) for n in per_process if n]
+    with multiprocessing.get_context('fork').Pool(len(jobs)) as pool:
+        results = pool.map(_hammer, jobs)
+    ok = sum(r[0] for r in results)
+    latencies = sorted(sample for r in results for sample in r[2])
+    return {
+        'requests': ok,
+        'errors': sum(r[1] for r in results),
+        'rps': round(ok / duration, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/healthz')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} not ready after {timeout:.0f} s')
+
+
+def worker_scaling(worker_counts: List[int], path: str, duration: float, connections: int,
+                   client_processes: int, log: Callable[[str], None] = lambda msg: None) -> dict:
+    """Start ``manage.py serve`` with each worker count in turn and measure ``path``."""
+    results = {}
+    for workers in worker_counts:
+        port = _free_port()
+        server = subprocess.Popen(
+            [sys.executable, 'manage.py', 'serve', '--workers', str(workers), '--port', str(port),
+             '--allow-unshared', '--daphne-arg=--access-log=/dev/null'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env={**os.environ, 'RATELIMIT_ENABLED': 'False'},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            _wait_ready(port, timeout=60)
+            # Every worker has to be up, not just the first one to answer
+            time.sleep(2)
+            results[workers] = http_throughput('127.0.0.1', port, path, duration, connections, client_processes)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+        log(f'{workers} workers: {results[workers]["rps"]} req/s, p50 {results[workers]["p50_ms"]} ms, '
+            f'p99 {results[workers]["p99_ms"]} ms, {results[workers]["errors"]} errors')
+    base = results[worker_counts[0]]['rps'] or 1
+    return {
+        'meta': {
+            'created_at': datetime.now(dt_timezone.utc).isoformat(),
+            'cpus': os.cpu_count(),
+            'path': path,
+            'duration': duration,
+            'connections': connections,
+            'client_processes': client_processes,
+        },
+        'results': {
+            str(workers): {**result, 'speedup': round(result['rps'] / base, 2)}
+            for workers, result in results.items()
+        },
+    }
@@ -0,0 +1,169 @@
+"""Message edits and deletions, recorded in an append-only change log.
+
+``edit_message`` and ``delete_message`` change the message row and append a
+``MessageChange`` in one transaction.  Its ``seq`` comes from the
+conversation's ``change_seq``: the UPDATE that moves it forward holds the
+conversation row until commit, so changes commit in seq order and a client
+that has seen seq N can never miss a lower one later.
+
+Clients keep the newest seq they have seen.  The delta endpoints return the
+current ``seq`` with every page and, given ``?since_seq=N``, the changes after
+it (``delta_fields``), read with one range scan of the log's unique index.
+Live changes go to the conversation's group as ``message_change`` events,
+which the consumers forward as ``change`` frames.
+
+Archived messages live in compressed segments and can't be changed.
+"""
+import time
+from typing import Optional, Union
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import F
+
+from . import attachments
+from .archive import cursor_param
+from .fragments import bump_dm_list, bump_room_list
+from .models import DirectMessage, DirectThread, Message, MessageChange, Room
+from mysite.metrics import chat_message_changes, group_send_latency
+
+CHANGE_COLUMNS = ('seq', 'message_id', 'action', 'content', 'created_at')
+# Changes per delta page; clients ask again from the returned seq when more are left
+CHANGES_LIMIT = 500
+
+
+class MessageArchived(Exception):
+    """The message was moved to the archive and can no longer be changed."""
+
+
+def _target(conversation: Union[Room, DirectThread]):
+    """(change kind, message model, fk attname) for a room or thread."""
+    if isinstance(conversation, Room):
+        return MessageChange.KIND_ROOM, Message, 'room_id'
+    return MessageChange.KIND_DM, DirectMessage, 'thread_id'
+
+
+def may_change(user, message) -> bool:
+    """Staff, and the signed-in user who posted the message.
+
+    Room messages posted anonymously (and those from before ``Message.author``)
+    have no author, so only staff may change them; the display name is free
+    text and proves nothing.
+    """
+    if user.is_staff:
+        return True
+    return message.author_id is not None and message.author_id == user.id
+
+
+def _apply(conversation, message_id: int, user, action: str, content: str = '') -> MessageChange:
+    kind, model, fk = _target(conversation)
+    if message_id <= conversation.archived_through:
+        raise MessageArchived(message_id)
+    with transaction.atomic():
+        message = model.objects.select_for_update().get(**{'pk': message_id, fk: conversation.pk})
+        if not may_change(user, message):
+            raise PermissionDenied
+        conversations = type(conversation).objects.filter(pk=conversation.pk)
+        conversations.update(change_seq=F('change_seq') + 1)
+        seq = conversations.values_list('change_seq', flat=True).get()
+        if action == MessageChange.ACTION_EDIT:
+            message.content = content
+            message.save(update_fields=['content'])
+        else:
+            message.delete()
+            attachments.discard(kind, message_id)
+        change = MessageChange.objects.create(
+            kind=kind, conversation_id=conversation.pk, seq=seq, message_id=message_id,
+            action=action, content=content, actor=user,
+        )
+    conversation.change_seq = seq
+    # The room and thread lists show each conversation's last message
+    if kind == MessageChange.KIND_ROOM:
+        bump_room_list()
+    else:
+        bump_dm_list(conversation.user1_id, conversation.user2_id)
+    chat_message_changes.labels(kind, action).inc()
+    _broadcast(conversation, change)
+    return change
+
+
+def edit_message(conversation, message_id: int, user, content: str) -> MessageChange:
+    """Replace the text of a message of ``conversation``.
+
+    Raises ``DoesNotExist`` for an unknown message, ``PermissionDenied`` and
+    ``MessageArchived``.
+    """
+    return _apply(conversation, message_id, user, MessageChange.ACTION_EDIT, content)
+
+
+def delete_message(conversation, message_id: int, user) -> MessageChange:
+    """Delete a message of ``conversation`` (and its image), leaving a tombstone; raises like ``edit_message``."""
+    return _apply(conversation, message_id, user, MessageChange.ACTION_DELETE)
+
+
+def change_row(change: MessageChange) -> dict:
+    return {
+        'seq': change.seq,
+        'message_id': change.message_id,
+        'action': change.action,
+        'content': change.content,
+        'created_at': change.created_at.isoformat(),
+    }
+
+
+def _broadcast(conversation, change: MessageChange) -> None:
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    group = f'chat_{conversation.slug}' if isinstance(conversation, Room) else f'dm_{conversation.pk}'
+    started = time.perf_counter()
+    async_to_sync(channel_layer.group_send)(group, {'type': 'message_change', 'data': change_row(change)})
+    group_send_latency.labels('change').observe(time.perf_counter() - started)
+
+
+def _since(conversation, since: int, limit: int):
+    kind, _, _ = _target(conversation)
+    return MessageChange.objects.filter(
+        kind=kind, conversation_id=conversation.pk, seq__gt=since,
+    ).order_by('seq').values_list(*CHANGE_COLUMNS)[:limit]
+
+
+def _rows(changes) -> list:
+    return [
+        {'seq': seq, 'message_id': message_id, 'action': action, 'content': content,
+         'created_at': created_at.isoformat()}
+        for seq, message_id, action, content, created_at in changes
+    ]
+
+
+def _since_seq(request) -> Optional[int]:
+    return cursor_param(request.GET, 'since_seq')
+
+
+def _fields(conversation, since: Optional[int], rows: list, limit: int) -> dict:
+    if since is None:
+        return {'seq': conversation.change_seq}
+    return {
+        'seq': rows[-1]['seq'] if rows else since,
+        'changes': rows,
+        'changes_more': len(rows) == limit,
+    }
+
+
+def delta_fields(request, conversation, limit: int = CHANGES_LIMIT) -> dict:
+    """``seq`` for a delta page, plus ``changes`` after ``?since_seq=N`` when asked for.
+
+    Load ``conversation`` before reading the page: its ``change_seq`` may then
+    trail the rows, which only makes the client apply a change it already has.
+    """
+    since = _since_seq(request)
+    rows = [] if since is None else _rows(_since(conversation, since, limit))
+    return _fields(conversation, since, rows, limit)
+
+
+async def adelta_fields(request, conversation, limit: int = CHANGES_LIMIT) -> dict:
+    since = _since_seq(request)
+    rows = [] if since is None else _rows([row async for row in _since(conversation, since, limit)])
+    return _fields(conversation, since, rows, limit)
@@ -0,0 +1,101 @@
+"""Conditional GET (ETag / If-None-Match) for poll-heavy JSON endpoints.
+
+Each validator below costs at most one indexed query (the room and thread
+lists only cache reads when warm) and never touches the serialization path, so an unchanged
+resource is answered with ``304 Not Modified`` before the view runs.  A
+validator returns ``None`` when the resource does not exist, so the view
+answers with its 404.  ``conditional_get`` works on sync views,
+async views (which need an async validator) and viewset methods.
+"""
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.db.models import OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from .fragments import dm_list_state, room_list_version
+from .models import DirectMessage, DirectThread, Message, Room
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def _finish(request, response, etag):
+    if etag and response.status_code == 200 and not response.has_header('ETag'):
+        response.headers['ETag'] = etag
+    # Make clients revalidate instead of reusing a stale copy
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_get(etag_func):
+    """Answer 304 when ``etag_func(request, *args, **kwargs)`` matches If-None-Match."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method not in SAFE_METHODS:
+                    return await view(request, *args, **kwargs)
+                etag = await etag_func(request, *args, **kwargs)
+                not_modified = get_conditional_response(request, etag=etag)
+                if not_modified is not None:
+                    return not_modified
+                return _finish(request, await view(request, *args, **kwargs), etag)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Function views get (request, ...); viewset methods (self, request, ...)
+            index = next(i for i, a in enumerate(args) if hasattr(a, 'META'))
+            request = args[index]
+            if request.method not in SAFE_METHODS:
+                return view(*args, **kwargs)
+            etag = etag_func(*args[index:], **kwargs)
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                return not_modified
+            return _finish(request, view(*args, **kwargs), etag)
+        return wrapper
+    return decorator
+
+
+def _newest(model, fk: str):
+    """Newest message id of the outer conversation: one backward step on the (conversation, id) index."""
+    return Subquery(model.objects.filter(**{fk: OuterRef('pk')}).order_by('-id').values('id')[:1])
+
+
+async def room_messages_etag(request, slug=None, room_slug=None):
+    """Newest message id, archive boundary and change seq of the room."""
+    state = await Room.objects.filter(slug=slug or room_slug).annotate(
+        latest=_newest(Message, 'room'),
+    ).values_list('latest', 'archived_through', 'change_seq').afirst()
+    if state is None:
+        return None
+    latest, archived, seq = state
+    return f'W/"room-{latest or 0}-{archived}-{seq}"'
+
+
+def thread_messages_etag(request, user_id):
+    """Newest message id, archive boundary and change seq of the requester's thread with ``user_id``."""
+    if not request.user.is_authenticated:
+        return None
+    u1, u2 = DirectThread.ordered_ids(request.user.id, user_id)
+    state = DirectThread.objects.filter(user1_id=u1, user2_id=u2).annotate(
+        latest=_newest(DirectMessage, 'thread'),
+    ).values_list('latest', 'archived_through', 'change_seq').first()
+    if state is None:
+        return None
+    latest, archived, seq = state
+    return f'W/"dm-{request.user.pk}-{latest or 0}-{archived}-{seq}"'
+
+
+def room_list_etag(request, *args, **kwargs):
+    """The room list's fragment version, bumped by room writes, room messages, edits and archiving."""
+    return f'W/"rooms-{room_list_version()}"'
+
+
+def thread_list_etag(request, *args, **kwargs):
+    """The user's DM list version and newest thread message id, from the cache (see ``core.fragments``)."""
+    user = request.user
+    if not user.is_authenticated:
+        return None
+    return f'W/"threads-{user.pk}-{dm_list_state(user.pk)}"'
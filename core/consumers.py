@@ -1,17 +1,35 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from django.contrib.auth.models import User
+from accounts.models import Profile
 from .models import Room, Message, DirectThread, DirectMessage
+from .ratelimit import ConsumerRateLimitMixin, RateLimiter
+from .directory import arecord_message
+from .fragments import aset_thread_last_message
+from mysite.db_router import apin_user
+from mysite.drain import ConsumerDrainMixin
+from mysite.metrics import ConsumerMetricsMixin, chat_messages
+from mysite.query_profiler import ConsumerQueryProfilerMixin
 
+chat_frame_limiter = RateLimiter('chat_frame', '20/10s')
+dm_frame_limiter = RateLimiter('dm_frame', '20/10s')
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+class ChatConsumer(ConsumerMetricsMixin, ConsumerDrainMixin, ConsumerQueryProfilerMixin, ConsumerRateLimitMixin,
+                   AsyncWebsocketConsumer):
     """WebSocket Consumer for Room-based chat"""
+    frame_limiter = chat_frame_limiter
     
     async def connect(self):
         self.room_slug = self.scope['url_route']['kwargs']['slug']
         self.room_group_name = f'chat_{self.room_slug}'
         
+        # Resolve the room once so each frame costs a single INSERT
+        try:
+            self.room_id = await Room.objects.values_list('id', flat=True).aget(slug=self.room_slug)
+        except Room.DoesNotExist:
+            await self.close()
+            return
+        
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -22,6 +40,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def disconnect(self, close_code):
         # Leave room group
+        if not hasattr(self, 'room_id'):
+            return
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -32,19 +52,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message_type = data.get('type')
         
         if message_type == 'chat_message':
+            if not await self.allow_frame():
+                return
             content = data.get('content', '')
             author_name = data.get('author_name', 'Anonymous')
             
             # Save message to database
-            room = await sync_to_async(Room.objects.get)(slug=self.room_slug)
-            message = await sync_to_async(Message.objects.create)(
-                room=room,
+            user_id = getattr(self.scope.get('user'), 'id', None)
+            message = await Message.objects.acreate(
+                room_id=self.room_id,
+                author_id=user_id,
                 author_name=author_name,
                 content=content
             )
+            await arecord_message(message)
+            await apin_user(user_id)
+            chat_messages.labels('room', 'ws').inc()
             
             # Send message to room group
-            await self.channel_layer.group_send(
+            await self.timed_group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
@@ -60,26 +86,37 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def chat_message(self, event):
         # Send message to WebSocket
         await self.send(text_data=json.dumps(event['data']))
+        self.resume_cursor = event['data']['id']
+    
+    async def message_change(self, event):
+        # Edit or deletion (core.changes)
+        await self.send(text_data=json.dumps({'type': 'change', **event['data']}))
 
 
-class DirectMessageConsumer(AsyncWebsocketConsumer):
+class DirectMessageConsumer(ConsumerMetricsMixin, ConsumerDrainMixin, ConsumerQueryProfilerMixin,
+                            ConsumerRateLimitMixin, AsyncWebsocketConsumer):
     """WebSocket Consumer for Direct Messages (1-on-1)"""
+    frame_limiter = dm_frame_limiter
     
     async def connect(self):
         self.user_id = self.scope['url_route']['kwargs']['user_id']
         self.current_user = self.scope['user']
+        if not self.current_user.is_authenticated:
+            await self.close()
+            return
         
-        # Determine thread ID
-        user = await sync_to_async(User.objects.get)(id=self.user_id)
-        
-        u1, u2 = (self.current_user, user) if self.current_user.id <= user.id else (user, self.current_user)
-        
-        thread = await sync_to_async(DirectThread.objects.get)(
-            user1=u1,
-            user2=u2
-        )
+        # Determine thread ID (the page view creates the thread)
+        try:
+            thread = await DirectThread.aget_for_users(self.current_user.id, self.user_id)
+        except DirectThread.DoesNotExist:
+            await self.close()
+            return
         
         self.thread_id = thread.id
+        profile_name = await Profile.objects.filter(
+            user_id=self.current_user.id
+        ).values_list('name', flat=True).afirst()
+        self.author_name = profile_name or self.current_user.username
         self.group_name = f'dm_{self.thread_id}'
         
         # Join group
@@ -92,6 +129,8 @@ class DirectMessageConsumer(AsyncWebsocketConsumer):
     
     async def disconnect(self, close_code):
         # Leave group
+        if not hasattr(self, 'thread_id'):
+            return
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
@@ -102,25 +141,29 @@ class DirectMessageConsumer(AsyncWebsocketConsumer):
         message_type = data.get('type')
         
         if message_type == 'dm_message':
+            if not await self.allow_frame():
+                return
             content = data.get('content', '')
             
             # Save to database
-            thread = await sync_to_async(DirectThread.objects.get)(id=self.thread_id)
-            message = await sync_to_async(DirectMessage.objects.create)(
-                thread=thread,
-                author=self.current_user,
+            message = await DirectMessage.objects.acreate(
+                thread_id=self.thread_id,
+                author_id=self.current_user.id,
                 content=content
             )
+            await aset_thread_last_message(message)
+            await apin_user(self.current_user.id)
+            chat_messages.labels('dm', 'ws').inc()
             
             # Send to group
-            await self.channel_layer.group_send(
+            await self.timed_group_send(
                 self.group_name,
                 {
                     'type': 'dm_message',
                     'data': {
                         'id': message.id,
                         'author': self.current_user.username,
-                        'author_name': self.current_user.profile.name if hasattr(self.current_user, 'profile') else self.current_user.username,
+                        'author_name': self.author_name,
                         'content': message.content,
                         'created_at': message.created_at.isoformat(),
                     }
@@ -130,4 +173,9 @@ class DirectMessageConsumer(AsyncWebsocketConsumer):
     async def dm_message(self, event):
         # Send message to WebSocket
         await self.send(text_data=json.dumps(event['data']))
+        self.resume_cursor = event['data']['id']
+    
+    async def message_change(self, event):
+        # Edit or deletion (core.changes)
+        await self.send(text_data=json.dumps({'type': 'change', **event['data']}))
 
@@ -0,0 +1,110 @@
+"""Bounded thread pool for ORM work started from async code.
+
+Every thread that touches the ORM holds its own database connection, so
+letting consumers and async views spawn threads freely can open one
+connection per thread.  ``db_sync_to_async`` runs the wrapped function on a
+fixed pool of ``DB_EXECUTOR_WORKERS`` threads instead, closes stale
+connections around each call (returning them to the pool when connection
+pooling is on) and records how long each call queued for a free thread.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+logger = logging.getLogger('core.db')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class ExecutorStats:
+    """Queue-wait and run-time counters for the DB executor."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls = 0
+            self.in_flight = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.run_total = 0.0
+
+    def started(self, wait: float) -> None:
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def finished(self, duration: float) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.run_total += duration
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'workers': settings.DB_EXECUTOR_WORKERS,
+                'calls': self.calls,
+                'in_flight': self.in_flight,
+                'wait_avg_ms': round(self.wait_total / self.calls * 1000, 3) if self.calls else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'run_avg_ms': round(self.run_total / self.calls * 1000, 3) if self.calls else 0.0,
+            }
+
+
+stats = ExecutorStats()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.DB_EXECUTOR_WORKERS,
+                    thread_name_prefix='db',
+                )
+    return _executor
+
+
+def db_sync_to_async(func):
+    """Like ``sync_to_async`` but on the bounded DB executor."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            wait = started - submitted
+            stats.started(wait)
+            if wait > settings.DB_EXECUTOR_WAIT_WARNING:
+                logger.warning('DB executor queue wait %.1f ms for %s', wait * 1000, func.__qualname__)
+            close_old_connections()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                close_old_connections()
+                stats.finished(time.perf_counter() - started)
+
+        return await sync_to_async(run, thread_sensitive=False, executor=get_executor())()
+    return wrapper
+
+
+def pool_stats() -> dict:
+    """psycopg pool counters per database alias (only when pooling is on)."""
+    result = {}
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is not None and hasattr(pool, 'get_stats'):
+            result[alias] = pool.get_stats()
+    return result
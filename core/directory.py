@@ -0,0 +1,136 @@
+"""Activity-ranked room directory.
+
+Each message adds ``exp((t - EPOCH) / tau)`` to its room's score, with
+``tau = half_life / ln 2``.  Every room decays at the same rate, so ordering
+rooms by that sum is the same as ordering by the decayed count "now", and
+the sum never has to be recomputed as time passes.  It is kept in log space
+(``RoomActivity.rank``) and folded in with a log-sum-exp update on each
+write, so the directory is a single indexed ORDER BY.
+"""
+import math
+from datetime import datetime, timezone as dt_timezone
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Abs, Coalesce, Exp, Greatest, Least, Ln
+from django.utils import timezone
+
+from .fragments import abump_room_list, bump_room_list
+from .models import Message, Room, RoomActivity
+
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+# Beyond this gap the smaller term is negligible (and PostgreSQL's exp() underflows)
+MAX_GAP = 50.0
+
+
+def activity_weight(at: datetime) -> float:
+    """Log-space weight of one message sent at ``at``."""
+    half_life = settings.ROOM_ACTIVITY_HALF_LIFE_HOURS * 3600
+    return (at - EPOCH).total_seconds() * math.log(2) / half_life
+
+
+def logsumexp(weights: Iterable[float]) -> float:
+    weights = list(weights)
+    top = max(weights)
+    return top + math.log(sum(math.exp(w - top) for w in weights))
+
+
+def ranked_rooms():
+    """All rooms, most active first; rooms without messages last, newest first."""
+    return Room.objects.select_related('activity').order_by(
+        F('activity__rank').desc(nulls_last=True), '-created_at',
+    )
+
+
+def _fold(weight: float, last_id: int, last_at: datetime) -> dict:
+    """Update kwargs adding ``weight`` to a row's rank (log-sum-exp in SQL)."""
+    w = Value(weight)
+    gap = Least(Abs(F('rank') - w), Value(MAX_GAP))
+    at = Value(last_at)
+    return {
+        'rank': Greatest(F('rank'), w) + Ln(Value(1.0) + Exp(-gap)),
+        'last_message_id': Greatest(F('last_message_id'), Value(last_id)),
+        # GREATEST skips NULLs on PostgreSQL but returns NULL on SQLite
+        'last_message_at': Greatest(Coalesce(F('last_message_at'), at), at),
+        'updated_at': timezone.now(),
+    }
+
+
+def _summaries(messages) -> dict:
+    """{room_id: (weight, last_id, last_at)} for a batch of saved messages."""
+    by_room = {}
+    for m in messages:
+        by_room.setdefault(m.room_id, []).append(m)
+    return {
+        room_id: (
+            logsumexp(activity_weight(m.created_at) for m in batch),
+            max(m.id for m in batch),
+            max(m.created_at for m in batch),
+        )
+        for room_id, batch in by_room.items()
+    }
+
+
+def record_messages(messages: Iterable[Message]) -> None:
+    """Fold newly saved messages into their rooms' activity rank."""
+    for room_id, (weight, last_id, last_at) in _summaries(messages).items():
+        rows = RoomActivity.objects.filter(room_id=room_id)
+        if rows.update(**_fold(weight, last_id, last_at)):
+            continue
+        try:
+            with transaction.atomic():
+                RoomActivity.objects.create(
+                    room_id=room_id, rank=weight, last_message_id=last_id,
+                    last_message_at=last_at, updated_at=timezone.now(),
+                )
+        except IntegrityError:
+            # Another writer created the row first
+            rows.update(**_fold(weight, last_id, last_at))
+    bump_room_list()
+
+
+async def arecord_message(message: Message) -> None:
+    """Async ``record_messages`` for a single message (the websocket path)."""
+    weight = activity_weight(message.created_at)
+    rows = RoomActivity.objects.filter(room_id=message.room_id)
+    if not await rows.aupdate(**_fold(weight, message.id, message.created_at)):
+        try:
+            await RoomActivity.objects.acreate(
+                room_id=message.room_id, rank=weight, last_message_id=message.id,
+                last_message_at=message.created_at, updated_at=timezone.now(),
+            )
+        except IntegrityError:
+            await rows.aupdate(**_fold(weight, message.id, message.created_at))
+    await abump_room_list()
+
+
+def rebuild_activity(batch_size: int = 5000, room_ids: Optional[Iterable[int]] = None) -> int:
+    """Recompute every room's (or ``room_ids``') rank from its hot messages; returns rooms written.
+
+    Archived messages are old enough that their contribution is negligible;
+    rooms with no hot messages left keep their current row.
+    """
+    totals = {}
+    messages = Message.objects.order_by().values_list('room_id', 'id', 'created_at')
+    if room_ids is not None:
+        messages = messages.filter(room_id__in=list(room_ids))
+    for room_id, pk, created_at in messages.iterator(chunk_size=batch_size):
+        weight = activity_weight(created_at)
+        rank, last_id, last_at = totals.get(room_id, (None, 0, None))
+        if rank is not None:
+            top = max(rank, weight)
+            weight = top + math.log1p(math.exp(-abs(rank - weight)))
+        totals[room_id] = (weight, max(last_id, pk), created_at if last_at is None else max(last_at, created_at))
+
+    now = timezone.now()
+    rows = [
+        RoomActivity(room_id=room_id, rank=rank, last_message_id=last_id, last_message_at=last_at, updated_at=now)
+        for room_id, (rank, last_id, last_at) in totals.items()
+    ]
+    RoomActivity.objects.bulk_create(
+        rows, batch_size=batch_size, update_conflicts=True, unique_fields=['room'],
+        update_fields=['rank', 'last_message_id', 'last_message_at', 'updated_at'],
+    )
+    return len(rows)
@@ -0,0 +1,114 @@
+"""Streaming export of a room's or DM thread's whole history.
+
+``export_chunks`` walks the conversation forward with the same reader as
+the history endpoints (``core.archive``): pages of ``EXPORT_PAGE_SIZE``
+messages after the last exported id, decoded from archive segments up to
+``archived_through`` and read from the hot table after it.  Each page is
+one short keyset query rather than a cursor or transaction held open for
+the whole export, so memory stays at one page for any history size and
+rows archived meanwhile are still found.  Pages come out as NDJSON or CSV
+bytes, through an incremental gzip compressor when asked for.
+
+``aexport_chunks`` pulls the pages on the DB executor for async views; a
+sync iterator would be read into memory whole under ASGI.
+"""
+import csv
+import io
+import json
+import zlib
+from typing import Iterator, Optional, Union
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from .archive import room_history, thread_history
+from .db_executor import db_sync_to_async
+from .models import DirectThread, Room
+
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+ROOM_FIELDS = ('id', 'author_name', 'content', 'created_at')
+THREAD_FIELDS = ('id', 'author_id', 'author', 'content', 'created_at')
+# Read from storage; ``author`` (the username) is filled in per row
+THREAD_COLUMNS = ('id', 'author_id', 'content', 'created_at')
+
+
+def filename(conversation: Union[Room, DirectThread], fmt: str, gzip: bool = False) -> str:
+    stem = f'room-{conversation.slug}' if isinstance(conversation, Room) else f'dm-{conversation.pk}'
+    return f'{stem}.{fmt}' + ('.gz' if gzip else '')
+
+
+def _pages(conversation, page_size: int) -> Iterator[list]:
+    """Row dicts of ``conversation`` in id order, one page at a time."""
+    if isinstance(conversation, Room):
+        model, read, columns = Room, room_history, ROOM_FIELDS
+    else:
+        model, read, columns = DirectThread, thread_history, THREAD_COLUMNS
+        usernames = dict(User.objects.filter(
+            id__in=[conversation.user1_id, conversation.user2_id],
+        ).values_list('id', 'username'))
+    after = 0
+    while True:
+        # Archiving may have moved the boundary since the last page
+        conversation.archived_through = model.objects.values_list('archived_through', flat=True).get(
+            pk=conversation.pk,
+        )
+        rows = read(conversation, after=after, limit=page_size, columns=columns)
+        if not rows:
+            return
+        page = [dict(zip(columns, row)) for row in rows]
+        for row in page:
+            row['created_at'] = row['created_at'].isoformat()
+            if model is DirectThread:
+                row['author'] = usernames.get(row['author_id'])
+        yield page
+        after = rows[-1][0]
+
+
+def _ndjson(pages, fields) -> Iterator[bytes]:
+    for page in pages:
+        yield ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in page).encode('utf-8')
+
+
+def _csv(pages, fields) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writeheader()
+    yield drain()
+    for page in pages:
+        writer.writerows(page)
+        yield drain()
+
+
+def _gzip(chunks) -> Iterator[bytes]:
+    # wbits=31: gzip container
+    compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    for data in chunks:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_chunks(conversation: Union[Room, DirectThread], fmt: str = 'ndjson', gzip: bool = False,
+                  page_size: Optional[int] = None) -> Iterator[bytes]:
+    """The whole history of ``conversation`` as ``fmt`` (``ndjson`` or ``csv``), in chunks of one page."""
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f'unknown export format {fmt!r}')
+    fields = ROOM_FIELDS if isinstance(conversation, Room) else THREAD_FIELDS
+    pages = _pages(conversation, page_size or settings.EXPORT_PAGE_SIZE)
+    chunks = (_ndjson if fmt == 'ndjson' else _csv)(pages, fields)
+    return _gzip(chunks) if gzip else chunks
+
+
+async def aexport_chunks(conversation, fmt: str = 'ndjson', gzip: bool = False, page_size: Optional[int] = None):
+    chunks = export_chunks(conversation, fmt, gzip, page_size)
+    next_chunk = db_sync_to_async(lambda: next(chunks, None))
+    while (chunk := await next_chunk()) is not None:
+        yield chunk
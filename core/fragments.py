@@ -0,0 +1,135 @@
+"""Versions behind the ``{% cache %}`` fragments of the chat pages.
+
+Fragment keys include a version that the write paths move forward, so a
+stale fragment is never served and nothing has to be deleted:
+
+* room message lists: ``RoomActivity.last_message_id`` (kept current by
+  ``core.directory``) plus ``Room.archived_through`` and ``change_seq``
+  (moved by edits and deletions, see ``core.changes``);
+* DM message lists: the thread's last message id, cached under
+  ``frag:dm:<thread_id>`` and set on every DM write, plus the thread's
+  ``archived_through`` and ``change_seq``;
+* the rooms sidebar (and the room list's ETag): a counter bumped on room
+  changes, room messages, edits and deletions, and archiving;
+* a user's DM list (and the thread list's ETag): a per-user counter bumped
+  when one of their threads is created or a message in it edited or
+  deleted.  The ETag adds the newest of the threads' cached last message
+  ids, so it also moves on every new DM.
+
+A warm page load therefore renders the message lists without touching the
+message tables.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max, OuterRef, Q, Subquery
+
+from .models import DirectMessage, DirectThread, RoomActivity
+
+ROOM_LIST_KEY = 'frag:rooms'
+THREAD_KEY = 'frag:dm:{}'
+DM_LIST_KEY = 'frag:dmlist:{}'
+# A user's thread ids at a DM list version; a new thread bumps the version
+DM_THREADS_KEY = 'frag:dmthreads:{}:{}'
+
+
+def _version(key: str) -> int:
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, 1, timeout=None)
+        value = cache.get(key, 1)
+    return value
+
+
+def _bump(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+async def _abump(key: str) -> None:
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        await cache.aadd(key, 1, timeout=None)
+
+
+def fragment_context() -> dict:
+    return {'fragment_timeout': settings.FRAGMENT_CACHE_TIMEOUT}
+
+
+def room_list_version() -> int:
+    return _version(ROOM_LIST_KEY)
+
+
+def bump_room_list() -> None:
+    _bump(ROOM_LIST_KEY)
+
+
+async def abump_room_list() -> None:
+    await _abump(ROOM_LIST_KEY)
+
+
+def room_messages_version(room) -> str:
+    """Version of ``room``'s message list; load the room with ``select_related('activity')``."""
+    try:
+        last_id = room.activity.last_message_id
+    except RoomActivity.DoesNotExist:
+        last_id = 0
+    return f'{last_id}.{room.archived_through}.{room.change_seq}'
+
+
+def thread_messages_version(thread) -> str:
+    key = THREAD_KEY.format(thread.pk)
+    last_id = cache.get(key)
+    if last_id is None:
+        # Cold cache: one indexed lookup, then served from the cache
+        last_id = thread.messages.aggregate(m=Max('id'))['m'] or 0
+        cache.add(key, last_id, timeout=None)
+    return f'{last_id}.{thread.archived_through}.{thread.change_seq}'
+
+
+def set_thread_last_message(message) -> None:
+    cache.set(THREAD_KEY.format(message.thread_id), message.id, timeout=None)
+
+
+async def aset_thread_last_message(message) -> None:
+    await cache.aset(THREAD_KEY.format(message.thread_id), message.id, timeout=None)
+
+
+def dm_list_version(user_id: int) -> int:
+    return _version(DM_LIST_KEY.format(user_id))
+
+
+def bump_dm_list(*user_ids: int) -> None:
+    for user_id in user_ids:
+        _bump(DM_LIST_KEY.format(user_id))
+
+
+def dm_list_state(user_id: int) -> str:
+    """DM list version plus the newest last message id of the user's threads.
+
+    Message ids only grow, so the newest one moves with every new DM in any
+    of the threads; edits and deletions bump the version.  Warm, this is
+    two cache reads and a ``get_many``.
+    """
+    version = dm_list_version(user_id)
+    threads_key = DM_THREADS_KEY.format(user_id, version)
+    thread_ids = cache.get(threads_key)
+    if thread_ids is None:
+        # Cold cache: the thread ids and their last message ids in one query
+        newest = DirectMessage.objects.filter(thread=OuterRef('pk')).order_by('-id').values('id')[:1]
+        rows = dict(DirectThread.objects.filter(Q(user1_id=user_id) | Q(user2_id=user_id))
+                    .annotate(last_id=Subquery(newest)).values_list('id', 'last_id'))
+        cache.set(threads_key, list(rows), timeout=settings.FRAGMENT_CACHE_TIMEOUT)
+        for thread_id, last_id in rows.items():
+            cache.add(THREAD_KEY.format(thread_id), last_id or 0, timeout=None)
+        last_ids = [last_id or 0 for last_id in rows.values()]
+    else:
+        keys = [THREAD_KEY.format(thread_id) for thread_id in thread_ids]
+        cached = cache.get_many(keys)
+        last_ids = list(cached.values())
+        missing = [thread_id for key, thread_id in zip(keys, thread_ids) if key not in cached]
+        if missing:
+            last_ids.append(DirectMessage.objects.filter(thread_id__in=missing).aggregate(m=Max('id'))['m'] or 0)
+    return f'{version}.{max(last_ids, default=0)}'
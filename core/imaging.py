@@ -0,0 +1,97 @@
+"""Pillow work for ``core.attachments``, run in worker processes.
+
+Deliberately free of Django imports: the process pool starts its workers
+with ``spawn``, and a worker only needs this module and Pillow.
+"""
+import os
+from typing import Dict, Tuple
+
+from PIL import Image, ImageOps
+
+# Formats accepted as uploads (Pillow format names)
+FORMATS = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp', 'GIF': 'image/gif'}
+JPEG_QUALITY = 82
+# The served original is re-encoded to drop its metadata; close to the upload's quality
+ORIGINAL_QUALITY = 95
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def probe(path: str, max_pixels: int) -> Tuple[str, int, int]:
+    """``(content_type, width, height)`` from the header only; rejects other formats and pixel bombs."""
+    try:
+        with Image.open(path) as image:
+            fmt, (width, height) = image.format, image.size
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise InvalidImage(str(exc))
+    if fmt not in FORMATS:
+        raise InvalidImage(f'unsupported format {fmt}')
+    if width * height > max_pixels:
+        raise InvalidImage(f'{width}x{height} is over {max_pixels} pixels')
+    return FORMATS[fmt], width, height
+
+
+def strip_metadata(path: str) -> Tuple[int, int]:
+    """Re-encode the image at ``path`` in place, in its own format, without EXIF, XMP or comments.
+
+    Stills are rotated per their EXIF orientation first, since the tag goes
+    with the rest; animated GIFs keep every frame.  Returns the new
+    ``(width, height)``.
+    """
+    temp = f'{path}.clean'
+    with Image.open(path) as image:
+        fmt = image.format
+        if fmt == 'GIF':
+            # GIF has no EXIF; its only free-text metadata is the comment extension
+            image.info.pop('comment', None)
+            image.save(temp, 'GIF', save_all=True)
+            size = image.size
+        else:
+            icc_profile = image.info.get('icc_profile')
+            image = ImageOps.exif_transpose(image)
+            # Some encoders fall back to ``info`` (JPEG writes its comment from there)
+            image.info = {}
+            kwargs = {'icc_profile': icc_profile} if icc_profile else {}
+            if fmt == 'JPEG':
+                kwargs.update(quality=ORIGINAL_QUALITY, optimize=True)
+            elif fmt == 'WEBP':
+                kwargs.update(quality=ORIGINAL_QUALITY)
+            image.save(temp, fmt, **kwargs)
+            size = image.size
+    os.replace(temp, path)
+    return size
+
+
+def make_variants(path: str, variants: Dict[str, Tuple[int, str]], max_pixels: int) -> dict:
+    """Write a downscaled copy of the image at ``path`` per ``{name: (bound, dest_stem)}``.
+
+    Each copy fits in ``bound`` x ``bound``, is rotated per its EXIF
+    orientation and re-encoded without metadata: JPEG, or PNG when the
+    image has transparency, at ``dest_stem`` plus the matching extension.
+    The original is then stripped of its metadata too (``strip_metadata``).
+    Returns the original's size in pixels and bytes and
+    ``{name: {path, width, height, content_type}}``.
+    """
+    content_type, _, _ = probe(path, max_pixels)
+    made = {}
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        image.info = {}
+        for name, (bound, stem) in variants.items():
+            copy = image.copy()
+            copy.thumbnail((bound, bound), Image.Resampling.LANCZOS)
+            if has_alpha:
+                dest, fmt, kwargs = f'{stem}.png', 'PNG', {'optimize': True}
+            else:
+                dest, fmt, kwargs = f'{stem}.jpg', 'JPEG', {'quality': JPEG_QUALITY, 'optimize': True,
+                                                            'progressive': True}
+            copy.save(dest, fmt, **kwargs)
+            made[name] = {'path': dest, 'width': copy.width, 'height': copy.height,
+                          'content_type': FORMATS[fmt]}
+    width, height = strip_metadata(path)
+    return {'content_type': content_type, 'width': width, 'height': height, 'size': os.path.getsize(path),
+            'variants': made}
@@ -0,0 +1,285 @@
+"""Bulk import of group chat history exported from WhatsApp or Telegram.
+
+The export is parsed as a stream (``parse_whatsapp`` reads the text
+export line by line, ``parse_telegram`` decodes the ``messages`` array of
+Telegram Desktop's ``result.json`` one object at a time), so memory stays
+at one batch for any file size.  Authors shown as phone numbers (contacts
+the exporter had not saved) are run through ``normalize_phone`` and
+matched to ``Profile`` names with one query per batch.
+
+WhatsApp writes dates in the exporting phone's locale, day or month
+first with nothing in the file saying which.  ``detect_date_order`` reads
+every header before anything is inserted and settles the order from a
+field above 12, so a US export is not stored with days 1-12 swapped.  A
+line that cannot be read raises ``ExportError`` naming it.
+
+``import_messages`` inserts ``IMPORT_BATCH_SIZE`` rows per transaction,
+with ``COPY`` on PostgreSQL and one multi-row ``executemany`` elsewhere.
+Both write ``created_at`` as given, which ``bulk_create`` would replace
+with the import time (the field is ``auto_now_add``).  Each batch also
+advances the ``ChatImport`` checkpoint, so a rerun after an interruption
+skips the messages already committed.  At the end the room's activity
+summary is rebuilt and the room list's fragment version bumped.
+"""
+import hashlib
+import itertools
+import json
+import os
+import re
+from datetime import datetime, timezone as dt_timezone
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from accounts.models import Profile
+from accounts.services import normalize_phone
+
+from .directory import rebuild_activity
+from .fragments import bump_room_list
+from .models import ChatImport, Message
+
+FORMATS = ('whatsapp', 'telegram')
+INSERT_FIELDS = ('room', 'author_name', 'content', 'created_at')
+READ_SIZE = 1 << 16
+
+# "31/12/2020, 21:41 - Name: text" (Android) or "[31/12/2020, 21:41:05] Name: text" (iOS)
+_WHATSAPP_LINE = re.compile(
+    r'^\[?(?P<date>\d{1,4}[./-]\d{1,2}[./-]\d{1,4}),?\s+'
+    r'(?P<time>\d{1,2}[:.]\d{2}(?:[:.]\d{2})?)(?:\s*(?P<ampm>[AaPp])\.?\s?[Mm]\.?)?\]?\s*(?:-\s+)?(?P<rest>.*)$'
+)
+# Directional marks WhatsApp puts around names and numbers
+_MARKS = dict.fromkeys(map(ord, '\u200e\u200f\u202a\u202b\u202c\u202d\u202e\ufeff'))
+_PHONE = re.compile(r'^\+?[\d\s().-]{7,}$')
+
+
+class ExportError(ValueError):
+    """A line or message of the export that cannot be read; the message names it."""
+
+
+class ExportedMessage(NamedTuple):
+    created_at: datetime
+    author: str
+    content: str
+
+
+def fingerprint(path: str) -> str:
+    digest = hashlib.sha256(str(os.path.getsize(path)).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(1 << 20))
+    return digest.hexdigest()
+
+
+def _whatsapp_time(date: str, time: str, ampm: Optional[str], date_order: str) -> datetime:
+    parts = [int(p) for p in re.split(r'[./-]', date)]
+    if parts[0] > 999:
+        year, month, day = parts
+    elif date_order == 'mdy':
+        month, day, year = parts
+    else:
+        day, month, year = parts
+    if year < 100:
+        year += 2000
+    hms = [int(p) for p in re.split(r'[:.]', time)]
+    hour, minute, second = hms[0], hms[1], hms[2] if len(hms) > 2 else 0
+    if ampm:
+        hour = hour % 12 + (12 if ampm.lower() == 'p' else 0)
+    return timezone.make_aware(datetime(year, month, day, hour, minute, second))
+
+
+def _whatsapp_headers(lines: Iterable[str]) -> Iterator[tuple]:
+    """``(line number, text, header match or None)`` for each line of a WhatsApp export."""
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n').translate(_MARKS)
+        yield number, line, _WHATSAPP_LINE.match(line)
+
+
+def detect_date_order(lines: Iterable[str], date_order: str = 'auto') -> str:
+    """The day/month order of a WhatsApp export, checked against every header line.
+
+    ``auto`` picks the one order all dates fit and refuses a file where
+    either would do (no day above 12 anywhere); an explicit ``dmy`` or
+    ``mdy`` is refused if some date cannot be read that way.  Either way a
+    date or time that fits no order is reported here, before the import.
+    """
+    # order -> (line number, date) of the first header it cannot read
+    ruled_out: Dict[str, tuple] = {}
+    day_month = False
+    for number, _, match in _whatsapp_headers(lines):
+        if match is None:
+            continue
+        day_month = day_month or int(re.split(r'[./-]', match['date'])[0]) <= 999
+        for order in ('dmy', 'mdy'):
+            if order not in ruled_out:
+                try:
+                    _whatsapp_time(match['date'], match['time'], match['ampm'], order)
+                except ValueError:
+                    ruled_out[order] = (number, f'{match["date"]} {match["time"]}')
+    orders = ('dmy', 'mdy') if date_order == 'auto' else (date_order,)
+    fits = [order for order in orders if order not in ruled_out]
+    if not fits:
+        raise ExportError('; '.join(f'line {number}: {date} cannot be read as {order}'
+                                    for order, (number, date) in ruled_out.items() if order in orders))
+    if len(fits) > 1 and day_month:
+        raise ExportError('every date fits both day/month and month/day order; pass --date-order')
+    return fits[0]
+
+
+def parse_whatsapp(lines: Iterable[str], date_order: str = 'dmy') -> Iterator[ExportedMessage]:
+    """Messages of a WhatsApp "Export chat" text file; lines without a header continue the previous one.
+
+    System lines ("Messages are end-to-end encrypted", "X added Y") have no
+    author and are skipped.  Times are in the current time zone.
+    """
+    current = None
+    for number, line, match in _whatsapp_headers(lines):
+        if match is None:
+            if current is not None:
+                current = current._replace(content=current.content + '\n' + line)
+            continue
+        if current is not None:
+            yield current
+            current = None
+        author, sep, content = match['rest'].partition(': ')
+        if not sep:
+            continue
+        try:
+            created_at = _whatsapp_time(match['date'], match['time'], match['ampm'], date_order)
+        except ValueError as exc:
+            raise ExportError(f'line {number}: {match["date"]} {match["time"]}: {exc}') from None
+        current = ExportedMessage(created_at, author.strip(), content)
+    if current is not None:
+        yield current
+
+
+def _json_array(stream: TextIO, key: str) -> Iterator[dict]:
+    """Items of the top-level ``key`` array in the JSON document ``stream``, decoded one at a time."""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+    opener = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        data = stream.read(READ_SIZE)
+        eof = not data
+        buffer, pos = buffer[pos:] + data, 0
+        return not eof
+
+    while (match := opener.search(buffer)) is None:
+        if not fill():
+            return
+    pos = match.end()
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            if not fill():
+                return
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as exc:
+            if not fill():
+                raise ExportError(f'{key}: {exc}') from None
+            continue
+        pos = end
+        yield item
+
+
+def _telegram_text(text) -> str:
+    if isinstance(text, str):
+        return text
+    return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+
+
+def parse_telegram(stream: TextIO) -> Iterator[ExportedMessage]:
+    """Messages of a Telegram Desktop chat export (``result.json``); service and media-only entries are skipped."""
+    for item in _json_array(stream, 'messages'):
+        if item.get('type') != 'message':
+            continue
+        content = _telegram_text(item.get('text', ''))
+        if not content:
+            continue
+        try:
+            if 'date_unixtime' in item:
+                created_at = datetime.fromtimestamp(int(item['date_unixtime']), dt_timezone.utc)
+            else:
+                created_at = timezone.make_aware(datetime.fromisoformat(item['date']))
+        except (KeyError, TypeError, ValueError) as exc:
+            raise ExportError(f'message {item.get("id")}: unreadable date ({exc!r})') from None
+        yield ExportedMessage(created_at, item.get('from') or item.get('from_id') or '', content)
+
+
+def read_export(stream: TextIO, fmt: str, date_order: str = 'dmy') -> Iterator[ExportedMessage]:
+    if fmt == 'whatsapp':
+        return parse_whatsapp(stream, date_order)
+    if fmt == 'telegram':
+        return parse_telegram(stream)
+    raise ValueError(f'unknown export format {fmt!r}')
+
+
+class AuthorNames:
+    """Export author -> ``Message.author_name``: the ``Profile`` name for a known phone number, else the name as shown."""
+
+    def __init__(self):
+        self.names: Dict[str, str] = {}
+        self.matched = 0
+
+    def resolve(self, authors: Iterable[str]) -> Dict[str, str]:
+        new = {author for author in authors if author not in self.names}
+        phones = {}
+        for author in new:
+            self.names[author] = author[:Message._meta.get_field('author_name').max_length]
+            if _PHONE.match(author):
+                phones[normalize_phone(author)] = author
+        if phones:
+            for phone, name in Profile.objects.filter(phone__in=list(phones)).values_list('phone', 'name'):
+                self.names[phones[phone]] = name
+                self.matched += 1
+        return self.names
+
+
+def _insert(rows: List[tuple]) -> None:
+    """Insert ``rows`` (values of ``INSERT_FIELDS``) into the message table as they are."""
+    db = router.db_for_write(Message)
+    connection = connections[db]
+    fields = [Message._meta.get_field(name) for name in INSERT_FIELDS]
+    table = connection.ops.quote_name(Message._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            with cursor.cursor.copy(f'COPY {table} ({columns}) FROM STDIN') as copy:
+                for row in rows:
+                    copy.write_row(row)
+            return
+        placeholders = ', '.join(['%s'] * len(fields))
+        cursor.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', [
+            [field.get_db_prep_save(value, connection) for field, value in zip(fields, row)] for row in rows
+        ])
+
+
+def import_messages(job: ChatImport, messages: Iterable[ExportedMessage], batch_size: Optional[int] = None,
+                    progress: Callable[[int], None] = lambda done: None) -> int:
+    """Insert ``messages`` into ``job.room`` after the ones already imported; returns how many were inserted."""
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    db = router.db_for_write(Message)
+    authors = AuthorNames()
+    start = done = job.messages_done
+    remaining = itertools.islice(messages, start, None)
+    while batch := list(itertools.islice(remaining, batch_size)):
+        names = authors.resolve(message.author for message in batch)
+        rows = [(job.room_id, names[m.author], m.content, m.created_at) for m in batch]
+        with transaction.atomic(using=db):
+            _insert(rows)
+            done += len(rows)
+            ChatImport.objects.filter(pk=job.pk).update(messages_done=done, updated_at=timezone.now())
+        progress(done)
+    job.messages_done = done
+    job.finished_at = timezone.now()
+    job.save(update_fields=['messages_done', 'finished_at', 'updated_at'])
+    rebuild_activity(batch_size, room_ids=[job.room_id])
+    bump_room_list()
+    return done - start
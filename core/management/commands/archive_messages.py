@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.archive import archive_older_than
+
+
+class Command(BaseCommand):
+    help = 'Move old room and DM messages into compressed archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--segment-size', type=int, default=settings.MESSAGE_ARCHIVE_SEGMENT_SIZE)
+        parser.add_argument(
+            '--max-segments', type=int, default=None,
+            help='Stop after writing this many segments; rerun to continue',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        segments, messages = archive_older_than(
+            cutoff,
+            segment_size=options['segment_size'],
+            max_segments=options['max_segments'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {messages} messages into {segments} segments (cutoff {cutoff:%Y-%m-%d %H:%M})'
+        ))
@@ -0,0 +1,80 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from core import bench
+
+# Templates reference static files; skip the collectstatic manifest.  The
+# cache is a private LocMem one because cold runs clear it.
+BENCH_SETTINGS = {
+    'STORAGES': {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    },
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench'}},
+    'DATABASE_REPLICAS': [],
+    'RATELIMIT_ENABLED': False,
+}
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway database and time the key pages, endpoints and ORM paths (cold and warm cache)'
+
+    def add_arguments(self, parser):
+        for name, default in bench.DEFAULT_VOLUMES.items():
+            parser.add_argument(f'--{name.replace("_", "-")}', type=int, default=default)
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--only', help='Comma-separated case names')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the bench database and reuse its data on the next run')
+        parser.add_argument('--output', help='Write the JSON results to this file')
+        parser.add_argument('--baseline', help='Compare against results saved with --output')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='Percent slowdown of a median that counts as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        volumes = {name: options[name] for name in bench.DEFAULT_VOLUMES}
+        only = [name.strip() for name in options['only'].split(',')] if options['only'] else None
+        log = self.stdout.write
+
+        setup_test_environment(debug=False)
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if options['keepdb'] and connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # SQLite test databases live in memory unless named
+            test_settings['NAME'] = str(settings.BASE_DIR / 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            with override_settings(**BENCH_SETTINGS):
+                from core.models import Message
+                if options['keepdb'] and Message.objects.exists():
+                    log('Reusing seeded bench database')
+                else:
+                    bench.seed(volumes, log=lambda msg: log(f'Seeding {msg}'))
+                results = bench.run(options['rounds'], only=only, log=log)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+            log(self.style.SUCCESS(f'Results written to {options["output"]}'))
+        else:
+            log(json.dumps(results, indent=2, ensure_ascii=False))
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)
+            rows = bench.compare(baseline, results, options['threshold'])
+            log(f'{"case":<26} {"mode":<5} {"baseline":>10} {"current":>10} {"change":>8}  queries')
+            for row in rows:
+                line = (f'{row["case"]:<26} {row["mode"]:<5} {row["baseline_ms"]:>8.2f}ms {row["current_ms"]:>8.2f}ms '
+                        f'{row["change_pct"]:>+7.1f}%  {row["queries"]}')
+                log(self.style.ERROR(line) if row['regressed'] else line)
+            regressions = [row for row in rows if row['regressed']]
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} regressions over {options["threshold"]}%')
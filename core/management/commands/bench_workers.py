@@ -0,0 +1,49 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import bench
+
+
+class Command(BaseCommand):
+    help = 'Measure HTTP throughput of `manage.py serve` at several worker counts'
+
+    def add_arguments(self, parser):
+        cpus = os.cpu_count() or 1
+        default_counts = sorted({1, max(1, cpus // 2), cpus})
+        parser.add_argument('--workers', default=','.join(map(str, default_counts)),
+                            help='Comma-separated worker counts')
+        parser.add_argument('--path', default='/', help='Page to request')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per worker count')
+        parser.add_argument('--connections', type=int, default=64, help='Concurrent keep-alive connections')
+        parser.add_argument('--client-processes', type=int, default=max(1, cpus // 2),
+                            help='Load generator processes (they share the machine with the workers)')
+        parser.add_argument('--output', help='Write the JSON results to this file')
+
+    def handle(self, *args, **options):
+        try:
+            counts = [int(n) for n in options['workers'].split(',') if n.strip()]
+        except ValueError:
+            raise CommandError('--workers takes comma-separated integers')
+        if not counts or min(counts) < 1:
+            raise CommandError('--workers needs at least one count of 1 or more')
+        try:
+            results = bench.worker_scaling(
+                counts, options['path'], options['duration'], options['connections'],
+                options['client_processes'], log=self.stdout.write,
+            )
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+
+        self.stdout.write(f'{"workers":>8} {"req/s":>10} {"speedup":>8} {"p50 ms":>8} {"p99 ms":>8}')
+        for workers, result in results['results'].items():
+            self.stdout.write(f'{workers:>8} {result["rps"]:>10} {result["speedup"]:>8} '
+                              f'{result["p50_ms"]!s:>8} {result["p99_ms"]!s:>8}')
+        if counts[-1] > results['meta']['cpus']:
+            self.stdout.write(self.style.WARNING(
+                f'Only {results["meta"]["cpus"]} CPUs: worker counts above that cannot scale'))
@@ -0,0 +1,43 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import export
+from core.models import DirectThread, Room
+
+
+class Command(BaseCommand):
+    help = 'Stream the whole history of a room or DM thread to a file as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--room', help='Room slug')
+        target.add_argument('--thread', type=int, help='DM thread id')
+        parser.add_argument('--format', choices=sorted(export.CONTENT_TYPES), default='ndjson')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+        parser.add_argument('--page-size', type=int, default=settings.EXPORT_PAGE_SIZE)
+        parser.add_argument('--output', help='File to write (default: the export file name; "-" for stdout)')
+
+    def handle(self, *args, **options):
+        try:
+            if options['room']:
+                conversation = Room.objects.get(slug=options['room'])
+            else:
+                conversation = DirectThread.objects.get(pk=options['thread'])
+        except (Room.DoesNotExist, DirectThread.DoesNotExist):
+            raise CommandError('No such room or thread')
+
+        path = options['output'] or export.filename(conversation, options['format'], options['gzip'])
+        chunks = export.export_chunks(conversation, options['format'], options['gzip'], options['page_size'])
+        written = 0
+        out = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        if path != '-':
+            self.stdout.write(self.style.SUCCESS(f'Wrote {written} bytes to {path}'))
@@ -0,0 +1,68 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import importer
+from core.models import ChatImport, Room
+
+
+class Command(BaseCommand):
+    help = 'Import a WhatsApp or Telegram chat export into a room; rerun the same command to resume'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='WhatsApp "Export chat" .txt file or Telegram result.json')
+        parser.add_argument('--room', required=True, help='Slug of the room to import into (created if missing)')
+        parser.add_argument('--name', help='Name for a new room (default: the slug)')
+        parser.add_argument('--format', choices=importer.FORMATS,
+                            help='Export format (default: telegram for .json files, else whatsapp)')
+        parser.add_argument('--date-order', choices=('auto', 'dmy', 'mdy'), default='auto',
+                            help='Day/month order of WhatsApp dates (default: worked out from the file)')
+        parser.add_argument('--batch-size', type=int, default=settings.IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError(f'No such file: {path}')
+        fmt = options['format'] or ('telegram' if path.endswith('.json') else 'whatsapp')
+        date_order = options['date_order']
+        if fmt == 'whatsapp':
+            # Settled before anything is inserted: a rerun resumes by count and cannot fix stored dates
+            with open(path, encoding='utf-8-sig') as stream:
+                try:
+                    date_order = importer.detect_date_order(stream, date_order)
+                except importer.ExportError as exc:
+                    raise CommandError(f'{path}: {exc}') from None
+        room, _ = Room.objects.get_or_create(slug=options['room'], defaults={'name': options['name'] or options['room']})
+        job = ChatImport.objects.filter(room=room, fingerprint=importer.fingerprint(path)).first()
+        if job is not None and job.finished_at is not None:
+            self.stdout.write(f'{path} was already imported into {room.slug} ({job.messages_done} messages)')
+            return
+        if job is None:
+            # Imported history gets newer ids than what is already there, which would sort it last
+            if room.messages.exists():
+                raise CommandError(f'Room {room.slug} already has messages; import into a new room')
+            job = ChatImport.objects.create(room=room, source=os.path.basename(path)[:255],
+                                            fingerprint=importer.fingerprint(path))
+        elif job.messages_done:
+            self.stdout.write(f'Resuming after {job.messages_done} messages')
+
+        started = time.monotonic()
+
+        def progress(done: int) -> None:
+            rate = (done - resumed_at) / max(time.monotonic() - started, 1e-6)
+            self.stdout.write(f'{done} messages ({rate:.0f}/s)')
+
+        resumed_at = job.messages_done
+        with open(path, encoding='utf-8-sig') as stream:
+            try:
+                imported = importer.import_messages(
+                    job, importer.read_export(stream, fmt, date_order),
+                    batch_size=options['batch_size'], progress=progress,
+                )
+            except importer.ExportError as exc:
+                raise CommandError(f'{path}: {exc}') from None
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} messages into {room.slug} in {time.monotonic() - started:.1f} s'
+        ))
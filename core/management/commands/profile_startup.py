@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mysite import startup
+
+
+class Command(BaseCommand):
+    help = 'Show the slowest imports of a worker boot and, optionally, time the warm-up phases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', default='mysite.asgi', help='Module the worker imports at boot')
+        parser.add_argument('--top', type=int, default=25)
+        parser.add_argument('--sort', choices=['cumulative', 'self'], default='cumulative')
+        parser.add_argument('--warm-up', action='store_true', help='Also run the warm-up against this database')
+
+    def handle(self, *args, **options):
+        try:
+            rows = startup.profile_imports(options['module'])
+        except RuntimeError as exc:
+            raise CommandError(f'Importing {options["module"]} failed: {exc}')
+        total = sum(cumulative for _, depth, _, cumulative in rows if depth == 0)
+        self.stdout.write(f'{len(rows)} modules imported in {total / 1000:.0f} ms')
+        key = 3 if options['sort'] == 'cumulative' else 2
+        self.stdout.write(f'{"cumulative ms":>14} {"self ms":>9}  module')
+        for name, _, self_us, cumulative_us in sorted(rows, key=lambda row: row[key], reverse=True)[:options['top']]:
+            self.stdout.write(f'{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}')
+
+        if options['warm_up']:
+            self.stdout.write('')
+            for name, ms in startup.warm_up().items():
+                self.stdout.write(f'{name:>10}: {ms:.1f} ms')
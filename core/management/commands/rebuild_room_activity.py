@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.directory import rebuild_activity
+
+
+class Command(BaseCommand):
+    help = 'Recompute the activity rank of every room from its messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        rooms = rebuild_activity(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt activity rank for {rooms} rooms'))
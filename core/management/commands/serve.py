@@ -0,0 +1,50 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mysite.workers import Supervisor, shared_state_problems
+
+
+class Command(BaseCommand):
+    help = 'Run WEB_WORKERS supervised daphne workers on one address (see mysite.workers)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.WEB_WORKERS)
+        parser.add_argument('--bind', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--application', default='mysite.asgi:application')
+        parser.add_argument('--no-reuse-port', action='store_true',
+                            help='One socket accepted on by all workers instead of one per worker')
+        parser.add_argument('--proxy-headers', action='store_true', help='Passed on to daphne')
+        parser.add_argument('--daphne-arg', action='append', default=[], help='Extra daphne argument (repeatable)')
+        parser.add_argument('--allow-unshared', action='store_true',
+                            help='Start several workers even with the in-memory channel layer (benchmarks)')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+        if workers > 1:
+            problems = shared_state_problems()
+            if problems and 'channel layer' in problems[0] and not options['allow_unshared']:
+                raise CommandError(f'Cannot run {workers} workers: {problems[0]}')
+            for problem in problems:
+                self.stderr.write(self.style.WARNING(f'Warning: {problem}'))
+
+        logger = logging.getLogger('mysite.workers')
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s [supervisor] %(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+
+        daphne_args = (['--proxy-headers'] if options['proxy_headers'] else []) + options['daphne_arg']
+        try:
+            supervisor = Supervisor(
+                options['application'], options['bind'], options['port'], workers,
+                reuse_port=False if options['no_reuse_port'] else None, daphne_args=daphne_args,
+            )
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'Cannot listen on {options["bind"]}:{options["port"]}: {exc}')
+        supervisor.run()
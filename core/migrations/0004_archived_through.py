@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:05
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_archived_through(apps, schema_editor):
+    ArchiveSegment = apps.get_model('core', 'ArchiveSegment')
+    models_by_kind = {'room': apps.get_model('core', 'Room'), 'dm': apps.get_model('core', 'DirectThread')}
+    rows = ArchiveSegment.objects.values('kind', 'conversation_id').annotate(last=Max('last_id'))
+    for row in rows:
+        models_by_kind[row['kind']].objects.filter(pk=row['conversation_id']).update(archived_through=row['last'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_archivesegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='directthread',
+            name='archived_through',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='archived_through',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_archived_through, migrations.RunPython.noop),
+    ]
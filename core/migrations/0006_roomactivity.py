@@ -0,0 +1,52 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:13
+
+import math
+from datetime import datetime, timezone as dt_timezone
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+from django.utils import timezone
+
+
+def activity_weight(at):
+    # Copy of core.directory.activity_weight as of this migration
+    half_life = settings.ROOM_ACTIVITY_HALF_LIFE_HOURS * 3600
+    return (at - datetime(2024, 1, 1, tzinfo=dt_timezone.utc)).total_seconds() * math.log(2) / half_life
+
+
+def seed_room_activity(apps, schema_editor):
+    # Rank each room by its latest message; `rebuild_room_activity` computes the full rank
+    Message = apps.get_model('core', 'Message')
+    RoomActivity = apps.get_model('core', 'RoomActivity')
+    now = timezone.now()
+    latest = Message.objects.order_by().values('room_id').annotate(last_id=Max('id'), last_at=Max('created_at'))
+    RoomActivity.objects.bulk_create([
+        RoomActivity(
+            room_id=row['room_id'], rank=activity_weight(row['last_at']),
+            last_message_id=row['last_id'], last_message_at=row['last_at'], updated_at=now,
+        )
+        for row in latest
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_message_conversation_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomActivity',
+            fields=[
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='activity', serialize=False, to='core.room')),
+                ('rank', models.FloatField(db_index=True)),
+                ('last_message_id', models.BigIntegerField(default=0)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(seed_room_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:07
+
+from django.db import migrations, models
+
+from mysite.migration_operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('core', '0009_message_changes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['author_name', 'id'], name='core_message_author_id_idx'),
+        ),
+    ]
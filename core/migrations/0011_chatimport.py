@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_message_author_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('messages_done', models.BigIntegerField(default=0)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='imports', to='core.room')),
+            ],
+            options={
+                'unique_together': {('room', 'fingerprint')},
+            },
+        ),
+    ]
@@ -7,6 +7,10 @@ class Room(models.Model):
     name = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(max_length=120, unique=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Highest message id moved to ArchiveSegment (0 = nothing archived)
+    archived_through = models.BigIntegerField(default=0, editable=False)
+    # Seq of the newest MessageChange in this conversation (0 = none)
+    change_seq = models.BigIntegerField(default=0, editable=False)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -26,14 +30,39 @@ class Room(models.Model):
         return self.name
 
 
+class RoomActivity(models.Model):
+    """Summary row ranking a room by recent activity (see ``core.directory``).
+
+    ``rank`` is the log of the room's exponentially decayed message count,
+    measured against a fixed epoch, so ordering by it gives the current
+    decayed ranking without recomputing anything as time passes.
+    """
+    room = models.OneToOneField(Room, primary_key=True, related_name='activity', on_delete=models.CASCADE)
+    rank = models.FloatField(db_index=True)
+    last_message_id = models.BigIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField()
+
+    def __str__(self) -> str:
+        return f"{self.room_id}: {self.rank:.3f}"
+
+
 class Message(models.Model):
     room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE)
     author_name = models.CharField(max_length=50)
+    # Who posted it, when signed in; ``author_name`` is only what was shown.  Only
+    # read through the message itself (``core.changes.may_change``), so no index
+    author = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='+',
+                               db_index=False)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['id']
+        indexes = [
+            models.Index(fields=['room', 'id'], name='core_message_room_id_idx'),
+            models.Index(fields=['author_name', 'id'], name='core_message_author_id_idx'),
+        ]
 
     def __str__(self) -> str:
         return f"{self.author_name}: {self.content[:30]}"
@@ -43,10 +72,28 @@ class DirectThread(models.Model):
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='dm_threads_as_user1')
     user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='dm_threads_as_user2')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Highest message id moved to ArchiveSegment (0 = nothing archived)
+    archived_through = models.BigIntegerField(default=0, editable=False)
+    # Seq of the newest MessageChange in this conversation (0 = none)
+    change_seq = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         unique_together = (('user1', 'user2'),)
 
+    @staticmethod
+    def ordered_ids(user_a_id: int, user_b_id: int) -> tuple:
+        return (user_a_id, user_b_id) if user_a_id <= user_b_id else (user_b_id, user_a_id)
+
+    @classmethod
+    def get_or_create_for_users(cls, user_a_id: int, user_b_id: int):
+        u1, u2 = cls.ordered_ids(user_a_id, user_b_id)
+        return cls.objects.get_or_create(user1_id=u1, user2_id=u2)
+
+    @classmethod
+    async def aget_for_users(cls, user_a_id: int, user_b_id: int) -> 'DirectThread':
+        u1, u2 = cls.ordered_ids(user_a_id, user_b_id)
+        return await cls.objects.aget(user1_id=u1, user2_id=u2)
+
     def save(self, *args, **kwargs):
         # ensure (user1.id <= user2.id) to keep uniqueness independent of order
         if self.user1_id and self.user2_id and self.user1_id > self.user2_id:
@@ -65,6 +112,161 @@ class DirectMessage(models.Model):
 
     class Meta:
         ordering = ['id']
+        indexes = [
+            models.Index(fields=['thread', 'id'], name='core_dm_thread_id_idx'),
+        ]
 
     def __str__(self) -> str:
         return f"DM {self.author_id}: {self.content[:30]}"
+
+
+class IdempotencyKey(models.Model):
+    """Client-supplied key of a batch-submitted message (see ``core.batch``).
+
+    A retried batch finds its keys here and gets the original message ids
+    back instead of creating the messages again.
+    """
+    KIND_ROOM = 'room'
+    KIND_DM = 'dm'
+    KIND_CHOICES = [(KIND_ROOM, 'Room'), (KIND_DM, 'Direct thread')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=64)
+    kind = models.CharField(max_length=4, choices=KIND_CHOICES)
+    message_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = (('user', 'key'),)
+
+    def __str__(self) -> str:
+        return f"{self.user_id}:{self.key} -> {self.kind} {self.message_id}"
+
+
+class ArchiveSegment(models.Model):
+    """Compressed block of archived messages from one room or DM thread.
+
+    ``payload`` is zlib-compressed JSON of ``[id, author, content, created_at]``
+    rows where ``author`` is the author name for rooms and the user id for DMs.
+    """
+    KIND_ROOM = 'room'
+    KIND_DM = 'dm'
+    KIND_CHOICES = [(KIND_ROOM, 'Room'), (KIND_DM, 'Direct thread')]
+
+    kind = models.CharField(max_length=4, choices=KIND_CHOICES)
+    conversation_id = models.BigIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    payload = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['first_id']
+        unique_together = (('kind', 'conversation_id', 'first_id'),)
+        indexes = [
+            models.Index(fields=['kind', 'conversation_id', 'last_id'], name='core_archive_last_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.conversation_id} [{self.first_id}-{self.last_id}]"
+
+
+class Attachment(models.Model):
+    """Image sent to a room or DM thread (see ``core.attachments``).
+
+    The upload is stored first; the message that shows it (``message_id``,
+    in the table picked by ``kind``) is only created once the downscaled
+    ``variants`` exist, so history and live frames never point at an image
+    that is still being processed.
+    """
+    KIND_ROOM = 'room'
+    KIND_DM = 'dm'
+    KIND_CHOICES = [(KIND_ROOM, 'Room'), (KIND_DM, 'Direct thread')]
+
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [(STATUS_PROCESSING, 'Processing'), (STATUS_READY, 'Ready'), (STATUS_FAILED, 'Failed')]
+
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='attachments')
+    kind = models.CharField(max_length=4, choices=KIND_CHOICES)
+    conversation_id = models.BigIntegerField()
+    author_name = models.CharField(max_length=50, blank=True)
+    caption = models.TextField(blank=True)
+    file = models.FileField(upload_to='attachments/%Y/%m/')
+    content_type = models.CharField(max_length=50, blank=True)
+    size = models.PositiveBigIntegerField(default=0)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    # {name: {"name": storage name, "width", "height", "content_type"}}
+    variants = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PROCESSING)
+    message_id = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'message_id'], name='core_attachment_message_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.conversation_id}: {self.file.name} ({self.status})"
+
+
+class MessageChange(models.Model):
+    """Edit or deletion of a room message or DM (see ``core.changes``).
+
+    Append-only.  ``seq`` counts the changes of one conversation (the
+    conversation's ``change_seq`` is the newest), so "everything since seq N"
+    is one range scan of the unique index.  Edits carry the new ``content``;
+    a deletion is a tombstone for a message row that no longer exists.
+    """
+    KIND_ROOM = 'room'
+    KIND_DM = 'dm'
+    KIND_CHOICES = [(KIND_ROOM, 'Room'), (KIND_DM, 'Direct thread')]
+
+    ACTION_EDIT = 'edit'
+    ACTION_DELETE = 'delete'
+    ACTION_CHOICES = [(ACTION_EDIT, 'Edit'), (ACTION_DELETE, 'Delete')]
+
+    kind = models.CharField(max_length=4, choices=KIND_CHOICES)
+    conversation_id = models.BigIntegerField()
+    seq = models.BigIntegerField()
+    message_id = models.BigIntegerField()
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+    content = models.TextField(blank=True)
+    actor = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['seq']
+        unique_together = (('kind', 'conversation_id', 'seq'),)
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.conversation_id} #{self.seq}: {self.action} {self.message_id}"
+
+
+class ChatImport(models.Model):
+    """Progress of importing one export file into a room (see ``core.importer``).
+
+    ``messages_done`` is advanced in the same transaction as each inserted
+    batch, so an interrupted import resumes right after the last batch that
+    was committed.
+    """
+    room = models.ForeignKey(Room, related_name='imports', on_delete=models.CASCADE)
+    source = models.CharField(max_length=255)
+    # sha256 of the file's size and first megabyte
+    fingerprint = models.CharField(max_length=64)
+    messages_done = models.BigIntegerField(default=0)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('room', 'fingerprint'),)
+
+    def __str__(self) -> str:
+        return f"{self.source} -> {self.room_id}: {self.messages_done}{' (done)' if self.finished_at else ''}"
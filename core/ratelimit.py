@@ -0,0 +1,286 @@
+"""Sliding-window rate limiting shared by views, viewsets and consumers.
+
+Rates are written as ``'<count>/<period>'`` where the period is ``s``, ``m``,
+``h`` or ``d`` with an optional multiplier (``'20/10s'``).  The sliding window
+is approximated from two fixed-window counters, so a check costs a couple of
+dict operations (``MemoryBackend``) or one pipelined round trip
+(``RedisBackend``).  Once a client is rejected it is remembered in-process
+until its retry time, so repeated floods never reach the backend at all.
+
+Per-scope rates can be overridden with ``settings.RATELIMIT_RATES`` and the
+whole engine switched off with ``settings.RATELIMIT_ENABLED = False``.
+"""
+import json
+import math
+import threading
+import time
+from functools import lru_cache, wraps
+from typing import Callable, Optional, Tuple
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.module_loading import import_string
+
+_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate: str) -> Tuple[int, int]:
+    """``'20/10s'`` -> ``(20, 10)``: request limit and window in seconds."""
+    count, period = rate.split('/')
+    unit = period[-1]
+    multiplier = int(period[:-1]) if period[:-1] else 1
+    return int(count), multiplier * _PERIODS[unit]
+
+
+def _retry_after(prev: int, curr: int, elapsed: float, limit: int, window: int) -> float:
+    """Seconds until one more hit on top of ``curr`` fits under ``limit``."""
+    if curr >= limit or not prev:
+        return window - elapsed
+    needed = window * (1 - (limit - curr - 1) / prev) - elapsed
+    return max(needed, 0.001)
+
+
+class MemoryBackend:
+    """Per-process counters; fine for a single worker and for tests."""
+
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def hit(self, key: str, limit: int, window: int) -> Tuple[bool, float]:
+        now = time.time()
+        index, elapsed = divmod(now, window)
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None or entry[0] < index - 1:
+                entry = [index, 0, 0]
+            elif entry[0] == index - 1:
+                entry = [index, entry[2], 0]
+            prev, curr = entry[1], entry[2]
+            if prev * (1 - elapsed / window) + curr + 1 > limit:
+                self._windows[key] = entry
+                return False, _retry_after(prev, curr, elapsed, limit, window)
+            entry[2] += 1
+            self._windows[key] = entry
+            if len(self._windows) > self.MAX_KEYS:
+                self._prune(index)
+        return True, 0.0
+
+    async def ahit(self, key: str, limit: int, window: int) -> Tuple[bool, float]:
+        return self.hit(key, limit, window)
+
+    def _prune(self, index: float) -> None:
+        for k in [k for k, v in self._windows.items() if v[0] < index - 1]:
+            del self._windows[k]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._windows.clear()
+
+
+class RedisBackend:
+    """Counters in Redis so every worker shares the same budget."""
+
+    KEY_PREFIX = 'rl'
+
+    def __init__(self, url: Optional[str] = None):
+        self.url = url or getattr(settings, 'RATELIMIT_REDIS_URL', None)
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import redis.asyncio
+            self._async_client = redis.asyncio.Redis.from_url(self.url)
+        return self._async_client
+
+    def _keys(self, key: str, window: int, now: float):
+        index, elapsed = divmod(now, window)
+        curr_key = f"{self.KEY_PREFIX}:{key}:{window}:{int(index)}"
+        prev_key = f"{self.KEY_PREFIX}:{key}:{window}:{int(index) - 1}"
+        return curr_key, prev_key, elapsed
+
+    def _decide(self, prev, curr, elapsed, limit, window) -> Tuple[bool, float]:
+        prev = int(prev or 0)
+        if prev * (1 - elapsed / window) + curr > limit:
+            return False, _retry_after(prev, curr - 1, elapsed, limit, window)
+        return True, 0.0
+
+    def hit(self, key: str, limit: int, window: int) -> Tuple[bool, float]:
+        curr_key, prev_key, elapsed = self._keys(key, window, time.time())
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(curr_key)
+        pipe.expire(curr_key, window * 2)
+        pipe.get(prev_key)
+        curr, _, prev = pipe.execute()
+        return self._decide(prev, curr, elapsed, limit, window)
+
+    async def ahit(self, key: str, limit: int, window: int) -> Tuple[bool, float]:
+        curr_key, prev_key, elapsed = self._keys(key, window, time.time())
+        pipe = self.async_client.pipeline(transaction=False)
+        pipe.incr(curr_key)
+        pipe.expire(curr_key, window * 2)
+        pipe.get(prev_key)
+        curr, _, prev = await pipe.execute()
+        return self._decide(prev, curr, elapsed, limit, window)
+
+
+_backend = None
+
+
+def get_backend():
+    """Return the configured backend (``settings.RATELIMIT_BACKEND``), built once."""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'RATELIMIT_BACKEND', 'core.ratelimit.MemoryBackend')
+        _backend = import_string(path)()
+    return _backend
+
+
+class RateLimiter:
+    """A named limit (``scope``) applied per client identity."""
+
+    def __init__(self, scope: str, rate: str):
+        self.scope = scope
+        self.default_rate = rate
+        self._blocked = {}
+
+    @property
+    def rate(self) -> Tuple[int, int]:
+        rates = getattr(settings, 'RATELIMIT_RATES', {})
+        return parse_rate(rates.get(self.scope, self.default_rate))
+
+    def _short_circuit(self, key: str, now: float) -> Optional[float]:
+        until = self._blocked.get(key)
+        if until is None:
+            return None
+        if until > now:
+            return until - now
+        self._blocked.pop(key, None)
+        return None
+
+    def _record(self, key: str, allowed: bool, retry_after: float, now: float) -> None:
+        if not allowed:
+            if len(self._blocked) > MemoryBackend.MAX_KEYS:
+                self._blocked.clear()
+            self._blocked[key] = now + retry_after
+
+    def check(self, ident: str) -> Tuple[bool, float]:
+        """Count one hit for ``ident``; returns ``(allowed, retry_after)``."""
+        if not getattr(settings, 'RATELIMIT_ENABLED', True):
+            return True, 0.0
+        key = f"{self.scope}:{ident}"
+        now = time.time()
+        blocked = self._short_circuit(key, now)
+        if blocked is not None:
+            return False, blocked
+        limit, window = self.rate
+        allowed, retry_after = get_backend().hit(key, limit, window)
+        self._record(key, allowed, retry_after, now)
+        return allowed, retry_after
+
+    async def acheck(self, ident: str) -> Tuple[bool, float]:
+        """Async variant of ``check`` for consumers."""
+        if not getattr(settings, 'RATELIMIT_ENABLED', True):
+            return True, 0.0
+        key = f"{self.scope}:{ident}"
+        now = time.time()
+        blocked = self._short_circuit(key, now)
+        if blocked is not None:
+            return False, blocked
+        limit, window = self.rate
+        allowed, retry_after = await get_backend().ahit(key, limit, window)
+        self._record(key, allowed, retry_after, now)
+        return allowed, retry_after
+
+
+def client_ip(request) -> str:
+    """The client's address as seen by the outermost of ``RATELIMIT_TRUSTED_PROXIES`` proxies.
+
+    Each proxy appends the address it received the request from to
+    ``X-Forwarded-For``, so only the last ``RATELIMIT_TRUSTED_PROXIES``
+    entries can be believed; anything left of them came from the client.
+    """
+    proxies = settings.RATELIMIT_TRUSTED_PROXIES
+    if proxies:
+        hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+        if len(hops) >= proxies:
+            return hops[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def user_or_ip(request) -> str:
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f"u{user.pk}"
+    return client_ip(request)
+
+
+def rate_limited_response(retry_after: float) -> JsonResponse:
+    seconds = max(1, math.ceil(retry_after))
+    response = JsonResponse({'error': 'rate_limited', 'retry_after': seconds}, status=429)
+    response['Retry-After'] = str(seconds)
+    return response
+
+
+def ratelimit(scope: str, rate: str, key: Callable = client_ip, methods=None):
+    """Limit a function view or a viewset method to ``rate`` per ``key(request)``.
+
+    Rejected calls get a 429 with ``Retry-After``; the view itself never runs.
+    """
+    limiter = RateLimiter(scope, rate)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            request = next(a for a in args if hasattr(a, 'META'))
+            if methods is None or request.method in methods:
+                ident = key(request)
+                if ident:
+                    allowed, retry_after = limiter.check(ident)
+                    if not allowed:
+                        return rate_limited_response(retry_after)
+            return view(*args, **kwargs)
+
+        wrapper.limiter = limiter
+        return wrapper
+
+    return decorator
+
+
+class ConsumerRateLimitMixin:
+    """Hook for websocket consumers: gate each inbound frame on ``frame_limiter``.
+
+    Rejected frames are answered with a small ``rate_limited`` control frame
+    and should simply be dropped by the caller.
+    """
+
+    frame_limiter: Optional[RateLimiter] = None
+
+    def rate_limit_ident(self) -> str:
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            return f"u{user.pk}"
+        return self.channel_name
+
+    async def allow_frame(self) -> bool:
+        if self.frame_limiter is None:
+            return True
+        allowed, retry_after = await self.frame_limiter.acheck(self.rate_limit_ident())
+        if not allowed:
+            await self.send(text_data=json.dumps({
+                'type': 'rate_limited',
+                'retry_after': max(1, math.ceil(retry_after)),
+            }))
+        return allowed
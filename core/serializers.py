@@ -107,3 +107,18 @@ class DirectThreadSerializer(serializers.ModelSerializer):
         # TODO: Implement unread messages count
         return 0
 
+
+class BatchMessageSerializer(serializers.Serializer):
+    """One item of a batch submission: exactly one of room / thread / user, plus content"""
+    key = serializers.CharField(max_length=64, required=False, allow_blank=False)
+    room = serializers.SlugField(required=False)
+    thread = serializers.IntegerField(required=False, min_value=1)
+    user = serializers.IntegerField(required=False, min_value=1)
+    content = serializers.CharField(trim_whitespace=True)
+    author_name = serializers.CharField(max_length=50, required=False, allow_blank=True)
+
+    def validate(self, attrs):
+        targets = [name for name in ('room', 'thread', 'user') if name in attrs]
+        if len(targets) != 1:
+            raise serializers.ValidationError('Give exactly one of room, thread or user.')
+        return attrs
@@ -0,0 +1,58 @@
+// Image attachments in chat pages.
+//
+// ChatAttachments.render() adds the thumbnail of a message's `attachment`
+// pointer to its bubble.  ChatAttachments.bind() uploads the picked image
+// (with the text box as its caption); the server answers right away and
+// the message itself arrives over the websocket once the image is processed.
+(function () {
+  function render(li, attachment, before) {
+    if (!attachment) return;
+    const variant = attachment.variants.thumb || attachment.variants.large;
+    const link = document.createElement('a');
+    link.className = 'attachment';
+    link.href = (attachment.variants.large || attachment).url;
+    link.target = '_blank';
+    link.rel = 'noopener';
+    const img = document.createElement('img');
+    img.src = variant ? variant.url : attachment.url;
+    img.width = variant ? variant.width : attachment.width;
+    img.height = variant ? variant.height : attachment.height;
+    img.loading = 'lazy';
+    img.alt = '';
+    link.appendChild(img);
+    li.insertBefore(link, before || null);
+  }
+
+  function bind(form, picker, uploadUrl, fields, status) {
+    picker.addEventListener('change', function () {
+      const file = picker.files[0];
+      if (!file) return;
+      const body = new FormData();
+      body.append('file', file);
+      const extra = fields();
+      Object.keys(extra).forEach((name) => body.append(name, extra[name]));
+      const caption = form.querySelector('input[name="content"]');
+      body.append('caption', caption.value);
+      status.textContent = '📤 جارٍ رفع الصورة...';
+      status.classList.add('disconnected');
+      fetch(uploadUrl, {
+        method: 'POST',
+        body: body,
+        credentials: 'same-origin',
+        headers: { 'X-CSRFToken': form.querySelector('input[name="csrfmiddlewaretoken"]').value },
+      }).then((response) => {
+        if (response.status === 413) throw new Error('الصورة أكبر من الحد المسموح');
+        if (!response.ok) throw new Error('تعذر رفع الصورة');
+        caption.value = '';
+        status.textContent = '';
+        status.classList.remove('disconnected');
+      }).catch((error) => {
+        status.textContent = '⚠️ ' + error.message;
+      }).finally(() => {
+        picker.value = '';
+      });
+    });
+  }
+
+  window.ChatAttachments = { render: render, bind: bind };
+})();
@@ -0,0 +1,94 @@
+// Chat websocket that reconnects in place instead of reloading the page.
+//
+// ChatSocket.open() connects to `url` and reconnects whenever the socket
+// closes.  A stopping server first sends {type: 'reconnect', after_ms,
+// cursor}: the client waits `after_ms` (the server spreads these over a
+// window so its clients don't all come back at once) and, once connected
+// again, fetches only the messages after `cursor` from the delta endpoint.
+// Other drops back off exponentially with random jitter.
+//
+// Edits and deletions arrive as {type: 'change', seq, message_id, action,
+// content} frames.  The client keeps the newest seq and, after a drop, asks
+// the delta endpoint for the changes it missed along with the messages.
+(function () {
+  const BASE_DELAY = 1000;
+  const MAX_DELAY = 30000;
+
+  // Every page of the delta endpoint after message `after` and change `state.seq`
+  async function catchUp(options, after, state) {
+    for (;;) {
+      const res = await fetch(options.deltaUrl + '?after=' + after + '&since_seq=' + state.seq, {
+        credentials: 'same-origin'
+      });
+      if (!res.ok) return;
+      const body = await res.json();
+      body.messages.forEach(options.render);
+      body.changes.forEach(options.applyChange);
+      state.seq = Math.max(state.seq, body.seq);
+      if (!(body.more && body.messages.length) && !body.changes_more) return;
+      if (body.messages.length) after = body.messages[body.messages.length - 1].id;
+    }
+  }
+
+  // options: {deltaUrl, seq (change seq the page is current with),
+  //           lastId() -> newest rendered id, render(message),
+  //           applyChange(change), onOpen(), onMessage(data), onClose()}
+  function open(url, options) {
+    const state = { seq: options.seq || 0 };
+    let socket = null;
+    let failures = 0;
+    let dropped = false;
+    let cursor = null;
+    let suggestedDelay = null;
+
+    function connect() {
+      socket = new WebSocket(url);
+
+      socket.onopen = function () {
+        failures = 0;
+        if (dropped) {
+          // Never skip past what is on screen, even if the server's cursor is ahead
+          const after = cursor ? Math.min(cursor, options.lastId() || cursor) : options.lastId();
+          catchUp(options, after || 0, state).catch(() => {});
+        }
+        cursor = null;
+        options.onOpen();
+      };
+
+      socket.onmessage = function (e) {
+        const data = JSON.parse(e.data);
+        if (data.type === 'reconnect') {
+          cursor = data.cursor;
+          suggestedDelay = data.after_ms;
+          return;
+        }
+        if (data.type === 'change') {
+          state.seq = Math.max(state.seq, data.seq);
+          options.applyChange(data);
+          return;
+        }
+        options.onMessage(data);
+      };
+
+      socket.onclose = function () {
+        dropped = true;
+        options.onClose();
+        let delay = suggestedDelay;
+        suggestedDelay = null;
+        if (delay === null) {
+          failures += 1;
+          delay = Math.random() * Math.min(MAX_DELAY, BASE_DELAY * 2 ** failures);
+        }
+        setTimeout(connect, delay);
+      };
+    }
+
+    connect();
+    return {
+      ready: () => socket.readyState === WebSocket.OPEN,
+      send: (data) => socket.send(JSON.stringify(data))
+    };
+  }
+
+  window.ChatSocket = { open };
+})();
@@ -0,0 +1,96 @@
+// Page side of the offline-first message cache kept by the service worker.
+//
+// ChatSync.load() asks the worker for a conversation: it fetches only the
+// messages after its newest cached id, stores them in IndexedDB and returns
+// the cached conversation.  Once that works the `chat_history` cookie tells
+// the server to stop rendering the history into chat pages.
+// ChatSync.queue() parks messages written while offline in the outbox; they
+// are sent on reconnect (background sync, the `online` event or flush()).
+// ChatSync.change() applies an edit or deletion to the cached copy.
+(function () {
+  const HISTORY_COOKIE = 'chat_history';
+
+  function worker() {
+    return navigator.serviceWorker && navigator.serviceWorker.controller;
+  }
+
+  function ask(message) {
+    const sw = worker();
+    if (!sw) return Promise.reject(new Error('no service worker'));
+    return new Promise((resolve, reject) => {
+      const channel = new MessageChannel();
+      channel.port1.onmessage = (e) => (e.data.ok ? resolve(e.data) : reject(new Error(e.data.error)));
+      sw.postMessage(message, [channel.port2]);
+    });
+  }
+
+  function hasHistoryCookie() {
+    return document.cookie.split('; ').indexOf(HISTORY_COOKIE + '=1') !== -1;
+  }
+
+  function setHistoryCookie(on) {
+    document.cookie = HISTORY_COOKIE + '=' + (on ? '1; max-age=2592000' : '; max-age=0') + '; path=/; SameSite=Lax';
+  }
+
+  function registerSync() {
+    if (!('serviceWorker' in navigator)) return;
+    navigator.serviceWorker.ready
+      .then((reg) => reg.sync && reg.sync.register('outbox'))
+      .catch(() => {});
+  }
+
+  window.ChatSync = {
+    available: function () {
+      return !!worker();
+    },
+
+    // render(message) is called for cached/delta messages newer than `renderedUpTo`
+    load: async function (conversation, deltaUrl, render, renderedUpTo) {
+      let messages;
+      try {
+        messages = (await ask({ type: 'sync', conversation, deltaUrl })).messages;
+        setHistoryCookie(true);
+      } catch (err) {
+        // No worker in control (first visit, hard reload): if the server left
+        // the history out for us, fetch it directly
+        if (!hasHistoryCookie()) return;
+        try {
+          const res = await fetch(deltaUrl, { credentials: 'same-origin' });
+          messages = (await res.json()).messages;
+        } catch (err2) {
+          return;
+        }
+      }
+      messages
+        .filter((m) => m.id > (renderedUpTo || 0))
+        .sort((a, b) => a.id - b.id)
+        .forEach(render);
+    },
+
+    store: function (conversation, message) {
+      ask({ type: 'store', conversation, messages: [message] }).catch(() => {});
+    },
+
+    change: function (conversation, change) {
+      ask({ type: 'change', conversation, change }).catch(() => {});
+    },
+
+    // item: {url, fields, csrf} - replayed as a form POST to `url`; signed-in
+    // users also pass `batch` ({room} or {user}, content) to use the batch API
+    queue: async function (item) {
+      await ask({ type: 'enqueue', item });
+      registerSync();
+    },
+
+    flush: function () {
+      return ask({ type: 'flush' }).catch(() => {});
+    },
+
+    clear: function () {
+      setHistoryCookie(false);
+      return ask({ type: 'clear' }).catch(() => {});
+    }
+  };
+
+  window.addEventListener('online', () => window.ChatSync.flush());
+})();
@@ -1,9 +1,18 @@
-// Simple PWA service worker for caching static assets and basic pages
-const CACHE_NAME = 'djchat-cache-v1';
+// PWA service worker: static asset cache, network-first pages, and an
+// offline-first message store (IndexedDB) with delta sync and an outbox.
+// Pages talk to it through /static/core/chat-sync.js.
+const CACHE_NAME = 'djchat-cache-v4';
 const CORE_ASSETS = [
   '/static/core/styles.css',
-  '/static/core/manifest.webmanifest'
+  '/static/core/manifest.webmanifest',
+  '/static/core/chat-sync.js',
+  '/static/core/chat-socket.js',
+  '/static/core/attachments.js'
 ];
+const DB_NAME = 'djchat';
+const DB_VERSION = 1;
+// Messages kept per conversation; older ones come back from the server
+const MAX_CACHED_MESSAGES = 500;
 
 self.addEventListener('install', (event) => {
   event.waitUntil(
@@ -20,14 +29,294 @@ self.addEventListener('activate', (event) => {
 self.addEventListener('fetch', (event) => {
   const req = event.request;
   if (req.method !== 'GET') return;
-  event.respondWith(
-    caches.match(req).then((cached) => {
-      const network = fetch(req).then((res) => {
-        const copy = res.clone();
-        caches.open(CACHE_NAME).then((cache) => cache.put(req, copy)).catch(() => {});
+  const url = new URL(req.url);
+  // API responses live in IndexedDB (messages) and the HTTP cache (ETags), not here
+  if (url.origin !== self.location.origin || url.pathname.startsWith('/api/')) return;
+
+  if (url.pathname.startsWith('/static/')) {
+    // Static files are fingerprinted: cache first
+    event.respondWith(
+      caches.match(req).then((cached) => cached || fetch(req).then((res) => {
+        if (res.ok) {
+          const copy = res.clone();
+          caches.open(CACHE_NAME).then((cache) => cache.put(req, copy)).catch(() => {});
+        }
+        return res;
+      }))
+    );
+    return;
+  }
+
+  if (req.mode === 'navigate') {
+    // Network first so online users always get fresh pages; the cached copy is the offline fallback
+    event.respondWith(
+      fetch(req).then((res) => {
+        if (res.ok) {
+          const copy = res.clone();
+          caches.open(CACHE_NAME).then((cache) => cache.put(req, copy)).catch(() => {});
+        }
         return res;
-      }).catch(() => cached);
-      return cached || network;
-    })
+      }).catch(() => caches.match(req).then((cached) => cached || caches.match('/')))
+    );
+  }
+});
+
+// ---------------------------------------------------------------------------
+// IndexedDB message store
+//
+// messages: one row per message keyed [conversation, id], so every
+//           conversation ("room:<slug>", "dm:<me>:<other>") is its own key range
+// cursors:  {conversation, lastId, seq} - the delta cursor and the newest
+//           change seq (edits and deletions) applied to the cached rows
+// outbox:   messages written offline, sent on reconnect
+// ---------------------------------------------------------------------------
+
+function openDb() {
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open(DB_NAME, DB_VERSION);
+    req.onupgradeneeded = () => {
+      const db = req.result;
+      db.createObjectStore('messages', { keyPath: ['conversation', 'id'] });
+      db.createObjectStore('cursors', { keyPath: 'conversation' });
+      db.createObjectStore('outbox', { keyPath: 'key' });
+    };
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+function done(request) {
+  return new Promise((resolve, reject) => {
+    request.onsuccess = () => resolve(request.result);
+    request.onerror = () => reject(request.error);
+  });
+}
+
+function committed(tx) {
+  return new Promise((resolve, reject) => {
+    tx.oncomplete = () => resolve();
+    tx.onerror = tx.onabort = () => reject(tx.error);
+  });
+}
+
+function conversationRange(conversation) {
+  return IDBKeyRange.bound([conversation, 0], [conversation, Infinity]);
+}
+
+async function storeMessages(conversation, messages) {
+  if (!messages.length) return;
+  const db = await openDb();
+  const tx = db.transaction(['messages', 'cursors'], 'readwrite');
+  const store = tx.objectStore('messages');
+  const cursors = tx.objectStore('cursors');
+  let lastId = 0;
+  for (const message of messages) {
+    store.put(Object.assign({}, message, { conversation }));
+    lastId = Math.max(lastId, message.id);
+  }
+  const cursor = await done(cursors.get(conversation));
+  if (!cursor || cursor.lastId < lastId) cursors.put(Object.assign({}, cursor, { conversation, lastId }));
+
+  // Keep only the newest MAX_CACHED_MESSAGES
+  const excess = (await done(store.count(conversationRange(conversation)))) - MAX_CACHED_MESSAGES;
+  if (excess > 0) {
+    let removed = 0;
+    const walk = store.openCursor(conversationRange(conversation));
+    walk.onsuccess = () => {
+      const c = walk.result;
+      if (c && removed < excess) {
+        c.delete();
+        removed += 1;
+        c.continue();
+      }
+    };
+  }
+  await committed(tx);
+}
+
+async function readConversation(conversation) {
+  const db = await openDb();
+  return done(db.transaction('messages').objectStore('messages').getAll(conversationRange(conversation)));
+}
+
+async function readCursor(conversation) {
+  const db = await openDb();
+  const cursor = await done(db.transaction('cursors').objectStore('cursors').get(conversation));
+  return cursor || { conversation, lastId: 0 };
+}
+
+// Apply edits and deletions to the cached rows.  The cursor's seq only moves
+// across consecutive changes, so a gap is fetched by the next sync
+async function applyChanges(conversation, changes, seq) {
+  const db = await openDb();
+  const tx = db.transaction(['messages', 'cursors'], 'readwrite');
+  const store = tx.objectStore('messages');
+  const cursors = tx.objectStore('cursors');
+  const cursor = (await done(cursors.get(conversation))) || { conversation, lastId: 0 };
+  for (const change of changes) {
+    const key = [conversation, change.message_id];
+    if (change.action === 'delete') {
+      store.delete(key);
+    } else {
+      const message = await done(store.get(key));
+      if (message) store.put(Object.assign(message, { content: change.content }));
+    }
+    if (cursor.seq !== undefined && change.seq === cursor.seq + 1) cursor.seq = change.seq;
+  }
+  if (seq !== undefined && (cursor.seq === undefined || seq > cursor.seq)) cursor.seq = seq;
+  cursors.put(cursor);
+  await committed(tx);
+}
+
+// Fetch only what arrived after the newest cached message and the changes
+// after the cached seq, then return the whole cached conversation (also
+// when offline)
+async function syncConversation(conversation, deltaUrl) {
+  const cursor = await readCursor(conversation);
+  let after = cursor.lastId;
+  let seq = cursor.seq;
+  try {
+    for (;;) {
+      const url = new URL(deltaUrl, self.location.origin);
+      if (after) url.searchParams.set('after', after);
+      if (seq !== undefined) url.searchParams.set('since_seq', seq);
+      const res = await fetch(url, { credentials: 'same-origin', headers: { 'Accept': 'application/json' } });
+      if (!res.ok) break;
+      const body = await res.json();
+      await storeMessages(conversation, body.messages);
+      // Without a cached seq, start from the server's current one
+      await applyChanges(conversation, body.changes || [], body.seq);
+      seq = body.seq;
+      if (!(body.more && body.messages.length) && !body.changes_more) break;
+      if (body.messages.length) after = body.messages[body.messages.length - 1].id;
+    }
+  } catch (err) {
+    // Offline: serve what we have
+  }
+  return readConversation(conversation);
+}
+
+async function enqueue(item) {
+  const db = await openDb();
+  const tx = db.transaction('outbox', 'readwrite');
+  tx.objectStore('outbox').put(Object.assign({ key: self.crypto.randomUUID(), queuedAt: Date.now() }, item));
+  await committed(tx);
+}
+
+async function removeFromOutbox(keys) {
+  if (!keys.length) return;
+  const db = await openDb();
+  const tx = db.transaction('outbox', 'readwrite');
+  keys.forEach((key) => tx.objectStore('outbox').delete(key));
+  await committed(tx);
+}
+
+const BATCH_URL = '/api/v1/messages/batch/';
+const BATCH_SIZE = 100;
+
+// Items queued by signed-in users carry a `batch` payload and go out
+// together in one POST, keyed by their outbox key so a retry after a lost
+// response is answered with "duplicate" instead of sending them twice.
+// Returns the keys that are done, or null to retry later.
+async function sendBatch(items) {
+  let res;
+  try {
+    res = await fetch(BATCH_URL, {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: { 'Content-Type': 'application/json', 'X-CSRFToken': items[0].csrf },
+      body: JSON.stringify({
+        messages: items.map((item) => Object.assign({ key: item.key }, item.batch))
+      })
+    });
+  } catch (err) {
+    return null;
+  }
+  if (res.status >= 500 || res.status === 429) return null;
+  // 200: every item was created, a duplicate or rejected for good; other 4xx won't get better
+  return items.map((item) => item.key);
+}
+
+// Send queued messages in order; stops at the first network failure and
+// returns false so background sync retries later
+async function flushOutbox() {
+  const db = await openDb();
+  const items = (await done(db.transaction('outbox').objectStore('outbox').getAll()))
+    .sort((a, b) => a.queuedAt - b.queuedAt);
+  const sent = [];
+  let complete = true;
+  const batched = items.filter((item) => item.batch);
+  for (let i = 0; i < batched.length; i += BATCH_SIZE) {
+    const keys = await sendBatch(batched.slice(i, i + BATCH_SIZE));
+    if (!keys) {
+      complete = false;
+      break;
+    }
+    sent.push(...keys);
+  }
+  for (const item of complete ? items.filter((item) => !item.batch) : []) {
+    let res;
+    try {
+      res = await fetch(item.url, {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {
+          'Content-Type': 'application/x-www-form-urlencoded',
+          'X-CSRFToken': item.csrf,
+          'X-Requested-With': 'XMLHttpRequest'
+        },
+        body: new URLSearchParams(item.fields)
+      });
+    } catch (err) {
+      complete = false;
+      break;
+    }
+    if (res.status >= 500 || res.status === 429) {
+      complete = false;
+      break;
+    }
+    // 2xx, or a 4xx that no retry would fix
+    sent.push(item.key);
+  }
+  await removeFromOutbox(sent);
+  if (sent.length) {
+    const clients = await self.clients.matchAll();
+    clients.forEach((client) => client.postMessage({ type: 'outbox-flushed', sent: sent.length }));
+  }
+  return complete;
+}
+
+async function clearAll() {
+  const db = await openDb();
+  const tx = db.transaction(['messages', 'cursors', 'outbox'], 'readwrite');
+  ['messages', 'cursors', 'outbox'].forEach((name) => tx.objectStore(name).clear());
+  await committed(tx);
+}
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === 'outbox') {
+    event.waitUntil(flushOutbox().then((complete) => {
+      if (!complete) throw new Error('outbox not flushed, retrying later');
+    }));
+  }
+});
+
+self.addEventListener('message', (event) => {
+  const data = event.data || {};
+  const port = event.ports[0];
+  const handlers = {
+    sync: () => syncConversation(data.conversation, data.deltaUrl).then((messages) => ({ messages })),
+    store: () => storeMessages(data.conversation, data.messages),
+    change: () => applyChanges(data.conversation, [data.change]),
+    enqueue: () => enqueue(data.item),
+    flush: () => flushOutbox().then((complete) => ({ complete })),
+    clear: () => clearAll()
+  };
+  const handler = handlers[data.type];
+  if (!handler) return;
+  event.waitUntil(
+    handler()
+      .then((result) => port && port.postMessage(Object.assign({ ok: true }, result)))
+      .catch((err) => port && port.postMessage({ ok: false, error: String(err) }))
   );
 });
@@ -1 +1,1588 @@
-from django.test import TestCase
+import csv
+import gzip
+import importlib
+import io
+import json
+import os
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+
+from accounts.models import Profile
+from accounts.views import signup, verify
+from mysite import compression, db_router, drain, metrics, query_profiler, startup, workers
+from mysite.db_router import PIN_COOKIE, ReplicaPinMiddleware, replica_reads
+from . import api_views, attachments, batch, export, importer, ratelimit
+from .admin import MessageAdmin
+from .archive import archive_conversation, decode_segment, room_history, thread_history
+from .changes import edit_message
+from .directory import activity_weight, ranked_rooms, rebuild_activity, record_messages
+from .fast_serializers import (
+    DIRECT_MESSAGE_COLUMNS, MESSAGE_COLUMNS, dumps, room_rows, serialize_direct_messages, serialize_messages,
+    serialize_rooms, serialize_threads, thread_rows,
+)
+from .models import (
+    ArchiveSegment, Attachment, Room, Message, MessageChange, DirectThread, DirectMessage, IdempotencyKey,
+    RoomActivity,
+)
+from .serializers import DirectMessageSerializer, DirectThreadSerializer, MessageSerializer, RoomSerializer
+
+
+# Templates reference static files; skip the collectstatic manifest in tests
+PLAIN_STATIC = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], STORAGES=PLAIN_STATIC)
+class ReplicaRoutingTests(TransactionTestCase):
+    """`default` and `replica` are the two local SQLite aliases from settings.
+
+    Under tests the replica is a TEST MIRROR of `default` rather than a second
+    SQLite file: nothing would replicate rows into a separate file, and what is
+    under test is the routing.  Committed rows are visible on both connections
+    and each query shows up on the alias it was routed to.
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.room = Room.objects.create(name='general')
+        Message.objects.create(room=self.room, author_name='a', content='hello')
+
+    def test_history_reads_go_to_replica(self):
+        with CaptureQueriesContext(connections['replica']) as replica:
+            with CaptureQueriesContext(connections['default']) as primary:
+                response = self.client.get(f'/api/r/{self.room.slug}/messages/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(replica), 0)
+        self.assertEqual(len(primary), 0)
+
+    def test_writes_stay_on_primary_and_pin_the_client(self):
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.post(f'/r/{self.room.slug}/', {'author_name': 'a', 'content': 'hi'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(replica), 0)
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        # The pinned client reads its own write from the primary
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.client.get(f'/api/r/{self.room.slug}/messages/')
+        self.assertEqual(len(replica), 0)
+
+    def test_async_requests_pin_without_a_sync_hop(self):
+        async def view(request):
+            return None
+
+        self.assertTrue(iscoroutinefunction(ReplicaPinMiddleware(view)))
+        response = async_to_sync(self.async_client.post)(f'/r/{self.room.slug}/', {'author_name': 'a', 'content': 'hi'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        response = async_to_sync(self.async_client.get)(f'/api/r/{self.room.slug}/messages/')
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_nested_async_views_restore_the_outer_routing(self):
+        @replica_reads
+        async def inner(request):
+            return db_router._state.use_replica
+
+        @replica_reads
+        async def outer(request):
+            return await inner(request), db_router._state.use_replica
+
+        async def anonymous():
+            return AnonymousUser()
+
+        request = RequestFactory().get('/')
+        request.auser = anonymous
+        self.assertEqual(async_to_sync(outer)(request), (True, True))
+        self.assertFalse(getattr(db_router._state, 'use_replica', False))
+
+    def test_unmarked_views_read_from_primary(self):
+        me = User.objects.create_user(username='me')
+        other = User.objects.create_user(username='other')
+        self.client.force_login(me)
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(f'/dm/{other.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(replica), 0)
+
+
+class QueryBudgetMixin:
+    """Run a path against growing datasets and hold it to a flat query budget.
+
+    Queries are counted through ``mysite.query_profiler`` so the ones run on
+    DB executor threads (async views, consumers) are included.  The cache is
+    cleared before each run, so fragment-cached pages are measured cold.
+    """
+    sizes = (3, 15)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        query_profiler.enable()
+
+    def grow_to(self, size: int) -> None:
+        raise NotImplementedError
+
+    def count_queries(self, func) -> int:
+        cache.clear()
+        with query_profiler.profile_queries(self.id(), report=False) as profile:
+            func()
+        return profile.count
+
+    def assertFlatQueries(self, budget: int, func) -> None:
+        counts = []
+        for size in self.sizes:
+            self.grow_to(size)
+            counts.append(self.count_queries(func))
+        self.assertEqual(len(set(counts)), 1, f'query count grows with the data: {counts} for sizes {self.sizes}')
+        self.assertLessEqual(counts[0], budget)
+
+    def get_ok(self, url: str):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return response
+
+    def peak_allocation(self, func) -> int:
+        cache.clear()
+        func()  # warm imports and per-process caches
+        cache.clear()
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False)
+class ChatQueryBudgetTests(QueryBudgetMixin, TransactionTestCase):
+    """Listings, histories and write paths keep the same query count as rooms, users and messages grow."""
+
+    def setUp(self):
+        self.me = User.objects.create_user(username='me')
+        Profile.objects.create(user=self.me, phone='+10', name='me')
+        self.room = Room.objects.create(name='main', slug='main')
+        self.client.force_login(self.me)
+        self.size = 0
+
+    def grow_to(self, size: int) -> None:
+        for i in range(self.size, size):
+            other = User.objects.create_user(username=f'user{i}')
+            if i == 0:
+                self._peer_id = other.id
+            Profile.objects.create(user=other, phone=f'+2{i}', name=f'user {i}')
+            Room.objects.create(name=f'room {i}', slug=f'room-{i}')
+            Message.objects.bulk_create(Message(room=self.room, author_name=f'a{i}', content='hi') for _ in range(5))
+            thread, _ = DirectThread.get_or_create_for_users(self.me.id, other.id)
+            DirectMessage.objects.bulk_create(
+                DirectMessage(thread=thread, author=author, content='hi') for author in (self.me, other, other)
+            )
+        self.size = size
+
+    def peer_id(self) -> int:
+        # Looked up before the measured call
+        return self._peer_id
+
+    def test_room_list(self):
+        self.assertFlatQueries(4, lambda: self.get_ok('/rooms/'))
+
+    # History views include one lookup of the page's image attachments
+    def test_room_detail(self):
+        self.assertFlatQueries(7, lambda: self.get_ok('/r/main/'))
+
+    def test_room_history(self):
+        self.assertFlatQueries(4, lambda: self.get_ok('/api/r/main/messages/'))
+
+    def test_room_poll(self):
+        self.assertFlatQueries(3, lambda: self.get_ok('/api/v1/rooms/main/poll/?after=1'))
+
+    def test_api_room_list(self):
+        self.assertFlatQueries(5, lambda: self.get_ok('/api/v1/rooms/'))
+
+    def test_api_room_detail(self):
+        self.assertFlatQueries(5, lambda: self.get_ok('/api/v1/rooms/main/'))
+
+    def test_dm_list(self):
+        self.assertFlatQueries(3, lambda: self.get_ok('/dm/'))
+
+    def test_dm_thread(self):
+        self.assertFlatQueries(8, lambda: self.get_ok(f'/dm/{self.peer_id()}/'))
+
+    def test_dm_history(self):
+        self.assertFlatQueries(7, lambda: self.get_ok(f'/api/dm/{self.peer_id()}/messages/'))
+
+    def test_api_thread_list(self):
+        self.assertFlatQueries(6, lambda: self.get_ok('/api/v1/direct-threads/'))
+
+    def test_batch_submit(self):
+        """One statement per table, not per message."""
+        def submit():
+            items = [{'room': 'main', 'content': f'm{i}', 'key': f'k{self.size}-{i}'} for i in range(self.size)]
+            items += [{'user': self.peer_id(), 'content': 'dm'}]
+            response = self.client.post('/api/v1/messages/batch/', json.dumps(items), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        # The room's first message creates its activity row; measure the steady state
+        self.grow_to(1)
+        submit()
+        self.assertFlatQueries(12, submit)
+
+    def test_room_consumer_frame(self):
+        """Counted per inbound frame by the consumer's own profiler hook."""
+        from mysite.asgi import application
+
+        async def send_frame():
+            communicator = WebsocketCommunicator(
+                application, '/ws/chat/main/', headers=[(b'origin', b'http://localhost'), (b'host', b'localhost')],
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'type': 'chat_message', 'author_name': 'a', 'content': 'hi'})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        # The room's first message creates its activity row; measure the steady state
+        self.grow_to(1)
+        async_to_sync(send_frame)()
+        counts = []
+        for size in self.sizes:
+            self.grow_to(size)
+            profiles = []
+            with override_settings(QUERY_PROFILER_SAMPLE_RATE=1), \
+                    mock.patch.object(query_profiler.QueryProfile, 'report', autospec=True, side_effect=profiles.append):
+                async_to_sync(send_frame)()
+            self.assertEqual(len(profiles), 1)
+            counts.append(profiles[0].count)
+        self.assertEqual(len(set(counts)), 1, counts)
+        self.assertLessEqual(counts[0], 2)
+
+    def test_history_allocations_are_bounded(self):
+        """The history endpoint returns one page, so memory does not follow the room's size."""
+        self.grow_to(40)  # 200 messages: one full page
+        page = self.peak_allocation(lambda: self.get_ok('/api/r/main/messages/'))
+        self.grow_to(200)  # 1000 messages
+        large = self.peak_allocation(lambda: self.get_ok('/api/r/main/messages/'))
+        self.assertLess(large, 512 * 1024)
+        self.assertLess(large, page * 1.5)
+
+
+@override_settings(STORAGES=PLAIN_STATIC, STARTUP_WARMUP='background', RATELIMIT_ENABLED=False)
+class StartupTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        startup._ready.clear()
+        self.addCleanup(startup._ready.clear)
+        Room.objects.create(name='general')
+
+    def test_healthz_waits_for_warm_up(self):
+        self.assertEqual(self.client.get('/healthz').status_code, 503)
+        timings = startup.warm_up()
+        self.assertEqual(set(timings), {name for name, _ in startup.PHASES} | {'total'})
+        response = self.client.get('/healthz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'ready')
+
+    def test_failing_phase_does_not_block_readiness(self):
+        with mock.patch.object(startup, 'warm_pages', side_effect=RuntimeError), \
+                mock.patch.object(startup, 'PHASES', [('pages', lambda: startup.warm_pages())]), \
+                self.assertLogs('mysite.startup', 'ERROR'):
+            startup.warm_up()
+        self.assertTrue(startup.is_ready())
+
+    @override_settings(STARTUP_WARMUP='off')
+    def test_ready_without_warm_up(self):
+        self.assertEqual(self.client.get('/healthz').status_code, 200)
+
+
+
+@override_settings(RATELIMIT_ENABLED=False, WS_DRAIN_MIN_MS=100, WS_DRAIN_SPREAD_MS=200)
+class DrainTests(TransactionTestCase):
+    def setUp(self):
+        Room.objects.create(name='main')
+        for patcher in (mock.patch.object(drain, '_draining', False), mock.patch.object(drain, 'install')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def communicator(self):
+        from mysite.asgi import application
+        return WebsocketCommunicator(
+            application, '/ws/chat/main/', headers=[(b'origin', b'http://localhost'), (b'host', b'localhost')],
+        )
+
+    def test_open_sockets_get_a_jittered_reconnect_with_their_cursor(self):
+        async def run():
+            sender, idle = self.communicator(), self.communicator()
+            self.assertTrue((await sender.connect())[0])
+            self.assertTrue((await idle.connect())[0])
+            await sender.send_json_to({'type': 'chat_message', 'author_name': 'a', 'content': 'hi'})
+            sent = await sender.receive_json_from()
+            await idle.receive_json_from()
+
+            self.assertEqual(await drain.drain(), 2)
+            for communicator in (sender, idle):
+                frame = await communicator.receive_json_from()
+                self.assertEqual(frame['type'], 'reconnect')
+                self.assertEqual(frame['cursor'], sent['id'])
+                self.assertTrue(100 <= frame['after_ms'] <= 200)
+                self.assertEqual((await communicator.receive_output())['code'], drain.CLOSE_CODE)
+
+            # New handshakes are refused while draining
+            self.assertFalse((await self.communicator().connect())[0])
+
+        async_to_sync(run)()
+        self.assertEqual(self.client.get('/healthz').json(), {'status': 'draining'})
+        self.assertEqual(self.client.get('/healthz').status_code, 503)
+
+    def test_signal_is_handed_on_after_draining(self):
+        previous = mock.Mock()
+        with mock.patch.object(drain, '_previous_handler', previous), \
+                mock.patch.object(drain, 'FLUSH_SECONDS', 0), \
+                mock.patch('signal.signal') as set_handler, mock.patch('signal.raise_signal') as raise_signal:
+            async_to_sync(drain.drain)(resignal=True)
+        set_handler.assert_called_once_with(signal.SIGTERM, previous)
+        raise_signal.assert_called_once_with(signal.SIGTERM)
+
+
+def image_upload(size=(800, 600), fmt='JPEG', name='photo.jpg') -> SimpleUploadedFile:
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(buffer, fmt)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False, ATTACHMENT_WORKERS=0)
+class AttachmentTests(TransactionTestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.media = media
+        self.me = User.objects.create_user(username='me')
+        Profile.objects.create(user=self.me, phone='+10', name='me')
+        self.other = User.objects.create_user(username='other')
+        self.room = Room.objects.create(name='main', slug='main')
+        self.client.force_login(self.me)
+
+    def upload(self, **fields):
+        fields.setdefault('file', image_upload())
+        return self.client.post('/attachments/', fields)
+
+    def test_room_upload_posts_message_with_variants(self):
+        layer = get_channel_layer()
+        async_to_sync(layer.group_add)('chat_main', 'watcher')
+        response = self.upload(room='main', caption='look')
+        self.assertEqual(response.status_code, 202)
+
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.status, Attachment.STATUS_READY)
+        self.assertEqual((attachment.width, attachment.height), (800, 600))
+        self.assertEqual(attachment.variants['thumb']['width'], 320)
+        message = Message.objects.get(id=attachment.message_id)
+        self.assertEqual((message.content, message.author_name, message.author), ('look', 'me', self.me))
+
+        frame = async_to_sync(layer.receive)('watcher')
+        self.assertEqual(frame['data']['attachment']['id'], attachment.id)
+        history = self.client.get('/api/r/main/messages/').json()['messages']
+        self.assertEqual(history[-1]['attachment'], attachments.pointer(attachment))
+        page = self.client.get('/r/main/')
+        self.assertContains(page, frame['data']['attachment']['variants']['thumb']['url'])
+
+    def test_oversized_upload_is_cut_off(self):
+        with override_settings(ATTACHMENT_MAX_BYTES=10_000):
+            response = self.upload(room='main')
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertEqual(list(os.walk(self.media))[0][1:], ([], []))
+
+    def test_not_an_image(self):
+        response = self.upload(room='main', file=SimpleUploadedFile('a.jpg', b'not an image'))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Attachment.objects.exists())
+
+    def fetch(self, url, **headers):
+        """GET through the async client; the files stream from an async iterator."""
+        async def get():
+            response = await self.async_client.get(url, headers=headers)
+            body = b''.join([chunk async for chunk in response]) if response.streaming else response.content
+            return response, body
+        return async_to_sync(get)()
+
+    def test_range_requests(self):
+        self.upload(room='main')
+        attachment = Attachment.objects.get()
+        url = f'/attachments/{attachment.id}/original/'
+        response, body = self.fetch(url)
+        self.assertEqual((response.status_code, len(body)), (200, attachment.size))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        partial, chunk = self.fetch(url, range='bytes=10-19')
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial['Content-Range'], f'bytes 10-19/{attachment.size}')
+        self.assertEqual(chunk, body[10:20])
+
+        self.assertEqual(self.fetch(url, range='bytes=-5')[1], body[-5:])
+        self.assertEqual(self.fetch(url, range=f'bytes={attachment.size}-')[0].status_code, 416)
+        self.assertEqual(self.fetch(url, range='bytes=0-9', if_range='"other"')[0].status_code, 200)
+        self.assertEqual(self.fetch(url, if_none_match=partial['ETag'])[0].status_code, 304)
+
+    def test_dm_images_are_private(self):
+        self.upload(user=self.other.id)
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.kind, Attachment.KIND_DM)
+        url = f'/attachments/{attachment.id}/thumb/'
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.force_login(User.objects.create_user(username='stranger'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_no_served_file_carries_metadata(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # orientation: rotated 90 degrees
+        exif[0x010F] = 'Camera maker'
+        exif[0x8825] = {2: (51.0, 30.0, 0.0)}  # GPS latitude
+        photo = io.BytesIO()
+        Image.effect_noise((800, 600), 64).convert('RGB').save(photo, 'JPEG', exif=exif, comment=b'where')
+        screenshot = io.BytesIO()
+        Image.effect_noise((300, 200), 64).convert('RGBA').save(screenshot, 'PNG', exif=exif)
+        animation = io.BytesIO()
+        frames = [Image.effect_noise((100, 100), 64).convert('P') for _ in range(3)]
+        frames[0].save(animation, 'GIF', save_all=True, append_images=frames[1:], comment=b'where')
+        uploads = [('photo.jpg', photo), ('screen.png', screenshot), ('anim.gif', animation)]
+
+        for name, data in uploads:
+            self.upload(room='main', file=SimpleUploadedFile(name, data.getvalue()))
+        for attachment in Attachment.objects.order_by('id'):
+            for variant in ['original', *attachment.variants]:
+                response, body = self.fetch(f'/attachments/{attachment.id}/{variant}/')
+                self.assertEqual(response.status_code, 200)
+                with Image.open(io.BytesIO(body)) as image:
+                    self.assertEqual(dict(image.getexif()), {}, (attachment.content_type, variant))
+                    self.assertNotIn('comment', image.info)
+                    self.assertNotIn(b'Camera maker', body)
+                if variant == 'original':
+                    self.assertEqual(len(body), attachment.size)
+
+        photo = Attachment.objects.get(content_type='image/jpeg')
+        # The orientation was applied before the tag went
+        self.assertEqual((photo.width, photo.height), (600, 800))
+        with Image.open(photo.file.path) as image:
+            self.assertEqual(image.size, (600, 800))
+        with Image.open(Attachment.objects.get(content_type='image/gif').file.path) as image:
+            self.assertEqual(image.n_frames, 3)
+
+    def test_malformed_content_length(self):
+        for value in ['lots', '-1', '\u0661\u0662']:
+            response = self.client.generic('POST', '/attachments/', b'', CONTENT_LENGTH=value)
+            self.assertEqual(response.status_code, 400, value)
+            self.assertEqual(response.json(), {'error': 'invalid_content_length'})
+
+    @override_settings(ATTACHMENT_WORKERS=1)
+    def test_variants_made_in_process_pool(self):
+        self.addCleanup(lambda: attachments._pool and attachments._pool.shutdown())
+        self.addCleanup(setattr, attachments, '_pool', None)
+        response = self.upload(room='main')
+        status_url = response.json()['status_url']
+        deadline = time.monotonic() + 30
+        while self.client.get(status_url).json()['status'] == Attachment.STATUS_PROCESSING:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertEqual(self.client.get(status_url).json()['status'], Attachment.STATUS_READY)
+        self.assertTrue(Message.objects.filter(id=Attachment.objects.get().message_id).exists())
+
+
+
+@override_settings(RATELIMIT_ENABLED=False)
+class ChangeFeedTests(TransactionTestCase):
+    def setUp(self):
+        self.me = User.objects.create_user(username='me')
+        Profile.objects.create(user=self.me, phone='+10', name='me')
+        self.room = Room.objects.create(name='main', slug='main')
+        self.messages = [
+            Message.objects.create(room=self.room, author=self.me, author_name='me', content=f'm{i}') for i in range(3)
+        ]
+        self.client.force_login(self.me)
+
+    def change(self, method, message, **data):
+        url = f'/api/v1/rooms/main/messages/{message.id}/'
+        return getattr(self.client, method)(url, data, content_type='application/json')
+
+    def test_edit_and_delete_append_to_the_log(self):
+        response = self.change('patch', self.messages[0], content='fixed')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['seq'], 1)
+        self.assertEqual(self.change('delete', self.messages[1]).json()['seq'], 2)
+
+        self.messages[0].refresh_from_db()
+        self.assertEqual(self.messages[0].content, 'fixed')
+        self.assertFalse(Message.objects.filter(pk=self.messages[1].pk).exists())
+        self.assertEqual(
+            list(MessageChange.objects.values_list('seq', 'message_id', 'action')),
+            [(1, self.messages[0].id, 'edit'), (2, self.messages[1].id, 'delete')],
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.change_seq, 2)
+
+    def test_only_the_author_may_change_a_message(self):
+        someone = User.objects.create_user(username='someone')
+        # Posted by someone else under my display name, and posted anonymously under it
+        impostor = Message.objects.create(room=self.room, author=someone, author_name='me', content='x')
+        anonymous = Message.objects.create(room=self.room, author_name='me', content='x')
+        for message in (impostor, anonymous):
+            self.assertEqual(self.change('patch', message, content='y').status_code, 403)
+            self.assertEqual(self.change('delete', message).status_code, 403)
+        self.assertFalse(MessageChange.objects.exists())
+
+        self.client.force_login(User.objects.create_user(username='staff', is_staff=True))
+        self.assertEqual(self.change('delete', anonymous).status_code, 200)
+
+    def test_every_write_path_records_the_author(self):
+        self.client.post('/r/main/', {'author_name': 'anyone', 'content': 'form'})
+        self.client.post('/api/v1/rooms/main/send_message/', {'content': 'api'})
+        self.client.post('/api/v1/messages/batch/', json.dumps([{'room': 'main', 'content': 'batch'}]),
+                         content_type='application/json')
+        from mysite.asgi import application
+
+        async def send():
+            session = self.client.cookies['sessionid'].value
+            communicator = WebsocketCommunicator(application, '/ws/chat/main/', headers=[
+                (b'origin', b'http://localhost'), (b'host', b'localhost'), (b'cookie', f'sessionid={session}'.encode()),
+            ])
+            self.assertTrue((await communicator.connect())[0])
+            await communicator.send_json_to({'type': 'chat_message', 'author_name': 'me', 'content': 'ws'})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        async_to_sync(send)()
+        self.client.logout()
+        self.client.post('/r/main/', {'author_name': 'me', 'content': 'signed out'})
+        authors = dict(Message.objects.values_list('content', 'author'))
+        self.assertEqual([authors[c] for c in ('form', 'api', 'batch', 'ws')], [self.me.id] * 4)
+        self.assertIsNone(authors['signed out'])
+
+    def test_malformed_since_seq_is_a_bad_request(self):
+        for url in ['/api/r/main/messages/?since_seq=x', '/api/v1/rooms/main/poll/?after=0&since_seq=-1']:
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+    def test_archived_messages_cannot_change(self):
+        Room.objects.filter(pk=self.room.pk).update(archived_through=self.messages[0].id)
+        self.assertEqual(self.change('patch', self.messages[0], content='y').status_code, 409)
+
+    def test_delta_returns_changes_since_seq_in_one_query(self):
+        for i in range(3):
+            self.change('patch', self.messages[0], content=f'v{i}')
+        url = f'/api/r/main/messages/?after={self.messages[-1].id}'
+        plain = self.client.get(url)
+        self.assertEqual(plain.json()['seq'], 3)
+        with CaptureQueriesContext(connections['default']) as without:
+            self.client.get(url)
+        with CaptureQueriesContext(connections['default']) as queries:
+            body = self.client.get(url + '&since_seq=1').json()
+        self.assertEqual(len(queries), len(without) + 1)
+        self.assertEqual([c['seq'] for c in body['changes']], [2, 3])
+        self.assertEqual(body['changes'][-1]['content'], 'v2')
+        self.assertEqual(body['seq'], 3)
+        self.assertFalse(body['changes_more'])
+
+    def test_edits_change_the_etag(self):
+        url = '/api/r/main/messages/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.change('patch', self.messages[-1], content='fixed')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_live_change_frame(self):
+        from mysite.asgi import application
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                application, '/ws/chat/main/', headers=[(b'origin', b'http://localhost'), (b'host', b'localhost')],
+            )
+            self.assertTrue((await communicator.connect())[0])
+            await sync_to_async(self.change)('delete', self.messages[0])
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        with mock.patch.object(drain, 'install'):
+            frame = async_to_sync(run)()
+        self.assertEqual(frame['type'], 'change')
+        self.assertEqual((frame['seq'], frame['message_id'], frame['action']), (1, self.messages[0].id, 'delete'))
+
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False)
+class FragmentCacheTests(TransactionTestCase):
+    """Warm fragments are served without the message tables and never outlive a write."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.me = User.objects.create_user(username='me')
+        Profile.objects.create(user=self.me, phone='+10', name='me')
+        self.other = User.objects.create_user(username='other')
+        Profile.objects.create(user=self.other, phone='+20', name='other')
+        self.room = Room.objects.create(name='main', slug='main')
+        self.client.force_login(self.me)
+
+    def page(self, url: str) -> str:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def assertWarm(self, url: str, sql: str) -> None:
+        self.page(url)
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.page(url)
+        self.assertFalse([q['sql'] for q in queries if sql in q['sql']])
+
+    def test_room_messages(self):
+        self.client.post('/r/main/', {'author_name': 'me', 'content': 'first'})
+        self.assertWarm('/r/main/', 'core_message')
+        self.client.post('/r/main/', {'author_name': 'me', 'content': 'from the form'})
+        self.assertIn('from the form', self.page('/r/main/'))
+        self.client.post('/api/v1/rooms/main/send_message/', {'content': 'from the api'})
+        self.assertIn('from the api', self.page('/r/main/'))
+        edit_message(self.room, Message.objects.get(content='first').id,
+                     User.objects.create_user(username='staff', is_staff=True), 'edited')
+        page = self.page('/r/main/')
+        self.assertIn('edited', page)
+        self.assertNotIn('first', page)
+
+    def test_room_messages_from_the_websocket(self):
+        from mysite.asgi import application
+
+        async def send():
+            communicator = WebsocketCommunicator(
+                application, '/ws/chat/main/', headers=[(b'origin', b'http://localhost'), (b'host', b'localhost')],
+            )
+            self.assertTrue((await communicator.connect())[0])
+            await communicator.send_json_to({'type': 'chat_message', 'author_name': 'a', 'content': 'over ws'})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        self.assertWarm('/r/main/', 'core_message')
+        async_to_sync(send)()
+        self.assertIn('over ws', self.page('/r/main/'))
+
+    def test_room_sidebar(self):
+        # The page still loads its own room, but not the ranked list
+        self.assertWarm('/r/main/', '"rank" DESC')
+        self.client.post('/rooms/', {'name': 'brand new'})
+        self.assertIn('brand new', self.page('/r/main/'))
+
+    def test_dm_messages(self):
+        url = f'/dm/{self.other.id}/'
+        self.client.post(url, {'content': 'first'})
+        self.assertWarm(url, 'core_directmessage')
+        self.client.post(url, {'content': 'from the form'})
+        self.assertIn('from the form', self.page(url))
+        thread = DirectThread.objects.get()
+        self.client.post(f'/api/v1/direct-threads/{thread.id}/send_message/', {'content': 'from the api'})
+        self.assertIn('from the api', self.page(url))
+
+    def test_dm_list(self):
+        self.assertWarm('/dm/', 'core_directthread')
+        self.page(f'/dm/{self.other.id}/')
+        self.assertIn('other', self.page('/dm/'))
+
+
+@override_settings(RATELIMIT_ENABLED=False)
+class BatchTests(TransactionTestCase):
+    def setUp(self):
+        self.me = User.objects.create_user(username='me')
+        self.other = User.objects.create_user(username='other')
+        self.room = Room.objects.create(name='main', slug='main')
+        self.client.force_login(self.me)
+
+    def submit(self, items):
+        response = self.client.post('/api/v1/messages/batch/', json.dumps(items), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_results_follow_the_items(self):
+        results = self.submit([
+            {'room': 'main', 'content': 'hi', 'key': 'a'},
+            {'room': 'nope', 'content': 'hi'},
+            {'user': self.other.id, 'content': 'dm', 'key': 'b'},
+            {'room': 'main', 'thread': 1, 'content': 'both'},
+            {'room': 'main', 'content': 'again', 'key': 'a'},
+        ])
+        self.assertEqual([r['status'] for r in results], ['created', 'error', 'created', 'error', 'duplicate'])
+        self.assertEqual(results[4]['id'], results[0]['id'])
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['hi'])
+        self.assertEqual(DirectMessage.objects.get().thread, DirectThread.objects.get())
+
+    def test_replay_returns_the_stored_ids(self):
+        items = [{'room': 'main', 'content': f'm{i}', 'key': f'k{i}'} for i in range(3)]
+        items.append({'user': self.other.id, 'content': 'dm', 'key': 'dm'})
+        first = self.submit(items)
+        replay = self.submit(items)
+        self.assertEqual([r['status'] for r in replay], ['duplicate'] * 4)
+        self.assertEqual([r['id'] for r in replay], [r['id'] for r in first])
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(DirectMessage.objects.count(), 1)
+        # Keys are per user
+        self.client.force_login(self.other)
+        self.assertEqual(self.submit(items[:1])[0]['status'], 'created')
+
+    def test_key_stored_concurrently_is_a_duplicate(self):
+        # Another request committed key "k" after our lookup: the insert fails and the retry reports it
+        earlier = Message.objects.create(room=self.room, author_name='me', content='hi')
+        IdempotencyKey.objects.create(user=self.me, key='k', kind=IdempotencyKey.KIND_ROOM, message_id=earlier.id)
+        lookup, calls = IdempotencyKey.objects.filter, []
+
+        def stale_lookup(*args, **kwargs):
+            calls.append(kwargs)
+            return IdempotencyKey.objects.none() if len(calls) == 1 else lookup(*args, **kwargs)
+
+        with mock.patch.object(IdempotencyKey.objects, 'filter', side_effect=stale_lookup):
+            results = batch.submit_batch(self.me, [
+                {'room': 'main', 'content': 'hi', 'key': 'k'}, {'room': 'main', 'content': 'new'},
+            ])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results[0], {'key': 'k', 'status': 'duplicate', 'id': earlier.id})
+        self.assertEqual(results[1]['status'], 'created')
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['hi', 'new'])
+
+
+@override_settings(RATELIMIT_ENABLED=False)
+class ExportTests(TransactionTestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='main', slug='main')
+        self.ids = [Message.objects.create(room=self.room, author_name='a', content=f'm{i}, "q"').id
+                    for i in range(7)]
+        # The oldest three go to the archive
+        archive_conversation('room', self.room.id, timezone.now() + timedelta(days=1), 3)
+        self.staff = User.objects.create_user(username='staff', is_staff=True)
+
+    def test_pages_span_archive_and_hot_rows(self):
+        chunks = list(export.export_chunks(self.room, page_size=2))
+        self.assertEqual(len(chunks), 4)
+        rows = [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], self.ids)
+        self.assertEqual(rows[0]['content'], 'm0, "q"')
+
+    def test_csv_and_gzip(self):
+        data = gzip.decompress(b''.join(export.export_chunks(self.room, 'csv', gzip=True, page_size=4)))
+        rows = list(csv.DictReader(io.StringIO(data.decode())))
+        self.assertEqual([int(row['id']) for row in rows], self.ids)
+        self.assertEqual(rows[-1]['content'], 'm6, "q"')
+
+    def test_thread_export_names_authors(self):
+        me, other = User.objects.create_user(username='me'), User.objects.create_user(username='other')
+        thread, _ = DirectThread.get_or_create_for_users(me.id, other.id)
+        DirectMessage.objects.create(thread=thread, author=other, content='hi')
+        row = json.loads(b''.join(export.export_chunks(thread)))
+        self.assertEqual((row['author_id'], row['author'], row['content']), (other.id, 'other', 'hi'))
+
+    def test_endpoint_streams_for_staff_only(self):
+        url = '/internal/export/room/main/?format=ndjson&gzip=1'
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        async def fetch():
+            await self.async_client.aforce_login(self.staff)
+            response = await self.async_client.get(url)
+            return response, b''.join([chunk async for chunk in response.streaming_content])
+
+        response, body = async_to_sync(fetch)()
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('room-main.ndjson.gz', response['Content-Disposition'])
+        self.assertEqual(len(gzip.decompress(body).splitlines()), 7)
+
+    def test_command_writes_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'out.csv')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command('export_conversation', room='main', format='csv', output=path, stdout=io.StringIO())
+        with open(path) as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 7)
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False, ADMIN_EXACT_COUNT_LIMIT=5)
+class LargeAdminTests(TransactionTestCase):
+    url = '/admin/core/message/'
+
+    def setUp(self):
+        self.room = Room.objects.create(name='main', slug='main')
+        other = Room.objects.create(name='other', slug='other')
+        self.ids = [Message.objects.create(room=self.room if i % 2 else other, author_name=f'a{i % 3}',
+                                           content=f'm{i}').id for i in range(8)]
+        self.client.force_login(User.objects.create_superuser(username='admin', password='x'))
+
+    def page(self, query=''):
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        sql = ' '.join(q['sql'] for q in queries).upper()
+        self.assertNotIn('OFFSET', sql)
+        self.assertNotIn("LIKE '%", sql)
+        return response
+
+    def test_keyset_pages_newest_first(self):
+        with mock.patch.object(MessageAdmin, 'list_per_page', 3):
+            first = self.page()
+            cl = first.context['cl']
+            self.assertEqual([m.id for m in cl.result_list], self.ids[:-4:-1])
+            self.assertEqual((cl.result_count, cl.result_count_kind), (5, 'over'))
+            second = self.page(cl.next_page_url)
+        self.assertEqual([m.id for m in second.context['cl'].result_list], self.ids[-4:-7:-1])
+        self.assertContains(first, 'Older')
+
+    def test_filter_and_search_use_indexed_columns(self):
+        cl = self.page(f'?room={self.room.id}&q=a1').context['cl']
+        self.assertEqual([m.id for m in cl.result_list],
+                         [i for n, i in enumerate(self.ids) if n % 2 and n % 3 == 1][::-1])
+        self.assertEqual(cl.result_count_kind, 'exact')
+        cl = self.page(f'?q={self.ids[2]}').context['cl']
+        self.assertEqual([m.id for m in cl.result_list], [self.ids[2]])
+
+    def test_bad_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(self.url + '?before=x').status_code, 302)
+
+
+WHATSAPP_EXPORT = """\ufeff31/12/2020, 21:40 - Messages and calls are end-to-end encrypted.
+31/12/2020, 21:41 - \u202a+966 50 000 0001\u202c: first
+and more
+1/1/21, 9:05 PM - Ali: second
+[02/01/2021, 07:00:05] Ali: third
+"""
+
+
+@override_settings(RATELIMIT_ENABLED=False)
+class ImportTests(TransactionTestCase):
+    def setUp(self):
+        Profile.objects.create(user=User.objects.create_user(username='known'), phone='+966500000001', name='Known')
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def rows(self, slug):
+        return list(Message.objects.filter(room__slug=slug).order_by('id').values_list('author_name', 'content',
+                                                                                        'created_at'))
+
+    def test_whatsapp_keeps_times_and_maps_phones_to_profiles(self):
+        call_command('import_chat', self.write('chat.txt', WHATSAPP_EXPORT), room='wa', stdout=io.StringIO())
+        rows = self.rows('wa')
+        self.assertEqual([(a, c) for a, c, _ in rows], [('Known', 'first\nand more'), ('Ali', 'second'),
+                                                         ('Ali', 'third')])
+        self.assertEqual([t.day for _, _, t in rows], [31, 1, 2])
+        self.assertEqual(rows[1][2].hour, 21)
+        self.assertEqual(Room.objects.get(slug='wa').activity.last_message_id, Message.objects.latest('id').id)
+
+    def test_telegram_is_decoded_in_pieces(self):
+        messages = [{'id': 1, 'type': 'service', 'actor': 'x', 'action': 'create_group'}] + [
+            {'id': i, 'type': 'message', 'date': '2021-01-01T10:00:00', 'date_unixtime': str(1609495200 + i),
+             'from': 'سارة', 'text': ['hi ', {'type': 'bold', 'text': f'n{i}'}]}
+            for i in range(5)
+        ]
+        path = self.write('result.json', json.dumps({'name': 'G', 'messages': messages}, ensure_ascii=False))
+        with mock.patch.object(importer, 'READ_SIZE', 7):
+            call_command('import_chat', path, room='tg', stdout=io.StringIO())
+        rows = self.rows('tg')
+        self.assertEqual([c for _, c, _ in rows], [f'hi n{i}' for i in range(5)])
+        self.assertEqual((rows[0][0], rows[4][2].timestamp()), ('سارة', 1609495204))
+
+    def test_resumes_after_interruption(self):
+        path = self.write('chat.txt', ''.join(f'1/1/21, 10:{i:02d} - Ali: m{i}\n' for i in range(10)))
+        insert = importer._insert
+        calls = []
+
+        def flaky(rows):
+            calls.append(rows)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            insert(rows)
+
+        with mock.patch.object(importer, '_insert', flaky), self.assertRaises(KeyboardInterrupt):
+            call_command('import_chat', path, room='wa', batch_size=3, date_order='dmy', stdout=io.StringIO())
+        self.assertEqual(len(self.rows('wa')), 6)
+        out = io.StringIO()
+        call_command('import_chat', path, room='wa', batch_size=3, date_order='dmy', stdout=out)
+        self.assertIn('Resuming after 6 messages', out.getvalue())
+        self.assertEqual([c for _, c, _ in self.rows('wa')], [f'm{i}' for i in range(10)])
+        call_command('import_chat', path, room='wa', date_order='dmy', stdout=out)
+        self.assertEqual(len(self.rows('wa')), 10)
+
+    def test_month_first_export_is_detected(self):
+        path = self.write('chat.txt', '1/2/21, 9:00 - Ann: before\n12/31/2020, 21:41 - Ann: late\n')
+        call_command('import_chat', path, room='us', stdout=io.StringIO())
+        self.assertEqual([(t.month, t.day) for _, _, t in self.rows('us')], [(1, 2), (12, 31)])
+
+    def test_date_order_is_settled_before_inserting(self):
+        us = self.write('chat.txt', '1/2/21, 9:00 - Ann: before\n12/31/2020, 21:41 - Ann: late\n')
+        with self.assertRaisesMessage(CommandError, 'line 2: 12/31/2020 21:41 cannot be read as dmy'):
+            call_command('import_chat', us, room='us', date_order='dmy', stdout=io.StringIO())
+        ambiguous = self.write('ambiguous.txt', '1/2/21, 9:00 - Ann: hi\n3/4/21, 9:00 - Ann: there\n')
+        with self.assertRaisesMessage(CommandError, 'pass --date-order'):
+            call_command('import_chat', ambiguous, room='amb', stdout=io.StringIO())
+        self.assertFalse(Message.objects.exists())
+        call_command('import_chat', ambiguous, room='amb', date_order='mdy', stdout=io.StringIO())
+        self.assertEqual([(t.month, t.day) for _, _, t in self.rows('amb')], [(1, 2), (3, 4)])
+
+    def test_unreadable_line_is_named(self):
+        with self.assertRaisesMessage(importer.ExportError, 'line 2: 12/31/2020 21:41'):
+            list(importer.parse_whatsapp(['1/2/21, 9:00 - Ann: hi\n', '12/31/2020, 21:41 - Ann: hi\n']))
+        path = self.write('result.json', json.dumps({'messages': [{'id': 7, 'type': 'message', 'text': 'x',
+                                                                   'date': 'yesterday'}]}))
+        with self.assertRaisesMessage(CommandError, 'message 7: unreadable date'):
+            call_command('import_chat', path, room='tg', stdout=io.StringIO())
+
+    def test_refuses_room_with_messages(self):
+        Message.objects.create(room=Room.objects.create(name='wa', slug='wa'), author_name='a', content='live')
+        with self.assertRaisesMessage(CommandError, 'already has messages'):
+            call_command('import_chat', self.write('chat.txt', WHATSAPP_EXPORT), room='wa', stdout=io.StringIO())
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=True, RATELIMIT_BACKEND='core.ratelimit.MemoryBackend',
+                   RATELIMIT_RATES={'otp_ip': '3/h'})
+class RateLimitTests(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ratelimit, '_backend', ratelimit.MemoryBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 3600 * 1000.0
+        clock = mock.patch.object(ratelimit.time, 'time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        # Rejections are remembered per limiter, outside the backend
+        for view in (signup, signup.__wrapped__, verify, verify.__wrapped__):
+            view.limiter._blocked.clear()
+            self.addCleanup(view.limiter._blocked.clear)
+
+    def test_sliding_window(self):
+        backend = ratelimit.get_backend()
+        self.assertEqual(ratelimit.parse_rate('20/10s'), (20, 10))
+        self.assertEqual([backend.hit('k', 2, 60)[0] for _ in range(3)], [True, True, False])
+        # Halfway into the next window the previous one still counts for half
+        self.now += 90
+        self.assertEqual([backend.hit('k', 2, 60)[0] for _ in range(2)], [True, False])
+        allowed, retry_after = backend.hit('k', 2, 60)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 30)
+        # Two windows on, nothing is left
+        self.now += 120
+        self.assertEqual([backend.hit('k', 2, 60)[0] for _ in range(3)], [True, True, False])
+
+    def test_rejected_clients_skip_the_backend(self):
+        limiter = ratelimit.RateLimiter('t', '1/m')
+        self.assertEqual(limiter.check('a'), (True, 0.0))
+        self.assertFalse(limiter.check('a')[0])
+        with mock.patch.object(ratelimit.MemoryBackend, 'hit') as hit:
+            self.assertFalse(limiter.check('a')[0])
+        hit.assert_not_called()
+        self.assertTrue(limiter.check('b')[0])
+
+    def signup(self, **meta):
+        return self.client.post('/accounts/signup/', {}, **meta)
+
+    def test_verify_is_limited_per_phone(self):
+        def guess(phone, ip):
+            return self.client.post('/accounts/verify/', {'phone': phone, 'code': '000000'}, REMOTE_ADDR=ip).status_code
+
+        # From ever-changing addresses, so only the per-phone limit applies
+        statuses = [guess('+966 500', f'10.0.1.{i}') for i in range(11)]
+        self.assertNotIn(429, statuses[:10])
+        self.assertEqual(statuses[10], 429)
+        self.assertEqual(guess('+966500', '10.0.2.1'), 429)
+        self.assertNotEqual(guess('+966501', '10.0.2.1'), 429)
+
+    def test_view_answers_429_with_retry_after(self):
+        statuses = [self.signup(REMOTE_ADDR='10.0.0.1').status_code for _ in range(4)]
+        self.assertEqual(statuses, [200, 200, 200, 429])
+        response = self.signup(REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.json()['error'], 'rate_limited')
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(self.signup(REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    def test_spoofed_forwarded_for_does_not_reset_the_limit(self):
+        spoofed = [self.signup(REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=f'1.2.3.{i}').status_code
+                   for i in range(4)]
+        self.assertEqual(spoofed[-1], 429)
+        with override_settings(RATELIMIT_TRUSTED_PROXIES=1):
+            # Behind one proxy: the client controls everything left of the proxy's entry
+            statuses = [self.signup(REMOTE_ADDR='10.9.9.9', HTTP_X_FORWARDED_FOR=f'1.2.3.{i}, 5.6.7.8').status_code
+                        for i in range(4)]
+            self.assertEqual(statuses, [200, 200, 200, 429])
+            self.assertEqual(self.signup(REMOTE_ADDR='10.9.9.9', HTTP_X_FORWARDED_FOR='5.6.7.9').status_code, 200)
+
+
+class ArchiveTests(TransactionTestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='main', slug='main')
+        start = timezone.now() - timedelta(days=30)
+        self.messages = []
+        for i in range(10):
+            message = Message.objects.create(room=self.room, author_name=f'a{i}', content=f'm{i} «ü»')
+            Message.objects.filter(pk=message.pk).update(created_at=start + timedelta(days=i))
+            message.refresh_from_db()
+            self.messages.append(message)
+        self.ids = [m.id for m in self.messages]
+        self.cutoff = start + timedelta(days=8)
+
+    def archive(self, segment_size=4):
+        count = archive_conversation('room', self.room.id, self.cutoff, segment_size)
+        self.room.refresh_from_db()
+        return count
+
+    def test_segment_round_trip(self):
+        self.assertEqual((self.archive(), self.archive(), self.archive()), (4, 4, 0))
+        segments = list(ArchiveSegment.objects.filter(kind='room', conversation_id=self.room.id))
+        self.assertEqual([(s.first_id, s.last_id, s.count) for s in segments],
+                         [(self.ids[0], self.ids[3], 4), (self.ids[4], self.ids[7], 4)])
+        decoded = [m for s in segments for m in decode_segment(s)]
+        self.assertEqual([(m.id, m.room_id, m.author_name, m.content, m.created_at) for m in decoded],
+                         [(m.id, m.room_id, m.author_name, m.content, m.created_at) for m in self.messages[:8]])
+        # Only messages older than the cutoff move; the hot table keeps the rest
+        self.assertEqual(self.room.archived_through, self.ids[7])
+        self.assertEqual(list(self.room.messages.values_list('id', flat=True)), self.ids[8:])
+
+    def test_history_crosses_archived_through(self):
+        self.archive()
+        self.archive()
+        for kwargs, expected in [
+            ({'limit': 5}, self.ids[5:]),
+            ({'before': self.ids[9], 'limit': 3}, self.ids[6:9]),
+            ({'before': self.ids[8], 'limit': 2}, self.ids[6:8]),
+            ({'before': self.ids[5], 'limit': None}, self.ids[:5]),
+            ({'after': self.ids[5], 'limit': 3}, self.ids[6:9]),
+            ({'after': self.ids[7], 'limit': 5}, self.ids[8:]),
+            ({'after': 0, 'limit': None}, self.ids),
+        ]:
+            with self.subTest(**kwargs):
+                rows = room_history(self.room, **kwargs)
+                self.assertEqual([m.id for m in rows], expected)
+                tuples = room_history(self.room, columns=('id', 'content'), **kwargs)
+                self.assertEqual(tuples, [(m.id, m.content) for m in rows])
+
+    @override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False)
+    def test_poll_pages_forward(self):
+        self.archive()
+        self.client.force_login(User.objects.create_user(username='me'))
+        after, seen = 0, []
+        with mock.patch.object(api_views, 'DELTA_LIMIT', 4):
+            while True:
+                body = self.client.get(f'/api/v1/rooms/main/poll/?after={after}').json()
+                self.assertLessEqual(body['count'], 4)
+                seen += [m['id'] for m in body['messages']]
+                if not body['more']:
+                    break
+                after = seen[-1]
+        self.assertEqual(seen, self.ids)
+
+    def test_thread_history_loads_archived_authors(self):
+        me, other = User.objects.create_user(username='me'), User.objects.create_user(username='other')
+        thread, _ = DirectThread.get_or_create_for_users(me.id, other.id)
+        for author in (me, other, me):
+            DirectMessage.objects.create(thread=thread, author=author, content='hi')
+        archive_conversation('dm', thread.id, timezone.now() + timedelta(days=1), 2)
+        thread.refresh_from_db()
+        self.assertEqual([m.author.username for m in thread_history(thread)], ['me', 'other', 'me'])
+
+    @override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False)
+    def test_malformed_cursors_are_rejected(self):
+        self.client.force_login(User.objects.create_user(username='me'))
+        for url in ['/api/v1/rooms/main/messages/?before=x', '/api/v1/rooms/main/poll/?after=1e3',
+                    '/api/r/main/messages/?after=-1']:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/rooms/main/messages/?before=').status_code, 200)
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False)
+class ConditionalGetTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.room = Room.objects.create(name='main', slug='main')
+        self.me, self.other = User.objects.create_user(username='me'), User.objects.create_user(username='other')
+        self.thread, _ = DirectThread.get_or_create_for_users(self.me.id, self.other.id)
+        self.client.force_login(self.me)
+
+    def assertRevalidates(self, url, write):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        write()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def post_room_message(self):
+        self.client.post('/r/main/', {'author_name': 'a', 'content': 'hi'})
+
+    def test_room_messages(self):
+        self.assertRevalidates('/api/r/main/messages/', self.post_room_message)
+        self.assertRevalidates('/api/v1/rooms/main/poll/?after=0', self.post_room_message)
+
+    def test_room_messages_follow_archiving_and_edits(self):
+        self.post_room_message()
+        message = Message.objects.get()
+        staff = User.objects.create_user(username='staff', is_staff=True)
+        self.assertRevalidates('/api/r/main/messages/', lambda: edit_message(self.room, message.id, staff, 'edited'))
+        self.assertRevalidates('/api/v1/rooms/', lambda: edit_message(self.room, message.id, staff, 'again'))
+        self.assertRevalidates('/api/r/main/messages/', lambda: archive_conversation(
+            'room', self.room.id, timezone.now() + timedelta(days=1), 10,
+        ))
+
+    def test_unknown_room_is_404_whatever_the_etag(self):
+        for etag in ['W/"room-0-0"', 'W/"room-0-0-0"', '*']:
+            self.assertEqual(self.client.get('/api/r/nope/messages/', HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+    def test_thread_messages(self):
+        self.assertRevalidates(f'/api/dm/{self.other.id}/messages/', lambda: DirectMessage.objects.create(
+            thread=self.thread, author=self.other, content='hi',
+        ))
+
+    def test_room_list(self):
+        self.assertRevalidates('/api/v1/rooms/', self.post_room_message)
+        with CaptureQueriesContext(connections['default']) as queries:
+            etag = self.client.get('/api/v1/rooms/')['ETag']
+            count = len(queries)
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.assertEqual(self.client.get('/api/v1/rooms/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Only the session and user lookups; the validator itself reads the cache
+        self.assertLess(len(queries), count)
+        self.assertFalse(any('core_room' in q['sql'] for q in queries))
+
+    def test_thread_list(self):
+        url = '/api/v1/direct-threads/'
+        send = f'/api/v1/direct-threads/{self.thread.id}/send_message/'
+        self.assertRevalidates(url, lambda: self.client.post(send, {'content': 'hi'}))
+        message = DirectMessage.objects.get()
+        self.assertRevalidates(url, lambda: edit_message(self.thread, message.id, self.me, 'edited'))
+        self.assertRevalidates(url, lambda: self.client.post('/api/v1/direct-threads/get_or_create/', {
+            'user_id': User.objects.create_user(username='third').id,
+        }))
+        etag = self.client.get(url)['ETag']
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertFalse(any('core_direct' in q['sql'] for q in queries))
+
+
+@override_settings(ROOM_ACTIVITY_HALF_LIFE_HOURS=24)
+class DirectoryTests(TransactionTestCase):
+    def post(self, room, count, hours_ago):
+        at = timezone.now() - timedelta(hours=hours_ago)
+        ids = [Message.objects.create(room=room, author_name='a', content='hi').id for _ in range(count)]
+        Message.objects.filter(id__in=ids).update(created_at=at)
+        return list(Message.objects.filter(id__in=ids))
+
+    def test_busy_and_recent_rooms_rank_first(self):
+        quiet = Room.objects.create(name='quiet', slug='quiet')
+        stale = Room.objects.create(name='stale', slug='stale')
+        recent = Room.objects.create(name='recent', slug='recent')
+        busy = Room.objects.create(name='busy', slug='busy')
+        empty = Room.objects.create(name='empty', slug='empty')
+        self.post(quiet, 1, 48)
+        self.post(stale, 3, 72)  # 3 messages three half-lives ago weigh 3/8 of one now
+        self.post(recent, 1, 0)
+        self.post(busy, 4, 12)
+        rebuild_activity()
+        self.assertEqual([room.slug for room in ranked_rooms()], ['busy', 'recent', 'stale', 'quiet', 'empty'])
+
+    def test_recording_messages_matches_a_rebuild(self):
+        room = Room.objects.create(name='main', slug='main')
+        for hours_ago in (100, 30, 30, 2, 0):
+            record_messages(self.post(room, 1, hours_ago))
+        recorded = RoomActivity.objects.get(room=room)
+        record_messages(self.post(room, 2, 1))
+        self.assertGreater(RoomActivity.objects.get(room=room).rank, recorded.rank)
+        recorded = RoomActivity.objects.get(room=room)
+
+        rebuild_activity(batch_size=2)
+        rebuilt = RoomActivity.objects.get(room=room)
+        self.assertAlmostEqual(recorded.rank, rebuilt.rank, places=9)
+        self.assertEqual(recorded.last_message_id, rebuilt.last_message_id)
+        self.assertEqual(recorded.last_message_at, rebuilt.last_message_at)
+
+    def test_old_messages_do_not_move_the_last_message(self):
+        room = Room.objects.create(name='main', slug='main')
+        newest = self.post(room, 1, 0)
+        record_messages(newest)
+        record_messages(self.post(room, 1, 10))
+        self.assertEqual(RoomActivity.objects.get(room=room).last_message_at, newest[0].created_at)
+
+    def test_null_last_message_at_is_filled_in(self):
+        # GREATEST(NULL, x) is x on PostgreSQL but NULL on SQLite; both must end up with x
+        room = Room.objects.create(name='main', slug='main')
+        RoomActivity.objects.create(room=room, rank=0.0, last_message_at=None, updated_at=timezone.now())
+        messages = self.post(room, 1, 0)
+        record_messages(messages)
+        self.assertEqual(RoomActivity.objects.get(room=room).last_message_at, messages[0].created_at)
+
+    def test_seed_migration_weighs_like_the_directory(self):
+        migration = importlib.import_module('core.migrations.0006_roomactivity')
+        at = timezone.now()
+        self.assertEqual(migration.activity_weight(at), activity_weight(at))
+
+
+class FastSerializerTests(TransactionTestCase):
+    """The fast serializers encode to the same bytes as DRF's serializers and JSONRenderer."""
+
+    def setUp(self):
+        self.me = User.objects.create_user(username='me')
+        Profile.objects.create(user=self.me, phone='+10', name='\u0623\u0646\u0627')
+        self.other = User.objects.create_user(username='other')
+        self.room = Room.objects.create(name='main', slug='main')
+        Room.objects.create(name='empty', slug='empty')
+        Message.objects.create(room=self.room, author_name='a', content='x' * 80)
+        Message.objects.create(room=self.room, author_name='b', content='line\u2028break')
+        # Whole seconds drop the fraction from isoformat; the last message is nested in the room list
+        Message.objects.filter(pk=Message.objects.first().pk).update(
+            created_at=timezone.now().replace(microsecond=0),
+        )
+        Message.objects.filter(pk=Message.objects.last().pk).update(
+            created_at=timezone.now().replace(microsecond=123456),
+        )
+        self.thread, _ = DirectThread.get_or_create_for_users(self.me.id, self.other.id)
+        DirectThread.get_or_create_for_users(self.other.id, User.objects.create_user(username='third').id)
+        for author in (self.me, self.other):
+            DirectMessage.objects.create(thread=self.thread, author=author, content='hi ' * 30)
+
+    def drf(self, serializer_class, objects) -> bytes:
+        return JSONRenderer().render(serializer_class(objects, many=True).data)
+
+    def assertSameOutput(self):
+        self.assertEqual(
+            dumps(serialize_messages(Message.objects.values_list(*MESSAGE_COLUMNS))),
+            self.drf(MessageSerializer, Message.objects.all()),
+        )
+        self.assertEqual(
+            dumps(serialize_direct_messages(list(DirectMessage.objects.values_list(*DIRECT_MESSAGE_COLUMNS)))),
+            self.drf(DirectMessageSerializer, DirectMessage.objects.all()),
+        )
+        self.assertEqual(
+            dumps(serialize_rooms(room_rows(Room.objects.order_by('id')))),
+            self.drf(RoomSerializer, Room.objects.order_by('id')),
+        )
+        self.assertEqual(
+            dumps(serialize_threads(list(thread_rows(DirectThread.objects.order_by('id'))))),
+            self.drf(DirectThreadSerializer, DirectThread.objects.order_by('id')),
+        )
+
+    def test_same_bytes_as_drf(self):
+        self.assertSameOutput()
+
+    def test_same_bytes_in_another_time_zone(self):
+        # Top-level fields are converted to the current zone, nested ones are encoded as stored
+        with timezone.override('Asia/Riyadh'):
+            self.assertSameOutput()
+
+    def test_same_bytes_with_the_stdlib_encoder(self):
+        with mock.patch('core.fast_serializers.orjson', None):
+            self.assertSameOutput()
+
+
+@override_settings(COMPRESSION_MIN_SIZE=100)
+class CompressionTests(SimpleTestCase):
+    body = b'{"messages": ["hello"]}' * 50
+
+    def respond(self, response, accept='gzip, br'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept)
+        return compression.CompressionMiddleware(lambda request: response)(request)
+
+    def json(self, body=None):
+        return HttpResponse(self.body if body is None else body, content_type='application/json')
+
+    def test_negotiation(self):
+        self.assertEqual(compression.negotiate('gzip, br', 'application/json'), 'br')
+        self.assertEqual(compression.negotiate('br;q=0.5, gzip', 'application/json'), 'gzip')
+        self.assertEqual(compression.negotiate('*', 'application/json; charset=utf-8'), 'br')
+        self.assertEqual(compression.negotiate('gzip;q=0, identity', 'application/json'), None)
+        self.assertEqual(compression.negotiate('', 'application/json'), None)
+        # HTML carries the CSRF token: only the padded gzip
+        self.assertEqual(compression.negotiate('br', 'text/html; charset=utf-8'), None)
+        self.assertEqual(compression.negotiate('br, gzip', 'text/html; charset=utf-8'), 'gzip')
+
+    def test_compresses_and_varies(self):
+        response = self.respond(self.json())
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(response.content), self.body)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+
+        response = self.respond(HttpResponse(self.body, content_type='text/html'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), self.body)
+
+    def test_gzip_length_is_randomized(self):
+        responses = [self.respond(HttpResponse(self.body), accept='gzip') for _ in range(20)]
+        self.assertTrue(all(gzip.decompress(r.content) == self.body for r in responses))
+        self.assertGreater(len({len(r.content) for r in responses}), 1)
+
+    def test_small_incompressible_and_opted_out_bodies_stay_plain(self):
+        self.assertFalse(self.respond(self.json(b'{}')).has_header('Content-Encoding'))
+        self.assertFalse(self.respond(self.json(os.urandom(4096)), accept='gzip').has_header('Content-Encoding'))
+        response = self.json()
+        response.skip_compression = True
+        self.assertEqual(self.respond(response).content, self.body)
+        self.assertFalse(self.respond(self.json(), accept='identity').has_header('Content-Encoding'))
+
+    def test_no_compression_decorator(self):
+        view = compression.no_compression(lambda request: self.json())
+        self.assertTrue(view(None).skip_compression)
+
+    def test_streaming_responses_keep_streaming(self):
+        chunks = [b'{"n": %d}\n' % i * 20 for i in range(5)]
+        response = self.respond(StreamingHttpResponse(iter(chunks)), accept='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertFalse(response.has_header('Content-Length'))
+        decoder = zlib.decompressobj(31)
+        # Each chunk decodes on arrival, before the stream ends
+        parts = [decoder.decompress(part) for part in response.streaming_content]
+        self.assertEqual(parts[:len(chunks)], chunks)
+        self.assertEqual(b''.join(parts), b''.join(chunks))
+        self.assertTrue(decoder.eof)
+
+    def test_async_streaming(self):
+        async def chunks():
+            for i in range(3):
+                yield b'{"n": %d}\n' % i * 20
+
+        response = self.respond(StreamingHttpResponse(chunks(), content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'br')
+
+        async def read():
+            return b''.join([part async for part in response.streaming_content])
+
+        self.assertEqual(compression.brotli.decompress(async_to_sync(read)()),
+                         b''.join(b'{"n": %d}\n' % i * 20 for i in range(3)))
+
+
+@override_settings(STORAGES=PLAIN_STATIC, RATELIMIT_ENABLED=False, METRICS_TOKEN='secret',
+                   METRICS_ALLOWED_NETWORKS=['127.0.0.0/8', '10.0.0.0/8'])
+class MetricsTests(TransactionTestCase):
+    SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+    def scrape(self, **extra) -> dict:
+        """``{'name{labels}': value}`` of every sample, checking the exposition format on the way."""
+        response = self.client.get('/metrics', **extra)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        samples, typed = {}, {}
+        for line in response.content.decode().splitlines():
+            if line.startswith('# HELP '):
+                continue
+            if line.startswith('# TYPE '):
+                name, kind = line[7:].split(' ')
+                typed[name] = kind
+                continue
+            match = self.SAMPLE.match(line)
+            self.assertIsNotNone(match, line)
+            name = match[1]
+            family = re.sub(r'_(bucket|sum|count)$', '', name) if name not in typed else name
+            self.assertIn(family, typed, f'{name} has no TYPE line')
+            samples[name + (match[2] or '')] = float(match[3])
+        return samples
+
+    def test_only_private_unproxied_or_token_requests(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.9').status_code, 404)
+        # Through the proxy REMOTE_ADDR is the proxy's private address
+        self.assertEqual(self.client.get('/metrics', HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong',
+                                         REMOTE_ADDR='203.0.113.9').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret', REMOTE_ADDR='203.0.113.9',
+                                         HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 200)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ',
+                                             REMOTE_ADDR='203.0.113.9').status_code, 404)
+
+    def test_requests_and_messages_are_counted(self):
+        Room.objects.create(name='main', slug='main')
+        requests = 'http_requests_total{route="r/<str:slug>/",method="POST",status="302"}'
+        stored = 'chat_messages_total{kind="room",via="http"}'
+        before = self.scrape()
+        for i in range(3):
+            self.client.post('/r/main/', {'author_name': 'a', 'content': f'm{i}'})
+        after = self.scrape()
+        self.assertEqual(after[requests] - before.get(requests, 0), 3)
+        self.assertEqual(after[stored] - before.get(stored, 0), 3)
+
+    def test_histograms_are_cumulative(self):
+        self.client.get('/rooms/')
+        samples = self.scrape()
+        prefix = 'http_request_queries_bucket{route="rooms/",'
+        buckets = [value for key, value in samples.items() if key.startswith(prefix)]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(samples[prefix + 'le="+Inf"}'], samples['http_request_queries_count{route="rooms/"}'])
+        self.assertGreater(samples['http_request_queries_sum{route="rooms/"}'], 0)
+
+
+class NPlusOneConsumer(query_profiler.ConsumerQueryProfilerMixin, AsyncWebsocketConsumer):
+    """Counts each room's messages with one query per room."""
+
+    async def receive(self, text_data=None, bytes_data=None):
+        counts = await database_sync_to_async(lambda: [room.messages.count() for room in Room.objects.all()])()
+        await self.send(text_data=json.dumps(counts))
+
+
+@override_settings(QUERY_PROFILER_REPEAT_THRESHOLD=5, QUERY_PROFILER_MAX_QUERIES=30, QUERY_PROFILER_MAX_DB_MS=1e6)
+class QueryProfilerTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        query_profiler.enable()
+
+    def setUp(self):
+        for i in range(8):
+            Room.objects.create(name=f'room {i}', slug=f'room-{i}')
+
+    def n_plus_one_view(self, request):
+        return HttpResponse(str([room.messages.count() for room in Room.objects.all()]))
+
+    def request(self):
+        middleware = query_profiler.QueryProfilerMiddleware(self.n_plus_one_view)
+        return middleware(RequestFactory().get('/rooms/'))
+
+    def send_frame(self):
+        async def frame():
+            communicator = WebsocketCommunicator(NPlusOneConsumer.as_asgi(), '/ws/rooms/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_to(text_data='go')
+            await communicator.receive_from()
+            await communicator.disconnect()
+        async_to_sync(frame)()
+
+    @override_settings(QUERY_PROFILER_SAMPLE_RATE=1)
+    def test_view_flags_the_repeated_query(self):
+        with self.assertLogs('mysite.queries', 'WARNING') as logs:
+            response = self.request()
+        self.assertIn('db;dur=', response['Server-Timing'])
+        report = logs.output[0]
+        self.assertIn('GET /rooms/: 9 queries', report)
+        self.assertIn('(repeated)', report)
+        self.assertRegex(report, r'8x at core/tests\.py:\d+.*FROM "core_message"')
+
+    @override_settings(QUERY_PROFILER_SAMPLE_RATE=1)
+    def test_consumer_frame_flags_the_repeated_query(self):
+        with self.assertLogs('mysite.queries', 'WARNING') as logs:
+            self.send_frame()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('WS NPlusOneConsumer /ws/rooms/: 9 queries', logs.output[0])
+        self.assertRegex(logs.output[0], r'8x at core/tests\.py:\d+.*FROM "core_message"')
+
+    @override_settings(QUERY_PROFILER_SAMPLE_RATE=1, QUERY_PROFILER_REPEAT_THRESHOLD=10,
+                       QUERY_PROFILER_MAX_QUERIES=5)
+    def test_over_budget_is_logged(self):
+        with self.assertLogs('mysite.queries', 'WARNING') as logs:
+            self.request()
+        self.assertIn('9 queries', logs.output[0])
+        self.assertIn('(queries)', logs.output[0])
+        with override_settings(QUERY_PROFILER_MAX_QUERIES=30), self.assertNoLogs('mysite.queries'):
+            self.request()
+
+    @override_settings(QUERY_PROFILER_SAMPLE_RATE=0)
+    def test_sample_rate_zero_records_nothing(self):
+        with mock.patch.object(query_profiler, 'profile_queries', wraps=query_profiler.profile_queries) as profile, \
+                self.assertNoLogs('mysite.queries'):
+            response = self.request()
+            self.send_frame()
+        profile.assert_not_called()
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class SleepingSupervisor(workers.Supervisor):
+    """Workers that just sleep, so supervision is tested without booting daphne."""
+
+    def command(self, worker):
+        return [sys.executable, '-c', 'import time; time.sleep(60)']
+
+
+class WorkerSupervisorTests(SimpleTestCase):
+    def test_reuse_port_gives_each_worker_a_socket(self):
+        sockets = workers.bind_sockets('127.0.0.1', 0, 3, reuse_port=True)
+        self.addCleanup(lambda: [sock.close() for sock in sockets])
+        self.assertEqual(len({sock.getsockname() for sock in sockets}), 1)
+        self.assertEqual(len({sock.fileno() for sock in sockets}), 3)
+
+    def test_crashed_worker_is_restarted_and_all_stop(self):
+        supervisor = SleepingSupervisor('unused', '127.0.0.1', 0, 2, graceful_timeout=5)
+        with mock.patch('signal.signal'):
+            runner = threading.Thread(target=supervisor.run)
+            runner.start()
+        self.addCleanup(runner.join)
+        self.addCleanup(setattr, supervisor, 'stopping', True)
+
+        def wait_for(predicate):
+            deadline = time.monotonic() + 10
+            while not predicate():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+
+        wait_for(lambda: all(w.process for w in supervisor.workers))
+        crashed = supervisor.workers[0].process
+        with self.assertLogs('mysite.workers', 'WARNING'):
+            crashed.send_signal(signal.SIGKILL)
+            wait_for(lambda: supervisor.workers[0].process not in (None, crashed))
+        self.assertEqual(supervisor.workers[0].restarts, 1)
+        self.assertEqual(supervisor.workers[1].restarts, 0)
+
+        survivors = [w.process for w in supervisor.workers]
+        supervisor.stopping = True
+        runner.join(timeout=10)
+        self.assertTrue(all(p.poll() is not None for p in survivors))
+
+    def test_crash_looping_worker_leaves_the_reuse_port_group(self):
+        supervisor = SleepingSupervisor('unused', '127.0.0.1', 0, 2, reuse_port=True, graceful_timeout=5)
+        self.addCleanup(supervisor.stop)
+        worker = supervisor.workers[0]
+        supervisor.spawn(worker)
+        worker.process.kill()
+        worker.process.wait()
+        with self.assertLogs('mysite.workers', 'WARNING'):
+            supervisor.reap(worker, worker.started_at + 1)
+        # No socket for the kernel to queue connections on while nobody accepts them
+        self.assertIsNone(worker.sock)
+        self.assertEqual(supervisor.sockets, [supervisor.workers[1].sock])
+
+        supervisor.spawn(worker)
+        self.assertEqual(worker.sock.getsockname(), supervisor.workers[1].sock.getsockname())
+        self.assertEqual(len(supervisor.sockets), 2)
+
+        # A worker that ran for a while restarts at once on the socket it had
+        sock = worker.sock
+        worker.process.kill()
+        worker.process.wait()
+        with self.assertLogs('mysite.workers', 'WARNING'):
+            supervisor.reap(worker, worker.started_at + workers.MIN_UPTIME + 1)
+        self.assertIs(worker.sock, sock)
+
+    def test_in_memory_channel_layer_is_reported_first(self):
+        with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+            self.assertIn('channel layer', workers.shared_state_problems()[0])
@@ -12,4 +12,11 @@ urlpatterns = [
     path('connect/', views.connect, name='connect'),
     path('dm/', views.dm_list, name='dm_list'),
     path('dm/<int:user_id>/', views.dm_thread, name='dm_thread'),
+    path('api/dm/<int:user_id>/messages/', views.api_dm_messages, name='api_dm_messages'),
+    path('attachments/', views.upload_attachment, name='upload_attachment'),
+    path('attachments/<int:pk>/', views.attachment_status, name='attachment_status'),
+    path('attachments/<int:pk>/<str:variant>/', views.attachment_file, name='attachment_file'),
+    path('internal/db-stats/', views.db_stats, name='db_stats'),
+    path('internal/export/room/<str:slug>/', views.export_room, name='export_room'),
+    path('internal/export/dm/<int:thread_id>/', views.export_thread, name='export_thread'),
 ]
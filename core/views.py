@@ -1,61 +1,124 @@
-from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpRequest, HttpResponse, JsonResponse
-from django.views.decorators.http import require_http_methods
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_http_methods, require_POST
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
-from .models import Room, Message, DirectThread, DirectMessage
+from django.urls import reverse
+from uuid import uuid4
+from accounts.services import display_name
+from . import attachments, changes, export, imaging
+from .models import Attachment, Room, Message, DirectThread, DirectMessage
+from .archive import aroom_history, cursor_param, thread_history
+from .directory import ranked_rooms, record_messages
+from .fragments import (
+    fragment_context, bump_room_list, room_list_version, room_messages_version,
+    bump_dm_list, dm_list_version, thread_messages_version, set_thread_last_message,
+)
+from .fast_serializers import FastJsonResponse
+from .conditional import conditional_get, room_messages_etag, thread_messages_etag
+from .db_executor import stats as db_executor_stats, pool_stats
+from .ratelimit import ratelimit, user_or_ip
+from mysite.compression import no_compression
+from mysite.db_router import replica_reads
+from mysite.metrics import chat_messages
 import socket
 
+# Set by chat-sync.js once the service worker keeps the history in IndexedDB;
+# chat pages then skip rendering it and the client fetches only the delta
+CLIENT_HISTORY_COOKIE = 'chat_history'
+# Delta endpoints: the newest page when the client has nothing cached,
+# otherwise forward pages of at most DELTA_LIMIT after its last id.  Every page
+# carries the change seq, and ?since_seq=N adds the edits and deletions after N
+DELTA_INITIAL = 200
+DELTA_LIMIT = 500
+
+
+def _client_has_history(request: HttpRequest) -> bool:
+    return request.COOKIES.get(CLIENT_HISTORY_COOKIE) == '1'
+
+
+def _delta_window(request: HttpRequest) -> dict:
+    after = cursor_param(request.GET, 'after')
+    if after is None:
+        return {'limit': DELTA_INITIAL}
+    return {'after': after, 'limit': DELTA_LIMIT}
+
 
 def home(request: HttpRequest) -> HttpResponse:
     return render(request, 'core/home.html')
 
 
 @require_http_methods(["GET", "POST"])
+@replica_reads
 def room_list(request: HttpRequest) -> HttpResponse:
     if request.method == 'POST':
         name = (request.POST.get('name') or '').strip()
         if name:
-            room, _ = Room.objects.get_or_create(name=name)
+            room, created = Room.objects.get_or_create(name=name)
             if not room.slug:
                 room.save()
+            if created:
+                bump_room_list()
             return redirect('core:room_detail', slug=room.slug)
-    rooms = Room.objects.order_by('-created_at')
+    # Most active rooms first (see core.directory)
+    paginator = Paginator(ranked_rooms(), settings.ROOM_DIRECTORY_PAGE_SIZE)
+    rooms = paginator.get_page(request.GET.get('page', 1))
     return render(request, 'core/room_list.html', {'rooms': rooms})
 
 
 @require_http_methods(["GET", "POST"])
+@replica_reads
 def room_detail(request: HttpRequest, slug: str) -> HttpResponse:
-    room = get_object_or_404(Room, slug=slug)
+    room = get_object_or_404(Room.objects.select_related('activity'), slug=slug)
     if request.method == 'POST':
         author_name = (request.POST.get('author_name') or 'مجهول').strip() or 'مجهول'
         content = (request.POST.get('content') or '').strip()
         if content:
-            Message.objects.create(room=room, author_name=author_name, content=content)
+            author = request.user if request.user.is_authenticated else None
+            message = Message.objects.create(room=room, author=author, author_name=author_name, content=content)
+            record_messages([message])
+            chat_messages.labels('room', 'http').inc()
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
                 return JsonResponse({'ok': True})
             return redirect('core:room_detail', slug=room.slug)
-    messages = room.messages.all()[:200]
-    rooms = Room.objects.order_by('-created_at')[:50]
-    return render(request, 'core/room_detail.html', {'room': room, 'messages': messages, 'rooms': rooms})
+    # Lazy querysets: only evaluated when the cached fragments are cold
+    client_history = _client_has_history(request)
+    messages = [] if client_history else attachments.WithAttachments(room.messages.all()[:200], Attachment.KIND_ROOM)
+    rooms = ranked_rooms()[:settings.ROOM_SIDEBAR_SIZE]
+    return render(request, 'core/room_detail.html', {
+        'room': room, 'chat_messages': messages, 'rooms': rooms, 'client_history': client_history,
+        'messages_version': room_messages_version(room),
+        'rooms_version': room_list_version(),
+        **fragment_context(),
+    })
 
 
-def api_messages(request: HttpRequest, slug: str) -> JsonResponse:
-    room = get_object_or_404(Room, slug=slug)
-    after_id = int(request.GET.get('after', 0))
-    qs = room.messages.filter(id__gt=after_id).values('id', 'author_name', 'content', 'created_at')
+@replica_reads
+@conditional_get(room_messages_etag)
+async def api_messages(request: HttpRequest, slug: str) -> HttpResponse:
+    room = await aget_object_or_404(Room, slug=slug)
+    window = _delta_window(request)
+    rows = await aroom_history(room, columns=('id', 'author_name', 'content', 'created_at'), **window)
     data = [
         {
-            'id': m['id'],
-            'author_name': m['author_name'],
-            'content': m['content'],
-            'created_at': m['created_at'].isoformat(),
+            'id': pk,
+            'author_name': author_name,
+            'content': content,
+            'created_at': created_at.isoformat(),
         }
-        for m in qs
+        for pk, author_name, content, created_at in rows
     ]
-    return JsonResponse({'messages': data})
+    await attachments.aadd_pointers(Attachment.KIND_ROOM, data)
+    return FastJsonResponse({
+        'messages': data, 'more': len(rows) == window['limit'], **await changes.adelta_fields(request, room),
+    })
 
 
 def _lan_ips() -> list[str]:
@@ -93,10 +156,14 @@ def connect(request: HttpRequest) -> HttpResponse:
 
 
 @login_required
+@replica_reads
 def dm_list(request: HttpRequest) -> HttpResponse:
     me = request.user
-    threads = DirectThread.objects.filter(Q(user1=me) | Q(user2=me)).order_by('-created_at')
-    return render(request, 'core/dm_list.html', {'threads': threads})
+    threads = (DirectThread.objects.filter(Q(user1=me) | Q(user2=me))
+               .select_related('user1__profile', 'user2__profile').order_by('-created_at'))
+    return render(request, 'core/dm_list.html', {
+        'threads': threads, 'threads_version': dm_list_version(me.id), **fragment_context(),
+    })
 
 
 @login_required
@@ -107,14 +174,183 @@ def dm_thread(request: HttpRequest, user_id: int) -> HttpResponse:
     if me.id == other.id:
         return redirect('core:dm_list')
     # get or create deterministic order
-    u1, u2 = (me, other) if me.id <= other.id else (other, me)
-    thread, _ = DirectThread.objects.get_or_create(user1=u1, user2=u2)
+    thread, created = DirectThread.get_or_create_for_users(me.id, other.id)
+    if created:
+        bump_dm_list(me.id, other.id)
     if request.method == 'POST':
         content = (request.POST.get('content') or '').strip()
         if content:
-            DirectMessage.objects.create(thread=thread, author=me, content=content)
+            message = DirectMessage.objects.create(thread=thread, author=me, content=content)
+            set_thread_last_message(message)
+            chat_messages.labels('dm', 'http').inc()
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
                 return JsonResponse({'ok': True})
             return redirect('core:dm_thread', user_id=other.id)
-    msgs = thread.messages.select_related('author').all()[:500]
-    return render(request, 'core/dm_thread.html', {'thread': thread, 'other': other, 'messages': msgs})
+    client_history = _client_has_history(request)
+    msgs = [] if client_history else attachments.WithAttachments(
+        thread.messages.select_related('author').all()[:500], Attachment.KIND_DM,
+    )
+    return render(request, 'core/dm_thread.html', {
+        'thread': thread, 'other': other, 'chat_messages': msgs, 'client_history': client_history,
+        'messages_version': thread_messages_version(thread), **fragment_context(),
+    })
+
+
+@login_required
+@replica_reads
+@conditional_get(thread_messages_etag)
+def api_dm_messages(request: HttpRequest, user_id: int) -> HttpResponse:
+    """DM delta endpoint; rows match the websocket frames of DirectMessageConsumer."""
+    u1, u2 = DirectThread.ordered_ids(request.user.id, user_id)
+    thread = get_object_or_404(DirectThread, user1_id=u1, user2_id=u2)
+    window = _delta_window(request)
+    rows = thread_history(thread, columns=('id', 'author_id', 'content', 'created_at'), **window)
+    authors = {
+        pk: (username, name or username)
+        for pk, username, name in User.objects.filter(id__in=[u1, u2]).values_list('id', 'username', 'profile__name')
+    }
+    data = [
+        {
+            'id': pk,
+            'author': authors[author_id][0],
+            'author_name': authors[author_id][1],
+            'content': content,
+            'created_at': created_at.isoformat(),
+        }
+        for pk, author_id, content, created_at in rows
+    ]
+    attachments.add_pointers(Attachment.KIND_DM, data)
+    return FastJsonResponse({
+        'messages': data, 'more': len(rows) == window['limit'], **changes.delta_fields(request, thread),
+    })
+
+
+@csrf_exempt
+@login_required
+@require_POST
+@ratelimit('attachment_upload', '20/m', key=user_or_ip)
+def upload_attachment(request: HttpRequest) -> HttpResponse:
+    """Image upload: multipart ``file`` plus ``room`` (slug) or ``user`` (peer id), optional ``caption``.
+
+    Answers 202 right away; the message showing the image is posted to the
+    conversation once its variants are made (see ``core.attachments``).
+    """
+    max_bytes = settings.ATTACHMENT_MAX_BYTES
+    content_length = request.META.get('CONTENT_LENGTH') or '0'
+    if not content_length.isascii() or not content_length.isdigit():
+        return JsonResponse({'error': 'invalid_content_length'}, status=400)
+    # Refuse what is announced as too large before reading any of it
+    if int(content_length) > max_bytes + 64 * 1024:
+        return JsonResponse({'error': 'too_large', 'max_bytes': max_bytes}, status=413)
+    # The handlers must be swapped before anything reads the body, CSRF included
+    request.upload_handlers = [attachments.CappedUploadHandler(request, max_bytes)]
+    return _upload_attachment(request)
+
+
+@csrf_protect
+def _upload_attachment(request: HttpRequest) -> HttpResponse:
+    me = request.user
+    upload = request.FILES.get('file')
+    if request.upload_handlers[0].too_large:
+        return JsonResponse({'error': 'too_large', 'max_bytes': settings.ATTACHMENT_MAX_BYTES}, status=413)
+    if upload is None:
+        return JsonResponse({'error': 'file_required'}, status=400)
+    try:
+        content_type, width, height = imaging.probe(upload.temporary_file_path(), settings.ATTACHMENT_MAX_PIXELS)
+    except imaging.InvalidImage:
+        return JsonResponse({'error': 'invalid_image'}, status=400)
+
+    author_name = display_name(me)
+    if request.POST.get('room'):
+        room = get_object_or_404(Room, slug=request.POST['room'])
+        kind, conversation_id = Attachment.KIND_ROOM, room.id
+        author_name = (request.POST.get('author_name') or '').strip()[:50] or author_name
+    elif (request.POST.get('user') or '').isdigit() and int(request.POST['user']) != me.id:
+        other = get_object_or_404(User, id=int(request.POST['user']))
+        thread, created = DirectThread.get_or_create_for_users(me.id, other.id)
+        if created:
+            bump_dm_list(me.id, other.id)
+        kind, conversation_id = Attachment.KIND_DM, thread.id
+    else:
+        return JsonResponse({'error': 'room_or_user_required'}, status=400)
+
+    attachment = Attachment(
+        uploader=me, kind=kind, conversation_id=conversation_id, author_name=author_name,
+        caption=(request.POST.get('caption') or '').strip(),
+        content_type=content_type, size=upload.size, width=width, height=height,
+    )
+    # Moved, not copied, out of the temporary upload file
+    attachment.file.save(f'{uuid4().hex}{attachments.EXTENSIONS[content_type]}', upload, save=False)
+    attachment.save()
+    transaction.on_commit(lambda: attachments.schedule(attachment))
+    return JsonResponse({
+        'id': attachment.id,
+        'status': attachment.status,
+        'status_url': reverse('core:attachment_status', args=[attachment.id]),
+    }, status=202)
+
+
+@login_required
+def attachment_status(request: HttpRequest, pk: int) -> JsonResponse:
+    """Processing state of one of the user's uploads."""
+    attachment = get_object_or_404(Attachment, pk=pk, uploader=request.user)
+    data = {'id': attachment.id, 'status': attachment.status, 'message_id': attachment.message_id}
+    if attachment.status == Attachment.STATUS_READY:
+        data['attachment'] = attachments.pointer(attachment)
+    return JsonResponse(data)
+
+
+@require_http_methods(["GET", "HEAD"])
+@no_compression
+async def attachment_file(request: HttpRequest, pk: int, variant: str) -> HttpResponse:
+    """The original upload or one of its variants, with range requests; DM images only for the two users."""
+    attachment = await aget_object_or_404(Attachment, pk=pk, status=Attachment.STATUS_READY)
+    if attachment.kind == Attachment.KIND_DM:
+        user = await request.auser()
+        if not user.is_authenticated or not await DirectThread.objects.filter(
+            Q(user1_id=user.id) | Q(user2_id=user.id), id=attachment.conversation_id,
+        ).aexists():
+            raise Http404
+    if variant == 'original':
+        name, content_type = attachment.file.name, attachment.content_type
+    elif variant in attachment.variants:
+        name, content_type = attachment.variants[variant]['name'], attachment.variants[variant]['content_type']
+    else:
+        raise Http404
+    return attachments.ranged_response(
+        request, attachment.file.storage.path(name), content_type,
+        etag=f'"a{attachment.id}-{variant}"', private=attachment.kind == Attachment.KIND_DM,
+    )
+
+
+@staff_member_required
+def db_stats(request: HttpRequest) -> JsonResponse:
+    """DB executor queue waits and connection pool usage, for sizing the pool."""
+    return JsonResponse({'executor': db_executor_stats.snapshot(), 'pools': pool_stats()})
+
+
+def _export_response(request: HttpRequest, conversation) -> HttpResponse:
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in export.CONTENT_TYPES:
+        return JsonResponse({'error': f'format must be one of {", ".join(export.CONTENT_TYPES)}'}, status=400)
+    gzip = request.GET.get('gzip') == '1'
+    response = StreamingHttpResponse(
+        export.aexport_chunks(conversation, fmt, gzip),
+        content_type='application/gzip' if gzip else f'{export.CONTENT_TYPES[fmt]}; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export.filename(conversation, fmt, gzip)}"'
+    # Already compressed; otherwise the middleware may still gzip it in transit
+    response.skip_compression = gzip
+    return response
+
+
+@staff_member_required
+async def export_room(request: HttpRequest, slug: str) -> HttpResponse:
+    """Whole room history as NDJSON or CSV (``?format=``), gzipped with ``?gzip=1``; streamed."""
+    return _export_response(request, await aget_object_or_404(Room, slug=slug))
+
+
+@staff_member_required
+async def export_thread(request: HttpRequest, thread_id: int) -> HttpResponse:
+    """Same as ``export_room`` for a DM thread."""
+    return _export_response(request, await aget_object_or_404(DirectThread, pk=thread_id))
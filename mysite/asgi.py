@@ -21,6 +21,9 @@ django_asgi_app = get_asgi_application()
 
 # Import routing after Django is set up
 from core.routing import websocket_urlpatterns
+from mysite import startup
+
+startup.start()
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
@@ -0,0 +1,189 @@
+"""Content-negotiated gzip/brotli compression for dynamic responses.
+
+``CompressionMiddleware`` replaces Django's ``GZipMiddleware``: it picks the
+best encoding the client accepts (brotli when the ``brotli`` package is
+installed, else gzip), leaves responses under ``COMPRESSION_MIN_SIZE`` bytes
+alone and compresses streaming responses chunk by chunk with a flush after
+each one, so they keep streaming.  Views opt out with ``@no_compression``.
+Static files never reach it; WhiteNoise serves its own precompressed copies.
+
+Against BREACH (guessing a secret in a page, such as the CSRF token, from
+the compressed size of responses that also reflect attacker input), gzip
+output carries a random-length file name in its header, as Django's
+``GZipMiddleware`` does, so the size leaks nothing across a few requests.
+Brotli has no such header and is only used for JSON, which holds no
+secrets; HTML always gets the padded gzip.
+"""
+import secrets
+import struct
+import zlib
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - gzip only
+    brotli = None
+
+# Responses that may be brotli-compressed: no secrets next to reflected input, see above
+BROTLI_CONTENT_TYPES = ('application/json',)
+
+
+def no_compression(view):
+    """Serve a function view or viewset method uncompressed."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            response = await view(*args, **kwargs)
+            response.skip_compression = True
+            return response
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = view(*args, **kwargs)
+        response.skip_compression = True
+        return response
+    return wrapper
+
+
+def supported_encodings(content_type: str) -> tuple:
+    """Encodings we can produce for ``content_type``, in order of preference."""
+    if brotli is not None and content_type.partition(';')[0].strip().lower() in BROTLI_CONTENT_TYPES:
+        return ('br', 'gzip')
+    return ('gzip',)
+
+
+def negotiate(accept_encoding: str, content_type: str):
+    """The preferred encoding for ``content_type`` allowed by an Accept-Encoding header, or None."""
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in supported_encodings(content_type):
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def gzip_header() -> bytes:
+    """A gzip member header (no mtime) with a random-length file name of up to ``COMPRESSION_MAX_RANDOM_BYTES``."""
+    max_random_bytes = settings.COMPRESSION_MAX_RANDOM_BYTES
+    name = b'a' * secrets.randbelow(max_random_bytes) if max_random_bytes else b''
+    # magic, deflate, FNAME flag, mtime 0, no extra flags, OS unknown
+    return b'\x1f\x8b\x08\x08' + bytes(4) + b'\x00\xff' + name + b'\x00'
+
+
+class _GzipStream:
+    """Raw deflate wrapped in a gzip member by hand, so the header can carry the padding."""
+
+    def __init__(self):
+        self._deflate = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._header = gzip_header()
+        self._crc = self._size = 0
+
+    def process(self, data: bytes) -> bytes:
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        return self._take_header() + self._deflate.compress(data)
+
+    def flush(self) -> bytes:
+        return self._take_header() + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return (self._take_header() + self._deflate.flush()
+                + struct.pack('<II', self._crc, self._size & 0xFFFFFFFF))
+
+    def _take_header(self) -> bytes:
+        header, self._header = self._header, b''
+        return header
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        if encoding == 'br':
+            impl = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+        else:
+            impl = _GzipStream()
+        self._process, self._flush, self._finish = impl.process, impl.flush, impl.finish
+
+    def chunk(self, data: bytes) -> bytes:
+        """Compress ``data`` and flush it so the client can decode it right away."""
+        return self._process(data) + self._flush()
+
+    def finish(self) -> bytes:
+        return self._finish()
+
+
+def compress_bytes(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    compressor = _GzipStream()
+    return compressor.process(data) + compressor.finish()
+
+
+def compress_stream(chunks, encoding: str):
+    compressor = _Compressor(encoding)
+    for data in chunks:
+        if data:
+            yield compressor.chunk(data)
+    yield compressor.finish()
+
+
+async def acompress_stream(chunks, encoding: str):
+    compressor = _Compressor(encoding)
+    async for data in chunks:
+        if data:
+            yield compressor.chunk(data)
+    yield compressor.finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    def process_response(self, request, response):
+        if getattr(response, 'skip_compression', False):
+            return response
+        # Not worth it for small bodies
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        if response.has_header('Content-Encoding') or response.has_header('Content-Range'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''), response.get('Content-Type', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            # Bind the current iterator; streaming_content may be replaced later
+            if response.is_async:
+                response.streaming_content = acompress_stream(response.streaming_content, encoding)
+            else:
+                response.streaming_content = compress_stream(response.streaming_content, encoding)
+            # The compressed size is unknown until the stream ends
+            del response.headers['Content-Length']
+        else:
+            compressed = compress_bytes(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # A compressed body is a different representation: weaken strong ETags
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
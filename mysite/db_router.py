@@ -0,0 +1,145 @@
+"""Primary/replica database routing.
+
+Writes always go to ``default``.  Reads go to one of
+``settings.DATABASE_REPLICAS`` only while a view decorated with
+``@replica_reads`` handles a safe (GET/HEAD) request and the client has not
+written recently.  After a write, ``ReplicaPinMiddleware`` pins the client
+to the primary for ``REPLICA_PIN_SECONDS`` (a cookie for the browser plus a
+cache flag for the user, which websocket writes set through ``pin_user``)
+so it always reads its own writes.  With no replicas configured everything
+here is a no-op.
+"""
+import random
+from functools import wraps
+
+from asgiref.local import Local
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+
+PIN_COOKIE = 'dbpin'
+PIN_KEY = 'dbpin:u{}'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = Local()
+
+
+def _replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def _pin_seconds() -> int:
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+def pin_user(user_id) -> None:
+    """Keep ``user_id`` on the primary for the pin window (e.g. after a socket write)."""
+    if _replicas() and user_id:
+        cache.set(PIN_KEY.format(user_id), 1, timeout=_pin_seconds())
+
+
+async def apin_user(user_id) -> None:
+    if _replicas() and user_id:
+        await cache.aset(PIN_KEY.format(user_id), 1, timeout=_pin_seconds())
+
+
+def _is_pinned(request) -> bool:
+    if PIN_COOKIE in request.COOKIES:
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user is not None and user.is_authenticated and cache.get(PIN_KEY.format(user.pk)))
+
+
+async def _ais_pinned(request) -> bool:
+    if PIN_COOKIE in request.COOKIES:
+        return True
+    user = await request.auser()
+    return bool(user.is_authenticated and await cache.aget(PIN_KEY.format(user.pk)))
+
+
+def replica_reads(view):
+    """Serve the reads of a function view or viewset method from a replica."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if not _replicas() or request.method not in SAFE_METHODS or await _ais_pinned(request):
+                return await view(request, *args, **kwargs)
+            previous = getattr(_state, 'use_replica', False)
+            _state.use_replica = True
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                _state.use_replica = previous
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        request = next(a for a in args if hasattr(a, 'META'))
+        if not _replicas() or request.method not in SAFE_METHODS or _is_pinned(request):
+            return view(*args, **kwargs)
+        previous = getattr(_state, 'use_replica', False)
+        _state.use_replica = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _state.use_replica = previous
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = _replicas()
+        if replicas and getattr(_state, 'use_replica', False):
+            return random.choice(replicas)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in _replicas()
+
+
+class ReplicaPinMiddleware:
+    """Pin clients that just wrote to the primary for a short while."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        _state.wrote = False
+        response = self.get_response(request)
+        if _replicas() and getattr(_state, 'wrote', False):
+            self._set_cookie(response)
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_user(user.pk)
+        _state.wrote = False
+        return response
+
+    async def __acall__(self, request):
+        # ORM calls made through sync_to_async hand their context changes back, so ``wrote`` is seen here
+        _state.wrote = False
+        response = await self.get_response(request)
+        if _replicas() and getattr(_state, 'wrote', False):
+            self._set_cookie(response)
+            user = await request.auser()
+            if user.is_authenticated:
+                await apin_user(user.pk)
+        _state.wrote = False
+        return response
+
+    @staticmethod
+    def _set_cookie(response) -> None:
+        response.set_cookie(PIN_COOKIE, '1', max_age=_pin_seconds(), httponly=True, samesite='Lax')
@@ -0,0 +1,114 @@
+"""Graceful websocket drain when a worker is stopped.
+
+Without it every socket of a stopping worker drops at the same instant, and
+every client reconnects and reloads its history together.  On SIGTERM (from
+``manage.py serve`` or the platform) the worker instead:
+
+* answers ``/healthz`` with 503 and refuses new websocket handshakes;
+* sends each open socket a ``reconnect`` control frame with ``after_ms``, a
+  delay drawn at random from ``WS_DRAIN_SPREAD_MS``, and ``cursor``, the id
+  of the last message it delivered, then closes it with ``CLOSE_CODE``,
+  so the clients come back spread over that window and only ask for the
+  messages after their cursor;
+* then hands the signal on to the server's own handler, which shuts down
+  as before.
+
+The handler is installed by the first socket that connects, from inside the
+server's event loop.
+"""
+import asyncio
+import json
+import logging
+import random
+import signal
+import threading
+import weakref
+
+from django.conf import settings
+
+logger = logging.getLogger('mysite.drain')
+
+# 1012 (service restart) would fit, but servers may only send 1000 or 3000-4999
+CLOSE_CODE = 4012
+# Lets the close frames go out before the server stops the loop
+FLUSH_SECONDS = 1.0
+
+_consumers = weakref.WeakSet()
+_draining = False
+_previous_handler = None
+_installed = False
+
+
+def is_draining() -> bool:
+    return _draining
+
+
+def reconnect_delay_ms() -> int:
+    return random.randint(settings.WS_DRAIN_MIN_MS, max(settings.WS_DRAIN_MIN_MS, settings.WS_DRAIN_SPREAD_MS))
+
+
+def install() -> None:
+    """Route SIGTERM through ``drain``; must run on the event loop's (main) thread."""
+    global _installed, _previous_handler
+    if _installed or threading.current_thread() is not threading.main_thread():
+        return
+    _installed = True
+    loop = asyncio.get_running_loop()
+    _previous_handler = signal.getsignal(signal.SIGTERM)
+
+    def handle(signum, frame):
+        loop.call_soon_threadsafe(lambda: loop.create_task(drain(resignal=True)))
+
+    signal.signal(signal.SIGTERM, handle)
+
+
+async def drain(resignal: bool = False) -> int:
+    """Ask every open socket to reconnect elsewhere and close it; returns how many were open."""
+    global _draining
+    if _draining:
+        return 0
+    _draining = True
+    consumers = list(_consumers)
+    logger.info('Draining %s websockets over up to %s ms', len(consumers), settings.WS_DRAIN_SPREAD_MS)
+    results = await asyncio.gather(*(consumer.drain() for consumer in consumers), return_exceptions=True)
+    for error in results:
+        if isinstance(error, Exception):
+            logger.warning('Draining a websocket failed: %s', error)
+    if resignal:
+        await asyncio.sleep(FLUSH_SECONDS)
+        signal.signal(signal.SIGTERM, _previous_handler if _previous_handler is not None else signal.SIG_DFL)
+        signal.raise_signal(signal.SIGTERM)
+    return len(consumers)
+
+
+class ConsumerDrainMixin:
+    """Take part in the drain: refuse handshakes while draining, answer ``drain``.
+
+    Consumers set ``resume_cursor`` to the id of each message they send.
+    """
+
+    resume_cursor = None
+
+    async def websocket_connect(self, message):
+        install()
+        if _draining:
+            await self.close(code=CLOSE_CODE)
+            return
+        await super().websocket_connect(message)
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        _consumers.add(self)
+
+    async def websocket_disconnect(self, message):
+        _consumers.discard(self)
+        await super().websocket_disconnect(message)
+
+    async def drain(self) -> None:
+        _consumers.discard(self)
+        await self.send(text_data=json.dumps({
+            'type': 'reconnect',
+            'after_ms': reconnect_delay_ms(),
+            'cursor': self.resume_cursor,
+        }))
+        await self.close(code=CLOSE_CODE)
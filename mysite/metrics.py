@@ -0,0 +1,422 @@
+"""Prometheus metrics for the chat server, exposed at ``/metrics``.
+
+A small in-process registry (counters, gauges and fixed-bucket histograms)
+rendered in the Prometheus text format, so there is no client library to
+install and recording a sample is a dict lookup plus a locked add.
+
+Sources:
+
+* ``MetricsMiddleware``: latency, status, query count and DB time per URL
+  route (the route pattern, not the path, so label values stay bounded);
+* every database query, through an execute wrapper installed on each new
+  connection; queries made while a request is being handled are added to
+  that request's tally, including ones run in ``sync_to_async`` threads;
+* ``ConsumerMetricsMixin``: websocket connects, disconnects, open sockets,
+  inbound and outbound frames and ``group_send`` latency per consumer;
+  outbound frames divided by ``chat_messages_total`` is the mean fan-out;
+* the OTP sender (``accounts.services``) and the DB executor / connection
+  pool counters, read at scrape time.
+
+Values are per process: with several workers, scrape each one or let the
+scraper sum them.  ``metrics_view`` answers only requests carrying
+``METRICS_TOKEN`` or coming straight from ``METRICS_ALLOWED_NETWORKS``.
+"""
+import bisect
+import hmac
+import ipaddress
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+_registry: List['_Metric'] = []
+_collectors: List[Callable[[], Iterable[Tuple[str, str, str, list]]]] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, key, child) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for key, child in list(self._children.items()):
+            yield from self._samples(key, child)
+
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self, key, child):
+        yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self, key, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = f'le="{_format_value(float(bound))}"'
+            yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}'
+        labels = _format_labels(self.labelnames, key)
+        yield f'{self.name}_sum{labels} {_format_value(total)}'
+        yield f'{self.name}_count{labels} {cumulative}'
+
+
+def register_collector(func: Callable[[], Iterable[Tuple[str, str, str, list]]]) -> None:
+    """Add a scrape-time source yielding ``(name, type, help, [(labels dict, value)])``."""
+    _collectors.append(func)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, kind, documentation, samples in collector():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+http_requests = Counter(
+    'http_requests_total', 'HTTP responses by route, method and status.', ('route', 'method', 'status'))
+http_latency = Histogram(
+    'http_request_duration_seconds', 'Time to produce the response, by route.', ('route',))
+http_queries = Histogram(
+    'http_request_queries', 'Database queries per request, by route.', ('route',), buckets=COUNT_BUCKETS)
+http_db_time = Histogram(
+    'http_request_db_seconds', 'Database time per request, by route.', ('route',), buckets=FAST_BUCKETS)
+db_queries = Histogram(
+    'db_query_duration_seconds', 'Duration of every database query, by alias.', ('alias',), buckets=FAST_BUCKETS)
+
+ws_connects = Counter('ws_connects_total', 'Websocket handshakes received.', ('consumer',))
+ws_disconnects = Counter('ws_disconnects_total', 'Websocket connections closed.', ('consumer',))
+ws_open = Gauge('ws_open_connections', 'Websocket connections currently accepted.', ('consumer',))
+ws_frames_in = Counter('ws_frames_received_total', 'Inbound websocket frames.', ('consumer',))
+ws_frames_out = Counter('ws_frames_sent_total', 'Outbound websocket frames.', ('consumer',))
+group_send_latency = Histogram(
+    'channel_layer_group_send_seconds', 'Channel layer group_send latency, by sender.', ('source',),
+    buckets=FAST_BUCKETS)
+chat_messages = Counter(
+    'chat_messages_total', 'Messages stored, by conversation kind and write path.', ('kind', 'via'))
+chat_message_changes = Counter(
+    'chat_message_changes_total', 'Message edits and deletions, by conversation kind.', ('kind', 'action'))
+
+otp_sends = Counter('otp_send_total', 'OTP delivery attempts, by result.', ('result',))
+otp_latency = Histogram('otp_send_duration_seconds', 'Time spent calling the OTP provider.')
+
+
+# ---------------------------------------------------------------------------
+# Database queries
+# ---------------------------------------------------------------------------
+
+# [queries, seconds] of the request being handled; a list so threads started
+# with a copy of the context still add to the same tally
+_request_tally: ContextVar[Optional[list]] = ContextVar('metrics_request_tally', default=None)
+
+
+def _make_query_wrapper(alias: str):
+    observe = db_queries.labels(alias).observe
+
+    def record_query(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            observe(duration)
+            tally = _request_tally.get()
+            if tally is not None:
+                tally[0] += 1
+                tally[1] += duration
+
+    record_query.is_metrics_wrapper = True
+    return record_query
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if not any(getattr(w, 'is_metrics_wrapper', False) for w in connection.execute_wrappers):
+        connection.execute_wrappers.append(_make_query_wrapper(connection.alias))
+
+
+connection_created.connect(_instrument_connection, dispatch_uid='mysite.metrics.instrument_connection')
+
+
+# ---------------------------------------------------------------------------
+# HTTP
+# ---------------------------------------------------------------------------
+
+def _route(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+class MetricsMiddleware:
+    """Record latency, status and DB usage of every request, sync or async."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        tally = [0, 0.0]
+        token = _request_tally.set(tally)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_tally.reset(token)
+        self._record(request, response, time.perf_counter() - started, tally)
+        return response
+
+    async def __acall__(self, request):
+        tally = [0, 0.0]
+        token = _request_tally.set(tally)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_tally.reset(token)
+        self._record(request, response, time.perf_counter() - started, tally)
+        return response
+
+    @staticmethod
+    def _record(request, response, duration: float, tally: list) -> None:
+        route = _route(request)
+        http_requests.labels(route, request.method, response.status_code).inc()
+        http_latency.labels(route).observe(duration)
+        http_queries.labels(route).observe(tally[0])
+        http_db_time.labels(route).observe(tally[1])
+
+
+# ---------------------------------------------------------------------------
+# Websockets
+# ---------------------------------------------------------------------------
+
+class ConsumerMetricsMixin:
+    """Connection, frame and ``group_send`` metrics for websocket consumers.
+
+    Put it first in the bases and send to groups with ``timed_group_send``.
+    """
+
+    _metrics_accepted = False
+
+    @property
+    def metrics_label(self) -> str:
+        return type(self).__name__
+
+    async def websocket_connect(self, message):
+        ws_connects.labels(self.metrics_label).inc()
+        await super().websocket_connect(message)
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        if not self._metrics_accepted:
+            self._metrics_accepted = True
+            ws_open.labels(self.metrics_label).inc()
+
+    async def websocket_receive(self, message):
+        ws_frames_in.labels(self.metrics_label).inc()
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        ws_disconnects.labels(self.metrics_label).inc()
+        if self._metrics_accepted:
+            self._metrics_accepted = False
+            ws_open.labels(self.metrics_label).dec()
+        await super().websocket_disconnect(message)
+
+    async def send(self, *args, **kwargs):
+        ws_frames_out.labels(self.metrics_label).inc()
+        await super().send(*args, **kwargs)
+
+    async def timed_group_send(self, group: str, message: dict) -> None:
+        started = time.perf_counter()
+        await self.channel_layer.group_send(group, message)
+        group_send_latency.labels(self.metrics_label).observe(time.perf_counter() - started)
+
+
+# ---------------------------------------------------------------------------
+# Scrape-time sources
+# ---------------------------------------------------------------------------
+
+def _metric_name(value: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', value)
+
+
+def _db_executor_samples():
+    from core.db_executor import pool_stats, stats
+
+    snapshot = stats.snapshot()
+    yield 'db_executor_workers', 'gauge', 'Threads in the DB executor.', [({}, snapshot['workers'])]
+    yield 'db_executor_calls_total', 'counter', 'Calls run on the DB executor.', [({}, snapshot['calls'])]
+    yield 'db_executor_in_flight', 'gauge', 'DB executor calls running now.', [({}, snapshot['in_flight'])]
+    yield ('db_executor_wait_max_seconds', 'gauge', 'Longest queue wait for a DB executor thread.',
+           [({}, snapshot['wait_max_ms'] / 1000)])
+    by_key = {}
+    for alias, pool in pool_stats().items():
+        for key, value in pool.items():
+            by_key.setdefault(key, []).append(({'alias': alias}, value))
+    for key, samples in sorted(by_key.items()):
+        yield f'db_pool_{_metric_name(key)}', 'gauge', f'Connection pool statistic {key}.', samples
+
+
+register_collector(_db_executor_samples)
+
+
+# ---------------------------------------------------------------------------
+# Endpoint
+# ---------------------------------------------------------------------------
+
+def _allowed(request) -> bool:
+    token = settings.METRICS_TOKEN
+    if token:
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        if hmac.compare_digest(header.encode(), f'Bearer {token}'.encode()):
+            return True
+    # Proxied requests come from the public side, whatever REMOTE_ADDR says
+    if 'HTTP_X_FORWARDED_FOR' in request.META:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(net) for net in settings.METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; a 404 for anyone not allowed to see it."""
+    if not _allowed(request):
+        raise Http404
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,25 @@
+"""Migration operations that behave on both PostgreSQL and the SQLite used in development.
+
+``AddIndexConcurrently`` builds the index with ``CREATE INDEX CONCURRENTLY``
+on PostgreSQL, so a large table keeps taking writes while it is built (a
+plain ``CREATE INDEX`` holds a lock that blocks them).  Other backends have
+no such syntax and get an ordinary ``AddIndex``.  Migrations using it must
+set ``atomic = False``: PostgreSQL refuses a concurrent build inside a
+transaction.
+"""
+from django.contrib.postgres import operations as postgres_operations
+from django.db import migrations
+
+
+class AddIndexConcurrently(postgres_operations.AddIndexConcurrently):
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
@@ -0,0 +1,204 @@
+"""Per-request / per-frame query profiling with N+1 detection.
+
+While a profile is active every query is counted, timed and reduced to its
+*shape* (the SQL with literals and ``IN (...)`` lists collapsed), so the
+same query run once per row shows up as one shape repeated N times.  When
+a request or websocket frame goes over ``QUERY_PROFILER_MAX_QUERIES``,
+``QUERY_PROFILER_MAX_DB_MS`` or repeats a shape more than
+``QUERY_PROFILER_REPEAT_THRESHOLD`` times, it is logged on the
+``mysite.queries`` logger with the worst shapes and the line of our code
+that first ran each one.
+
+Only a ``QUERY_PROFILER_SAMPLE_RATE`` fraction of requests and frames are
+profiled; at 0 (the default) the middleware is not installed and no query
+wrapper is added, so production pays nothing until it is turned on.
+Profiled responses carry a ``Server-Timing: db`` header.
+"""
+import logging
+import os
+import random
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger('mysite.queries')
+
+_profile: ContextVar[Optional['QueryProfile']] = ContextVar('query_profile', default=None)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*(?:%s|\?|\d+)(?:\s*,\s*(?:%s|\?|\d+))*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+_PROJECT_DIR = str(settings.BASE_DIR)
+# Query wrappers, not callers
+_SKIP_FILES = {
+    os.path.abspath(__file__),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.py'),
+}
+
+
+def query_shape(sql: str) -> str:
+    """``sql`` with literals and value lists replaced, for grouping repeats."""
+    shape = _STRING.sub('?', sql)
+    shape = _NUMBER.sub('?', shape)
+    shape = _IN_LIST.sub('(...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+
+def _caller(depth: int = 2) -> str:
+    """Innermost ``depth`` frames of project code (not Django, site-packages or the query wrappers)."""
+    found = []
+    frame = sys._getframe(2)
+    while frame is not None and len(found) < depth:
+        filename = frame.f_code.co_filename
+        if (filename.startswith(_PROJECT_DIR) and filename not in _SKIP_FILES
+                and 'site-packages' not in filename):
+            found.append(f'{os.path.relpath(filename, _PROJECT_DIR)}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ' <- '.join(found) or '?'
+
+
+class QueryProfile:
+    """Queries seen while one request or frame was handled."""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.origins = {}
+
+    def record(self, sql: str, duration: float) -> None:
+        shape = query_shape(sql)
+        self.count += 1
+        self.duration += duration
+        self.shapes[shape] += 1
+        if shape not in self.origins:
+            self.origins[shape] = _caller()
+
+    def repeated(self) -> List[Tuple[str, int]]:
+        threshold = settings.QUERY_PROFILER_REPEAT_THRESHOLD
+        return [(shape, n) for shape, n in self.shapes.most_common() if n > threshold]
+
+    def problems(self) -> List[str]:
+        found = []
+        if self.count > settings.QUERY_PROFILER_MAX_QUERIES:
+            found.append('queries')
+        if self.duration * 1000 > settings.QUERY_PROFILER_MAX_DB_MS:
+            found.append('db_time')
+        if self.repeated():
+            found.append('repeated')
+        return found
+
+    def report(self) -> None:
+        problems = self.problems()
+        if not problems:
+            return
+        lines = [
+            f'{self.label}: {self.count} queries, {self.duration * 1000:.1f} ms DB ({", ".join(problems)})'
+        ]
+        for shape, n in (self.repeated() or self.shapes.most_common(3))[:5]:
+            lines.append(f'  {n}x at {self.origins[shape]}: {shape[:300]}')
+        logger.warning('\n'.join(lines))
+
+
+def _record_query(execute, sql, params, many, context):
+    profile = _profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.record(sql, time.perf_counter() - started)
+
+
+_enabled = False
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if (_enabled or settings.QUERY_PROFILER_SAMPLE_RATE > 0) and _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def enable() -> None:
+    """Instrument connections even at sample rate 0, for explicit ``profile_queries`` use."""
+    global _enabled
+    _enabled = True
+    for connection in connections.all(initialized_only=True):
+        _instrument_connection(None, connection)
+
+
+connection_created.connect(_instrument_connection, dispatch_uid='mysite.query_profiler.instrument_connection')
+
+
+def sampled() -> bool:
+    rate = settings.QUERY_PROFILER_SAMPLE_RATE
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+@contextmanager
+def profile_queries(label: str, report: bool = True):
+    """Profile the queries run inside the block (and threads it hands work to); logs on problems."""
+    profile = QueryProfile(label)
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+        if report:
+            profile.report()
+
+
+def _server_timing(response, profile: QueryProfile) -> None:
+    response.headers['Server-Timing'] = f'db;dur={profile.duration * 1000:.1f};desc="{profile.count} queries"'
+
+
+class QueryProfilerMiddleware:
+    """Profile a sample of requests; see the module docstring."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not sampled():
+            return self.get_response(request)
+        with profile_queries(f'{request.method} {request.path}') as profile:
+            response = self.get_response(request)
+        _server_timing(response, profile)
+        return response
+
+    async def __acall__(self, request):
+        if not sampled():
+            return await self.get_response(request)
+        with profile_queries(f'{request.method} {request.path}') as profile:
+            response = await self.get_response(request)
+        _server_timing(response, profile)
+        return response
+
+
+class ConsumerQueryProfilerMixin:
+    """Profile a sample of inbound websocket frames, one profile per frame."""
+
+    async def websocket_receive(self, message):
+        if not sampled():
+            return await super().websocket_receive(message)
+        with profile_queries(f'WS {type(self).__name__} {self.scope.get("path", "")}'):
+            await super().websocket_receive(message)
@@ -55,6 +55,8 @@ CSRF_TRUSTED_ORIGINS = [origin.strip() for origin in csrf_origins if origin.stri
 
 # Security settings for production
 SECURE_SSL_REDIRECT = os.getenv('SECURE_SSL_REDIRECT', 'False') == 'True'
+# Health checks come from inside the platform over plain HTTP
+SECURE_REDIRECT_EXEMPT = [r'^healthz$']
 SESSION_COOKIE_SECURE = os.getenv('SESSION_COOKIE_SECURE', 'False') == 'True'
 CSRF_COOKIE_SECURE = os.getenv('CSRF_COOKIE_SECURE', 'False') == 'True'
 SECURE_BROWSER_XSS_FILTER = True
@@ -80,13 +82,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mysite.metrics.MetricsMiddleware',  # Prometheus request metrics (see /metrics)
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # For serving static files in production
+    'mysite.compression.CompressionMiddleware',  # gzip/brotli for dynamic responses
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'mysite.db_router.ReplicaPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -114,15 +119,34 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Connection pooling (psycopg_pool) for PostgreSQL. A pool replaces
+# persistent per-thread connections, so CONN_MAX_AGE must be 0 when it's on.
+DB_POOL = os.getenv('DB_POOL', 'True') == 'True'
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '8'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+
+
+def database_from_url(url):
+    config = dj_database_url.parse(
+        url,
+        conn_max_age=0 if DB_POOL else 600,
+        conn_health_checks=True,
+    )
+    if DB_POOL and config['ENGINE'] == 'django.db.backends.postgresql':
+        config.setdefault('OPTIONS', {})['pool'] = {
+            'min_size': DB_POOL_MIN_SIZE,
+            'max_size': DB_POOL_MAX_SIZE,
+            'timeout': DB_POOL_TIMEOUT,
+        }
+    return config
+
+
 # Use PostgreSQL in production (Render), SQLite in development
 if os.getenv('DATABASE_URL'):
     # Production: Use PostgreSQL from Render
     DATABASES = {
-        'default': dj_database_url.config(
-            default=os.getenv('DATABASE_URL'),
-            conn_max_age=600,
-            conn_health_checks=True,
-        )
+        'default': database_from_url(os.getenv('DATABASE_URL')),
     }
 else:
     # Development: Use SQLite
@@ -130,9 +154,39 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
-        }
+        },
+        # Local stand-in for a read replica (a copy of db.sqlite3); only used
+        # when USE_SQLITE_REPLICA=True, and mirrors `default` under tests.
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db_replica.sqlite3',
+            'TEST': {'MIRROR': 'default'},
+        },
     }
 
+# Read replicas: safe read-heavy views decorated with
+# mysite.db_router.replica_reads are served from these aliases.
+DATABASE_REPLICAS = []
+for i, replica_url in enumerate(u.strip() for u in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if u.strip()):
+    alias = f'replica{i + 1}'
+    DATABASES[alias] = database_from_url(replica_url)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+if 'replica' in DATABASES and os.getenv('USE_SQLITE_REPLICA', 'False') == 'True':
+    DATABASE_REPLICAS.append('replica')
+DATABASE_ROUTERS = ['mysite.db_router.PrimaryReplicaRouter']
+# Seconds a client keeps reading from the primary after it writes
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '5'))
+
+# Thread pool for ORM calls made from consumers/async views (core.db_executor).
+# Each thread holds one pooled connection.  Sync views and middleware run on
+# another thread that needs one too, so the default leaves one connection for
+# it; the executor alone can never exhaust the pool.  Other threads (warm-up,
+# management tasks) can still make a caller wait up to DB_POOL_TIMEOUT.
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', str(max(1, DB_POOL_MAX_SIZE - 1))))
+# Queue waits longer than this (seconds) are logged on the 'core.db' logger
+DB_EXECUTOR_WAIT_WARNING = float(os.getenv('DB_EXECUTOR_WAIT_WARNING', '0.1'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -210,8 +264,20 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 50,
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
+# Response compression (mysite.compression): bodies smaller than this stay plain
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+# Up to this many random bytes in each gzip header, so sizes do not leak secrets (BREACH)
+COMPRESSION_MAX_RANDOM_BYTES = int(os.getenv('COMPRESSION_MAX_RANDOM_BYTES', '100'))
+# 4-5 is the usual sweet spot for dynamic content (11 is for static assets)
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+
 # CORS settings - Allow API calls from mobile apps
 cors_origins_default = (
     'http://localhost:3000,'
@@ -250,3 +316,124 @@ else:
             'BACKEND': 'channels.layers.InMemoryChannelLayer',
         },
     }
+
+# Cache: shared Redis in production, local memory in development
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+# OTP storage backend: 'accounts.otp_store.DatabaseOTPStore' or
+# 'accounts.otp_store.CacheOTPStore' (codes expire through the cache TTL)
+OTP_STORE = os.getenv('OTP_STORE', 'accounts.otp_store.DatabaseOTPStore')
+# Seconds between opportunistic sweeps of expired/used OTP rows (0 disables)
+OTP_SWEEP_INTERVAL = int(os.getenv('OTP_SWEEP_INTERVAL', '3600'))
+# Wrong codes allowed before the code is used up and a new one is needed
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', '5'))
+
+# Rate limiting (core.ratelimit): shared Redis counters in production
+RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'True') == 'True'
+if os.getenv('REDIS_URL'):
+    RATELIMIT_BACKEND = 'core.ratelimit.RedisBackend'
+    RATELIMIT_REDIS_URL = os.getenv('REDIS_URL')
+else:
+    RATELIMIT_BACKEND = 'core.ratelimit.MemoryBackend'
+# Per-scope overrides, e.g. {'otp_phone': '3/h'}
+RATELIMIT_RATES = {}
+# Reverse proxies in front of the app that append to X-Forwarded-For; per-IP
+# limits use the address the outermost one saw (0 = REMOTE_ADDR)
+RATELIMIT_TRUSTED_PROXIES = int(os.getenv('RATELIMIT_TRUSTED_PROXIES', '0'))
+
+# Message archival (core.archive): messages older than this many days are
+# moved into compressed ArchiveSegment rows by `manage.py archive_messages`
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', '90'))
+MESSAGE_ARCHIVE_SEGMENT_SIZE = int(os.getenv('MESSAGE_ARCHIVE_SEGMENT_SIZE', '500'))
+
+# Room directory (core.directory): a message's weight in the activity rank
+# halves every ROOM_ACTIVITY_HALF_LIFE_HOURS
+ROOM_ACTIVITY_HALF_LIFE_HOURS = float(os.getenv('ROOM_ACTIVITY_HALF_LIFE_HOURS', '24'))
+ROOM_DIRECTORY_PAGE_SIZE = int(os.getenv('ROOM_DIRECTORY_PAGE_SIZE', '30'))
+ROOM_SIDEBAR_SIZE = int(os.getenv('ROOM_SIDEBAR_SIZE', '50'))
+
+# Template fragment caching (core.fragments): keys are versioned by the
+# write paths, so the timeout only bounds relative times like "5 minutes ago"
+FRAGMENT_CACHE_TIMEOUT = int(os.getenv('FRAGMENT_CACHE_TIMEOUT', '600'))
+
+# Batch message submission (core.batch): items per request, and how long
+# client idempotency keys are kept by `manage.py purge_idempotency_keys`
+MESSAGE_BATCH_MAX = int(os.getenv('MESSAGE_BATCH_MAX', '100'))
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', '72'))
+
+# Prometheus metrics (mysite.metrics): /metrics answers requests with
+# "Authorization: Bearer $METRICS_TOKEN", or unproxied ones from these networks
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_ALLOWED_NETWORKS = [
+    net.strip() for net in os.getenv(
+        'METRICS_ALLOWED_NETWORKS', '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16'
+    ).split(',') if net.strip()
+]
+
+# Query profiler (mysite.query_profiler): profiles this fraction of requests
+# and websocket frames (0 = off, 1 = all) and logs the ones over budget or
+# repeating one query shape more than QUERY_PROFILER_REPEAT_THRESHOLD times
+QUERY_PROFILER_SAMPLE_RATE = float(os.getenv('QUERY_PROFILER_SAMPLE_RATE', '0'))
+QUERY_PROFILER_MAX_QUERIES = int(os.getenv('QUERY_PROFILER_MAX_QUERIES', '30'))
+QUERY_PROFILER_MAX_DB_MS = float(os.getenv('QUERY_PROFILER_MAX_DB_MS', '250'))
+QUERY_PROFILER_REPEAT_THRESHOLD = int(os.getenv('QUERY_PROFILER_REPEAT_THRESHOLD', '5'))
+if QUERY_PROFILER_SAMPLE_RATE > 0:
+    MIDDLEWARE.insert(MIDDLEWARE.index('mysite.metrics.MetricsMiddleware') + 1, 'mysite.query_profiler.QueryProfilerMiddleware')
+
+# Worker warm-up (mysite.startup): "background", "blocking" or "off"; until it
+# finishes /healthz answers 503
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', 'off')
+STARTUP_TEMPLATES = [
+    'core/base.html',
+    'core/home.html',
+    'core/room_list.html',
+    'core/room_detail.html',
+    'core/dm_list.html',
+    'core/dm_thread.html',
+    'accounts/users_list.html',
+    'accounts/friends_list.html',
+]
+STARTUP_WARM_URLS = [url for url in os.getenv('STARTUP_WARM_URLS', '/,/rooms/').split(',') if url]
+
+# Image attachments (core.attachments): uploads stream to disk and are cut off
+# past ATTACHMENT_MAX_BYTES; ATTACHMENT_WORKERS processes make the downscaled
+# variants (longest side in pixels), 0 makes them inside the request
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', str(BASE_DIR / 'media'))
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', str(10 * 1024 * 1024)))
+ATTACHMENT_MAX_PIXELS = int(os.getenv('ATTACHMENT_MAX_PIXELS', '40000000'))
+ATTACHMENT_WORKERS = int(os.getenv('ATTACHMENT_WORKERS', '2'))
+ATTACHMENT_VARIANTS = {'thumb': 320, 'large': 1600}
+
+# Multi-process serving (`manage.py serve`, mysite.workers): daphne workers per
+# instance, and how long a stopping worker may take before it is killed.
+# Every worker has its own DB pool and DB executor threads.  One by default:
+# os.cpu_count() reports the host's cores, not the container's CPU quota.
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '1'))
+WEB_WORKER_GRACEFUL_TIMEOUT = float(os.getenv('WEB_WORKER_GRACEFUL_TIMEOUT', '30'))
+
+# Websocket drain on SIGTERM (mysite.drain): open sockets are told to reconnect
+# after a random delay in [WS_DRAIN_MIN_MS, WS_DRAIN_SPREAD_MS] and closed
+WS_DRAIN_MIN_MS = int(os.getenv('WS_DRAIN_MIN_MS', '500'))
+WS_DRAIN_SPREAD_MS = int(os.getenv('WS_DRAIN_SPREAD_MS', '15000'))
+
+# Conversation exports (core.export): messages read per keyset page
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '1000'))
+
+# Admin on large tables (mysite.large_admin): change lists count exactly up to
+# this many rows and estimate past it
+ADMIN_EXACT_COUNT_LIMIT = int(os.getenv('ADMIN_EXACT_COUNT_LIMIT', '10000'))
+
+# Chat history imports (core.importer): messages inserted per transaction
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '5000'))
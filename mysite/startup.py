@@ -0,0 +1,173 @@
+"""Worker warm-up, so the first requests after a deploy don't pay for boot.
+
+Without it the first visitors of a fresh daphne worker open the database
+connections (and the psycopg pool), build the URL resolvers, compile the
+templates and rebuild every cached fragment.  ``warm_up`` does all of that
+up front, in timed phases logged on the ``mysite.startup`` logger:
+
+* ``database``: one ``SELECT 1`` per alias, then one per DB executor thread;
+* ``urls``: the URL resolvers;
+* ``templates``: ``STARTUP_TEMPLATES`` into the cached template loader;
+* ``cache``: the cache connection and the room list fragment version;
+* ``pages``: one GET of each ``STARTUP_WARM_URLS`` through the full
+  middleware stack, which fills the page fragment caches.
+
+``mysite.asgi`` starts it according to ``STARTUP_WARMUP``: ``background``
+serves right away while warming up in a thread, ``blocking`` finishes it
+before the application is handed to the server, ``off`` (the default)
+skips it.  Unless it is off, ``/healthz`` answers 503 until the warm-up is
+done, so the load balancer only routes traffic to warm workers.  A failing phase is logged and skipped;
+a worker never stays unready because of the warm-up.
+"""
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.http import JsonResponse
+from django.views.decorators.cache import never_cache
+
+from mysite.drain import is_draining
+
+logger = logging.getLogger('mysite.startup')
+
+_ready = threading.Event()
+timings: Dict[str, float] = {}
+
+
+def is_ready() -> bool:
+    return _ready.is_set() or settings.STARTUP_WARMUP == 'off'
+
+
+def _ping(alias: str) -> None:
+    with connections[alias].cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+def warm_database() -> None:
+    for alias in connections:
+        _ping(alias)
+    close_old_connections()
+
+    # Each executor thread holds its own connection; the barrier makes every
+    # thread take exactly one of the tasks
+    from core.db_executor import get_executor
+    workers = settings.DB_EXECUTOR_WORKERS
+    barrier = threading.Barrier(workers)
+
+    def connect():
+        try:
+            _ping('default')
+            barrier.wait(timeout=10)
+        finally:
+            close_old_connections()
+
+    for future in [get_executor().submit(connect) for _ in range(workers)]:
+        future.result()
+
+
+def warm_urls() -> None:
+    from django.urls import get_resolver
+    get_resolver().resolve('/')
+
+
+def warm_templates() -> None:
+    from django.template.loader import get_template
+    for name in settings.STARTUP_TEMPLATES:
+        get_template(name)
+
+
+def warm_cache() -> None:
+    from core.fragments import room_list_version
+    room_list_version()
+
+
+def warm_pages() -> None:
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test import RequestFactory
+
+    # A handler of our own rather than the test client, which rewires the
+    # request signals for the whole process while it runs
+    handler = WSGIHandler()
+    host = next((h.lstrip('.') for h in settings.ALLOWED_HOSTS if h != '*'), 'localhost')
+    factory = RequestFactory(HTTP_HOST=host)
+    for url in settings.STARTUP_WARM_URLS:
+        environ = factory.get(url, secure=settings.SECURE_SSL_REDIRECT).environ
+        response = handler(environ, lambda status, headers, exc_info=None: None)
+        b''.join(response)
+        response.close()
+        if response.status_code != 200:
+            logger.warning('Warm-up GET %s returned %s', url, response.status_code)
+
+
+PHASES: List[Tuple[str, Callable[[], None]]] = [
+    ('database', warm_database),
+    ('urls', warm_urls),
+    ('templates', warm_templates),
+    ('cache', warm_cache),
+    ('pages', warm_pages),
+]
+
+
+def warm_up() -> Dict[str, float]:
+    """Run every phase; returns (and keeps in ``timings``) milliseconds per phase."""
+    started = time.perf_counter()
+    for name, phase in PHASES:
+        phase_started = time.perf_counter()
+        try:
+            phase()
+        except Exception:
+            logger.exception('Warm-up phase %s failed', name)
+        timings[name] = round((time.perf_counter() - phase_started) * 1000, 1)
+    timings['total'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info('Warm-up done in %.0f ms (%s)', timings['total'],
+                ', '.join(f'{name} {ms:.0f} ms' for name, ms in timings.items() if name != 'total'))
+    _ready.set()
+    return timings
+
+
+def start() -> None:
+    """Warm up according to ``STARTUP_WARMUP``; called once per worker from ``mysite.asgi``."""
+    mode = settings.STARTUP_WARMUP
+    if mode == 'blocking':
+        warm_up()
+    elif mode == 'background':
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+def profile_imports(module: str = 'mysite.asgi') -> List[Tuple[str, int, int, int]]:
+    """``(name, depth, self_us, cumulative_us)`` per module imported by a fresh ``import module``.
+
+    Runs ``python -X importtime`` in a subprocess with the warm-up off, so
+    only the import cost is measured.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=settings.BASE_DIR, capture_output=True, text=True,
+        env={**os.environ, 'STARTUP_WARMUP': 'off'},
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed')
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        stripped = name.lstrip()
+        rows.append((stripped.strip(), (len(name) - len(stripped) - 1) // 2, int(self_us), int(cumulative_us)))
+    return rows
+
+
+@never_cache
+def health_view(request):
+    """Load balancer health check: 503 while the worker is still warming up or draining."""
+    if is_draining():
+        return JsonResponse({'status': 'draining'}, status=503)
+    if not is_ready():
+        return JsonResponse({'status': 'starting'}, status=503)
+    return JsonResponse({'status': 'ready', 'warmup_ms': timings})
@@ -20,9 +20,13 @@ from django.views.generic import TemplateView
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
+from mysite.metrics import metrics_view
+from mysite.startup import health_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),  # Prometheus, internal only
+    path('healthz', health_view, name='healthz'),  # Load balancer health check
     # Serve service worker at root so it can control '/'
     path('service-worker.js', TemplateView.as_view(template_name='core/service-worker.js', content_type='application/javascript'), name='service_worker'),
     path('api/v1/', include('core.api_urls')),
@@ -0,0 +1,177 @@
+"""Multi-process serving: N daphne workers behind one listening address.
+
+A single daphne process runs on one core.  ``Supervisor`` binds the
+listening address in the parent and starts ``WEB_WORKERS`` daphne processes
+that adopt it through an inherited file descriptor:
+
+* with ``SO_REUSEPORT`` (Linux; the default where available) every worker
+  gets its own socket bound to the same address and the kernel hashes new
+  connections evenly across them.  With one shared socket instead, the
+  worker that wakes up first takes each connection, which piles long-lived
+  websockets onto whichever worker happens to be idlest at the time;
+* the parent keeps every socket open, so connections arriving while a
+  worker restarts wait in its backlog instead of being refused;
+* a worker that exits is started again, after a delay that doubles (up to
+  ``MAX_BACKOFF``) while it keeps dying within ``MIN_UPTIME`` of starting.
+  During that delay its ``SO_REUSEPORT`` socket is closed, or the kernel
+  would keep queueing its share of new connections where nobody accepts
+  them; the worker gets a freshly bound one when it starts again;
+* SIGTERM / SIGINT stop the workers with SIGTERM, then SIGKILL after
+  ``WEB_WORKER_GRACEFUL_TIMEOUT`` seconds.
+
+Workers share no memory.  Websocket groups reach across them only through
+the Redis channel layer, and the cache, rate limits, DB pool and
+``/metrics`` counters are per worker unless backed by Redis;
+``shared_state_problems`` lists what is not shared.  Each worker reads its
+number from ``WEB_WORKER_ID``.
+"""
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Optional, Sequence
+
+from django.conf import settings
+
+logger = logging.getLogger('mysite.workers')
+
+MIN_UPTIME = 10.0
+MAX_BACKOFF = 30.0
+POLL_INTERVAL = 0.2
+
+
+def shared_state_problems() -> List[str]:
+    """Per-process state that multiple workers would not share; the first entry (if any) is fatal."""
+    problems = []
+    if settings.CHANNEL_LAYERS['default']['BACKEND'].endswith('InMemoryChannelLayer'):
+        problems.append('the channel layer is in memory, so messages would not reach sockets on other '
+                        'workers (set REDIS_URL)')
+    if settings.CACHES['default']['BACKEND'].endswith('LocMemCache'):
+        problems.append('the cache is per process, so fragment versions can go stale on other workers')
+    if settings.RATELIMIT_ENABLED and settings.RATELIMIT_BACKEND.endswith('MemoryBackend'):
+        problems.append('rate limits are counted per worker')
+    return problems
+
+
+def bind_sockets(host: str, port: int, count: int, reuse_port: bool, backlog: int = 2048) -> List[socket.socket]:
+    """``count`` IPv4 sockets sharing ``(host, port)`` with ``SO_REUSEPORT``, or one without it.
+
+    IPv4 only: daphne adopts descriptors through Twisted's ``fd:`` endpoint,
+    which cannot be told any other address family.
+    """
+    if ':' in host:
+        raise ValueError(f'{host}: only IPv4 addresses can be handed to the workers')
+    sockets = []
+    for _ in range(count if reuse_port else 1):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Port 0: the others join whichever port the first one got
+        sock.bind((host, sockets[0].getsockname()[1] if sockets else port))
+        sock.listen(backlog)
+        sock.set_inheritable(True)
+        sockets.append(sock)
+    return sockets
+
+
+class Worker:
+    def __init__(self, index: int, sock: socket.socket):
+        self.index = index
+        # None while a crash-looping worker waits to restart (see ``Supervisor.reap``)
+        self.sock: Optional[socket.socket] = sock
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.backoff = 0.0
+        self.restarts = 0
+
+
+class Supervisor:
+    def __init__(self, application: str, host: str, port: int, workers: int,
+                 reuse_port: Optional[bool] = None, daphne_args: Sequence[str] = (),
+                 graceful_timeout: Optional[float] = None):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT') if reuse_port is None else reuse_port
+        self.daphne_args = list(daphne_args)
+        self.graceful_timeout = settings.WEB_WORKER_GRACEFUL_TIMEOUT if graceful_timeout is None else graceful_timeout
+        self.sockets = bind_sockets(host, port, workers, self.reuse_port)
+        self.port = self.sockets[0].getsockname()[1]
+        self.workers = [Worker(i, self.sockets[i % len(self.sockets)]) for i in range(workers)]
+        self.stopping = False
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    def command(self, worker: Worker) -> List[str]:
+        return [sys.executable, '-m', 'daphne', '--fd', str(worker.sock.fileno()), *self.daphne_args, self.application]
+
+    def spawn(self, worker: Worker) -> None:
+        if worker.sock is None:
+            worker.sock = bind_sockets(self.host, self.port, 1, reuse_port=True)[0]
+            self.sockets.append(worker.sock)
+        env = {**os.environ, 'WEB_WORKER_ID': str(worker.index)}
+        worker.process = subprocess.Popen(
+            self.command(worker), cwd=settings.BASE_DIR, env=env, pass_fds=[worker.sock.fileno()],
+        )
+        worker.started_at = time.monotonic()
+        logger.info('Worker %s started (pid %s)', worker.index, worker.process.pid)
+
+    def reap(self, worker: Worker, now: float) -> None:
+        code = worker.process.returncode
+        uptime = now - worker.started_at
+        worker.process = None
+        worker.restarts += 1
+        # Crash loops back off; a worker that ran for a while comes back at once
+        worker.backoff = min(MAX_BACKOFF, max(1.0, worker.backoff * 2)) if uptime < MIN_UPTIME else 0.0
+        worker.restart_at = now + worker.backoff
+        if self.reuse_port and worker.backoff:
+            self.sockets.remove(worker.sock)
+            worker.sock.close()
+            worker.sock = None
+        logger.warning('Worker %s exited with %s after %.1f s; restarting in %.0f s',
+                       worker.index, code, uptime, worker.backoff)
+
+    def handle_signal(self, signum, frame) -> None:
+        self.stopping = True
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        host, port = self.address
+        logger.info('Serving %s on %s:%s with %s workers (%s)', self.application, host, port, len(self.workers),
+                    'SO_REUSEPORT' if self.reuse_port else 'one shared socket')
+        for worker in self.workers:
+            self.spawn(worker)
+        while not self.stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is not None and worker.process.poll() is not None:
+                    self.reap(worker, now)
+                if worker.process is None and now >= worker.restart_at and not self.stopping:
+                    self.spawn(worker)
+            time.sleep(POLL_INTERVAL)
+        self.stop()
+        return 0
+
+    def stop(self) -> None:
+        running = [w.process for w in self.workers if w.process is not None and w.process.poll() is None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + self.graceful_timeout
+        for process in running:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning('Worker pid %s did not stop in time; killing it', process.pid)
+                process.kill()
+                process.wait()
+        for sock in self.sockets:
+            sock.close()
+        logger.info('All workers stopped')
@@ -0,0 +1,137 @@
+"""Before/after latency of the message hot path (sync_to_async vs native async ORM).
+
+Runs against a throwaway test database:
+
+    python scripts/bench_async_orm.py [frames]
+
+"before" re-creates the previous implementations (a thread hop per ORM call,
+room lookup on every frame, sync history view); "after" uses the current
+consumers and views.
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from asgiref.sync import sync_to_async  # noqa: E402
+from channels.generic.websocket import AsyncWebsocketConsumer  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.http import JsonResponse  # noqa: E402
+from django.shortcuts import get_object_or_404  # noqa: E402
+from django.test import AsyncRequestFactory  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.urls import path  # noqa: E402
+
+from core.consumers import ChatConsumer  # noqa: E402
+from core.models import Message, Room  # noqa: E402
+from core.views import api_messages  # noqa: E402
+
+
+class LegacyChatConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        self.room_slug = self.scope['url_route']['kwargs']['slug']
+        self.room_group_name = f'chat_{self.room_slug}'
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.accept()
+
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        room = await sync_to_async(Room.objects.get)(slug=self.room_slug)
+        message = await sync_to_async(Message.objects.create)(
+            room=room, author_name=data['author_name'], content=data['content'],
+        )
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'chat_message',
+            'data': {
+                'id': message.id,
+                'author_name': message.author_name,
+                'content': message.content,
+                'created_at': message.created_at.isoformat(),
+            },
+        })
+
+    async def chat_message(self, event):
+        await self.send(text_data=json.dumps(event['data']))
+
+
+def legacy_api_messages(request, slug):
+    room = get_object_or_404(Room, slug=slug)
+    after_id = int(request.GET.get('after', 0))
+    qs = room.messages.filter(id__gt=after_id).values('id', 'author_name', 'content', 'created_at')
+    data = [dict(m, created_at=m['created_at'].isoformat()) for m in qs]
+    return JsonResponse({'messages': data})
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'p95_ms': round(samples[int(len(samples) * 0.95)] * 1000, 3),
+    }
+
+
+async def bench_frames(consumer, frames):
+    app = URLRouter([path('ws/chat/<slug:slug>/', consumer.as_asgi())])
+    communicator = WebsocketCommunicator(app, '/ws/chat/bench/')
+    await communicator.connect()
+    samples = []
+    for i in range(frames):
+        started = time.perf_counter()
+        await communicator.send_json_to({'type': 'chat_message', 'author_name': 'bench', 'content': f'm{i}'})
+        await communicator.receive_json_from(timeout=5)
+        samples.append(time.perf_counter() - started)
+    await communicator.disconnect()
+    return summarize(samples)
+
+
+async def bench_poll(view, requests):
+    factory = AsyncRequestFactory()
+    after = await Message.objects.filter(room__slug='bench').order_by('-id').values_list('id', flat=True).afirst()
+    samples = []
+    for _ in range(requests):
+        request = factory.get('/api/r/bench/messages/', {'after': after})
+        started = time.perf_counter()
+        if asyncio.iscoroutinefunction(view):
+            await view(request, slug='bench')
+        else:
+            await sync_to_async(view)(request, slug='bench')
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+async def main(frames):
+    await Room.objects.acreate(name='bench')
+    results = {
+        'chat_frame': {
+            'before': await bench_frames(LegacyChatConsumer, frames),
+            'after': await bench_frames(ChatConsumer, frames),
+        },
+        'poll_empty': {
+            'before': await bench_poll(legacy_api_messages, frames),
+            'after': await bench_poll(api_messages, frames),
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    settings.RATELIMIT_ENABLED = False
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,92 @@
+"""Rows/second of the DRF serializers vs ``core.fast_serializers``.
+
+Runs against a throwaway test database:
+
+    python scripts/bench_serializers.py [rows] [rounds]
+
+Each round serializes and JSON-encodes one ``rows``-message page (the size
+the history endpoints return) including the database fetch.
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from accounts.models import Profile  # noqa: E402
+from core.archive import room_history, thread_history  # noqa: E402
+from core.fast_serializers import (  # noqa: E402
+    DIRECT_MESSAGE_COLUMNS, MESSAGE_COLUMNS, dumps, serialize_direct_messages, serialize_messages,
+)
+from core.models import DirectMessage, DirectThread, Message, Room  # noqa: E402
+from core.serializers import DirectMessageSerializer, MessageSerializer  # noqa: E402
+
+
+def seed(rows):
+    room = Room.objects.create(name='bench')
+    Message.objects.bulk_create(
+        Message(room=room, author_name=f'user {i % 20}', content=f'رسالة تجريبية رقم {i} ' * 3) for i in range(rows)
+    )
+    users = []
+    for i in range(2):
+        user = User.objects.create_user(username=f'bench{i}')
+        Profile.objects.create(user=user, phone=f'+96650000000{i}', name=f'مستخدم {i}')
+        users.append(user)
+    thread, _ = DirectThread.get_or_create_for_users(users[0].id, users[1].id)
+    DirectMessage.objects.bulk_create(
+        DirectMessage(thread=thread, author=users[i % 2], content=f'dm {i}') for i in range(rows)
+    )
+    return room, thread
+
+
+def rate(func, rows, rounds):
+    func()  # warm-up
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return round(rows * rounds / (time.perf_counter() - started))
+
+
+def main(rows, rounds):
+    room, thread = seed(rows)
+    render = JSONRenderer().render
+    cases = {
+        'room_messages': {
+            'before': lambda: render(MessageSerializer(room_history(room, limit=rows), many=True).data),
+            'after': lambda: dumps(serialize_messages(room_history(room, limit=rows, columns=MESSAGE_COLUMNS))),
+        },
+        'direct_messages': {
+            'before': lambda: render(DirectMessageSerializer(thread_history(thread, limit=rows), many=True).data),
+            'after': lambda: dumps(serialize_direct_messages(
+                thread_history(thread, limit=rows, columns=DIRECT_MESSAGE_COLUMNS),
+            )),
+        },
+    }
+    results = {}
+    for name, impls in cases.items():
+        assert impls['before']() == impls['after'](), f'{name}: output differs'
+        results[name] = {label: {'rows_per_sec': rate(func, rows, rounds)} for label, func in impls.items()}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        main(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+        )
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)